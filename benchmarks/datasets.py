@@ -0,0 +1,70 @@
+import os
+import os.path
+import random
+
+
+WORDS = [b'backup', b'dropbox', b'archive', b'session', b'chunk', b'upload', b'manifest',
+         b'incremental', b'snapshot', b'compress', b'stream', b'encrypt', b'restore', b'volume']
+
+
+def compressible_data(generator, size):
+    """Returns ``size`` bytes of text-like data which compresses roughly 3:1 with gzip."""
+    line_count = size // 64 + 1
+    lines = (b' '.join(generator.choice(WORDS) for _ in range(6)) +
+             b' %08x\n' % generator.getrandbits(32) for _ in range(line_count))
+    return b''.join(lines)[:size]
+
+
+def generate_small_files(path, total_size, seed=0, file_size=4096):
+    """Many small compressible files spread over nested folders."""
+    generator = random.Random(seed)
+    for index in range(max(1, total_size // file_size)):
+        folder = os.path.join(path, '{:03d}'.format(index // 500), '{:02d}'.format(index % 50))
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, 'file-{}.txt'.format(index)), 'wb') as data_file:
+            data_file.write(compressible_data(generator, file_size))
+
+
+def generate_huge_files(path, total_size, seed=0, file_count=2, block_size=4 * 1024 * 1024):
+    """A few big compressible files."""
+    generator = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    for index in range(file_count):
+        remaining = total_size // file_count
+        with open(os.path.join(path, 'huge-{}.log'.format(index)), 'wb') as data_file:
+            while remaining > 0:
+                data = compressible_data(generator, min(block_size, remaining))
+                data_file.write(data)
+                remaining -= len(data)
+
+
+def generate_incompressible_files(path, total_size, file_size=16 * 1024 * 1024):
+    """Random data, as found in media files or already compressed archives."""
+    os.makedirs(path, exist_ok=True)
+    index = 0
+    remaining = total_size
+    while remaining > 0:
+        with open(os.path.join(path, 'random-{}.bin'.format(index)), 'wb') as data_file:
+            data_file.write(os.urandom(min(file_size, remaining)))
+        remaining -= file_size
+        index += 1
+
+
+DATASETS = {
+    'small-files': generate_small_files,
+    'huge-files': generate_huge_files,
+    'incompressible': generate_incompressible_files,
+}
+
+
+def generate_dataset(name, path, total_size):
+    DATASETS[name](path, total_size)
+    return dataset_size(path)
+
+
+def dataset_size(path):
+    size = 0
+    for dir_path, _, file_names in os.walk(path):
+        for name in file_names:
+            size += os.path.getsize(os.path.join(dir_path, name))
+    return size
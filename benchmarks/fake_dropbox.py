@@ -0,0 +1,408 @@
+import hashlib
+import itertools
+import random
+import re
+import threading
+import time
+
+from dropbox.exceptions import ApiError, InternalServerError, RateLimitError
+from dropbox.files import (DeleteBatchJobStatus, DeleteBatchLaunch, DeleteBatchResult,
+                           DeleteBatchResultData, DeleteBatchResultEntry, DeleteError, DownloadError,
+                           FileMetadata, FolderMetadata, GetMetadataError, ListFolderError,
+                           ListFolderResult, LookupError, RelocationError, RelocationResult,
+                           UploadSessionAppendError,
+                           UploadSessionFinishError, UploadSessionLookupError,
+                           UploadSessionOffsetError, UploadSessionStartResult, UploadSessionType,
+                           WriteConflictError, WriteError)
+
+
+class FakeFile:
+    """File stored by ``FakeDropbox``: only small files keep their content."""
+
+    def __init__(self, path, size, content_hash, content):
+        self.path = path
+        self.size = size
+        self.content_hash = content_hash
+        self.content = content
+
+
+class FakeContentHash:
+    """Dropbox content hash: the SHA-256 of the SHA-256 of every 4MB block."""
+
+    BLOCK_SIZE = 4 * 1024 * 1024 # 4MB
+
+    def __init__(self):
+        self.block_digests = []
+        self.__block = bytearray()
+
+    def update(self, data):
+        self.__block += data
+        while len(self.__block) >= FakeContentHash.BLOCK_SIZE:
+            self.block_digests.append(
+                hashlib.sha256(self.__block[:FakeContentHash.BLOCK_SIZE]).digest())
+            del self.__block[:FakeContentHash.BLOCK_SIZE]
+
+    def hexdigest(self):
+        digests = list(self.block_digests)
+        if self.__block:
+            digests.append(hashlib.sha256(self.__block).digest())
+        return hashlib.sha256(b''.join(digests)).hexdigest()
+
+    @staticmethod
+    def of(data):
+        content_hash = FakeContentHash()
+        content_hash.update(data)
+        return content_hash.hexdigest()
+
+
+class FakeUploadSession:
+
+    def __init__(self, concurrent):
+        self.concurrent = concurrent
+        self.offset = 0
+        self.content_hash = FakeContentHash()
+        self.content = bytearray()
+        self.pieces = {}
+        # Content of the pieces of a small concurrent session, or the digests of their blocks.
+        self.piece_contents = {}
+        self.piece_digests = {}
+        self.closed = False
+
+
+class FakeDropbox:
+    """In-process fake of the part of the Dropbox API used by ``DropboxClient``.
+
+    Every request waits ``latency`` seconds and, when ``bandwidth`` (bytes
+    per second) is set, data is sent through a link shared by all the
+    threads. Upload session and range download requests fail with a
+    transient error with probability ``error_rate``, and appends store their
+    data but fail anyway with probability ``lost_response_rate``, as if the
+    response had been lost. Upload requests beyond ``max_concurrent_uploads``
+    in flight are throttled, asking to retry after ``retry_after`` seconds.
+    Only the size and content hash of the files are
+    kept, plus the content of those smaller than ``max_stored_content``.
+    """
+
+    LIST_PAGE_SIZE = 100
+    DELETE_BATCH_CHECKS = 1
+
+    def __init__(self, latency=0, bandwidth=None, error_rate=0, lost_response_rate=0, seed=0,
+                 max_stored_content=1024 * 1024, max_concurrent_uploads=None, retry_after=1):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.lost_response_rate = lost_response_rate
+        self.max_stored_content = max_stored_content
+        self.max_concurrent_uploads = max_concurrent_uploads
+        self.retry_after = retry_after
+        self.files = {}
+        self.stats = {'requests': 0,
+                      'errors': 0,
+                      'throttled': 0,
+                      'max_concurrent_uploads': 0,
+                      'bytes_received': 0,
+                      'first_upload_time': None,
+                      'last_upload_time': None}
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__link_free_at = 0
+        self.__uploads_in_flight = 0
+        self.__sessions = {}
+        self.__delete_jobs = {}
+        self.__list_cursors = {}
+        self.__ids = itertools.count(1)
+
+    def files_upload(self, f, path, mode=None):
+        self._transfer(f)
+        self._store(path, len(f), FakeContentHash.of(f), f, mode)
+        return self._metadata(self.files[path])
+
+    def files_upload_session_start(self, f, close=False, session_type=None):
+        self._transfer(f)
+        self._maybe_fail()
+        session = FakeUploadSession(session_type == UploadSessionType.concurrent)
+        self._write_session(session, 0, f)
+        session.closed = close
+        with self.__lock:
+            session_id = 'session-{}'.format(next(self.__ids))
+            self.__sessions[session_id] = session
+        return UploadSessionStartResult(session_id)
+
+    def files_upload_session_append_v2(self, f, cursor, close=False):
+        self._transfer(f)
+        self._maybe_fail()
+        session = self._get_session(cursor, UploadSessionAppendError)
+        self._write_session(session, cursor.offset, f, UploadSessionAppendError)
+        session.closed = session.closed or close
+        self._maybe_lose_response()
+
+    def files_upload_session_finish(self, f, cursor, commit):
+        self._transfer(f)
+        self._maybe_fail()
+        session = self._get_session(cursor, UploadSessionFinishError)
+        self._write_session(session, cursor.offset, f, UploadSessionFinishError)
+        if session.concurrent:
+            size = sum(session.pieces.values())
+            if cursor.offset + len(f) != size or \
+                    not FakeDropbox._is_contiguous(session.pieces):
+                raise self._api_error(UploadSessionFinishError.concurrent_session_missing_data)
+            content_hash, content = FakeDropbox._concurrent_content(session)
+        else:
+            size = session.offset
+            content_hash, content = session.content_hash.hexdigest(), session.content
+        self._store(commit.path, size, content_hash, content, commit.mode)
+        with self.__lock:
+            del self.__sessions[cursor.session_id]
+        return self._metadata(self.files[commit.path])
+
+    def files_list_folder(self, path):
+        self._request()
+        prefix = path.rstrip('/') + '/'
+        with self.__lock:
+            names = sorted({file_path[len(prefix):].split('/')[0]
+                            for file_path in self.files if file_path.startswith(prefix)})
+        if not names:
+            raise self._api_error(ListFolderError.path(LookupError.not_found))
+        return self._list_page(prefix, names, 0)
+
+    def files_list_folder_continue(self, cursor):
+        self._request()
+        prefix, names, start = self.__list_cursors.pop(cursor)
+        return self._list_page(prefix, names, start)
+
+    def files_copy_v2(self, from_path, to_path):
+        self._request()
+        with self.__lock:
+            stored = self.files.get(from_path)
+            if stored is None:
+                raise self._api_error(RelocationError.from_lookup(LookupError.not_found))
+            if to_path in self.files:
+                raise self._api_error(RelocationError.to(WriteError.conflict(
+                    WriteConflictError.file)))
+            self.files[to_path] = FakeFile(to_path, stored.size, stored.content_hash,
+                                           stored.content)
+        return RelocationResult(self._metadata(self.files[to_path]))
+
+    def files_delete_v2(self, path):
+        self._request()
+        with self.__lock:
+            if self.files.pop(path, None) is None:
+                raise self._api_error(DeleteError.path_lookup(LookupError.not_found))
+
+    def files_delete_batch(self, entries):
+        self._request()
+        entries_result = []
+        with self.__lock:
+            for entry in entries:
+                deleted = self.files.pop(entry.path, None)
+                if deleted is None:
+                    entries_result.append(DeleteBatchResultEntry.failure(
+                        DeleteError.path_lookup(LookupError.not_found)))
+                else:
+                    entries_result.append(DeleteBatchResultEntry.success(
+                        DeleteBatchResultData(self._metadata(deleted))))
+            job_id = 'job-{}'.format(next(self.__ids))
+            self.__delete_jobs[job_id] = [FakeDropbox.DELETE_BATCH_CHECKS, entries_result]
+        return DeleteBatchLaunch.async_job_id(job_id)
+
+    def files_delete_batch_check(self, async_job_id):
+        self._request()
+        with self.__lock:
+            job = self.__delete_jobs[async_job_id]
+            if job[0] > 0:
+                job[0] -= 1
+                return DeleteBatchJobStatus('in_progress')
+            del self.__delete_jobs[async_job_id]
+        return DeleteBatchJobStatus.complete(DeleteBatchResult(job[1]))
+
+    def files_download(self, path, byte_range=None):
+        self._request()
+        stored = self.files.get(path)
+        if stored is None or stored.content is None:
+            raise self._api_error(DownloadError.path(LookupError.not_found))
+        content = bytes(stored.content)
+        if byte_range is not None:
+            self._maybe_fail()
+            start, end = byte_range
+            content = content[start:end + 1]
+        return self._metadata(stored), FakeResponse(content)
+
+    def files_get_metadata(self, path):
+        self._request()
+        stored = self.files.get(path)
+        if stored is None:
+            raise self._api_error(GetMetadataError.path(LookupError.not_found))
+        return self._metadata(stored)
+
+    def clone(self, headers=None):
+        """Returns a client sending ``headers``, of which only ``Range`` is supported."""
+        return FakeDropboxClone(self, headers or {})
+
+    def _list_page(self, prefix, names, start):
+        end = start + FakeDropbox.LIST_PAGE_SIZE
+        entries = []
+        for name in names[start:end]:
+            stored = self.files.get(prefix + name)
+            if stored is None:
+                entries.append(FolderMetadata(name=name, id='id:' + prefix + name))
+            else:
+                entries.append(self._metadata(stored))
+        cursor = None
+        if end < len(names):
+            cursor = 'cursor-{}'.format(next(self.__ids))
+            self.__list_cursors[cursor] = (prefix, names, end)
+        return ListFolderResult(entries=entries, cursor=cursor, has_more=cursor is not None)
+
+    def _request(self):
+        with self.__lock:
+            self.stats['requests'] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _transfer(self, data):
+        """Waits for the request and for ``data`` to go through the shared link."""
+        with self.__lock:
+            if self.stats['first_upload_time'] is None:
+                self.stats['first_upload_time'] = time.perf_counter()
+            throttled = self.max_concurrent_uploads is not None and \
+                self.__uploads_in_flight >= self.max_concurrent_uploads
+            if throttled:
+                self.stats['throttled'] += 1
+            else:
+                self.__uploads_in_flight += 1
+                self.stats['max_concurrent_uploads'] = max(self.stats['max_concurrent_uploads'],
+                                                           self.__uploads_in_flight)
+        if throttled:
+            raise RateLimitError('fake', backoff=self.retry_after)
+        try:
+            self._request()
+            now = time.perf_counter()
+            with self.__lock:
+                self.stats['bytes_received'] += len(data)
+                done_at = now
+                if self.bandwidth:
+                    done_at = max(now, self.__link_free_at) + len(data) / self.bandwidth
+                    self.__link_free_at = done_at
+            if done_at > now:
+                time.sleep(done_at - now)
+        finally:
+            with self.__lock:
+                self.__uploads_in_flight -= 1
+                self.stats['last_upload_time'] = time.perf_counter()
+
+    def _maybe_fail(self):
+        with self.__lock:
+            failed = self.__random.random() < self.error_rate
+            if failed:
+                self.stats['errors'] += 1
+        if failed:
+            raise InternalServerError('fake', 503, 'Injected error')
+
+    def _maybe_lose_response(self):
+        with self.__lock:
+            lost = self.__random.random() < self.lost_response_rate
+            if lost:
+                self.stats['errors'] += 1
+        if lost:
+            raise InternalServerError('fake', 503, 'Injected lost response')
+
+    def _get_session(self, cursor, error_type):
+        with self.__lock:
+            session = self.__sessions.get(cursor.session_id)
+        if session is None:
+            raise self._session_error(error_type, 'not_found')
+        return session
+
+    def _write_session(self, session, offset, data, error_type=None):
+        with self.__lock:
+            if session.concurrent:
+                if data:
+                    session.pieces[offset] = len(data)
+                    if sum(session.pieces.values()) <= self.max_stored_content:
+                        session.piece_contents[offset] = bytes(data)
+                    # Pieces but the last one are aligned to blocks, as Dropbox requires.
+                    session.piece_digests[offset] = [hashlib.sha256(data[start:start +
+                                                     FakeContentHash.BLOCK_SIZE]).digest()
+                                                     for start in range(0, len(data),
+                                                                        FakeContentHash.BLOCK_SIZE)]
+                return
+            if offset != session.offset:
+                raise self._session_error(error_type,
+                                          'incorrect_offset',
+                                          UploadSessionOffsetError(correct_offset=session.offset))
+            session.offset += len(data)
+            session.content_hash.update(data)
+            if session.offset <= self.max_stored_content:
+                session.content += data
+            else:
+                session.content = None
+
+    def _store(self, path, size, content_hash, content, mode):
+        with self.__lock:
+            if path in self.files and (mode is None or mode.is_add()):
+                raise self._api_error(WriteError.conflict(WriteConflictError.file))
+            if content is not None and size > self.max_stored_content:
+                content = None
+            self.files[path] = FakeFile(path, size, content_hash, content)
+
+    def _metadata(self, stored):
+        name = stored.path.rsplit('/', 1)[-1]
+        return FileMetadata(name=name,
+                            id='id:' + stored.path,
+                            size=stored.size,
+                            content_hash=stored.content_hash)
+
+    @staticmethod
+    def _concurrent_content(session):
+        """Returns the content hash and, if it's small, the content of a concurrent session."""
+        if len(session.piece_contents) == len(session.pieces):
+            content = b''.join(session.piece_contents[offset] for offset in sorted(session.pieces))
+            return FakeContentHash.of(content), content
+        digests = [digest for offset in sorted(session.pieces)
+                   for digest in session.piece_digests[offset]]
+        return hashlib.sha256(b''.join(digests)).hexdigest(), None
+
+    @staticmethod
+    def _session_error(error_type, tag, value=None):
+        """Builds the error of a session lookup for an append or a finish request."""
+        if error_type is UploadSessionFinishError:
+            return FakeDropbox._api_error(
+                UploadSessionFinishError.lookup_failed(UploadSessionLookupError(tag, value)))
+        return FakeDropbox._api_error(error_type(tag, value))
+
+    @staticmethod
+    def _is_contiguous(pieces):
+        offset = 0
+        for start in sorted(pieces):
+            if start != offset:
+                return False
+            offset += pieces[start]
+        return True
+
+    @staticmethod
+    def _api_error(error):
+        return ApiError('fake', error, None, None)
+
+
+class FakeDropboxClone:
+
+    RANGE_RE = re.compile(r'^bytes=(\d+)-(\d+)$')
+
+    def __init__(self, fake, headers):
+        self.__fake = fake
+        self.__range = None
+        if 'Range' in headers:
+            match = FakeDropboxClone.RANGE_RE.match(headers['Range'])
+            self.__range = (int(match.group(1)), int(match.group(2)))
+
+    def files_download(self, path):
+        return self.__fake.files_download(path, self.__range)
+
+
+class FakeResponse:
+
+    def __init__(self, content):
+        self.content = content
+
+    def close(self):
+        pass
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""End-to-end benchmarks of the backup pipeline against an in-process fake Dropbox.
+
+Every case runs in a fresh process so its peak RSS can be measured. Run it
+from the root of the repository:
+
+    $ python -m benchmarks.suite --size 64 --baseline benchmarks/baseline.json
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import os.path
+import sys
+import tempfile
+import threading
+import time
+
+from backup_to_dropbox.clients import DropboxClient
+from backup_to_dropbox.metrics import RunMetrics, peak_rss_bytes
+from backup_to_dropbox.services import BackupService
+
+from benchmarks.datasets import DATASETS, generate_dataset
+from benchmarks.fake_dropbox import FakeDropbox
+
+
+MB = 1024 * 1024
+
+MODES = {
+    'tempfile': {},
+    'streaming': {'streaming': True},
+    'concurrent': {'streaming': True, 'upload_concurrency': 4, 'compress_threads': 4},
+}
+
+# Metrics compared against the baseline: True when higher is better.
+COMPARED_METRICS = {
+    'total_mb_s': True,
+    'archive_mb_s': True,
+    'upload_mb_s': True,
+    'files_per_s': True,
+    'peak_rss_mb': False,
+    'peak_scratch_mb': False,
+}
+# Differences below this are never reported, so tiny values don't flag noise.
+ABSOLUTE_SLACK = 1
+
+
+class ScratchMonitor:
+    """Samples the disk used under a folder, including files deleted but still open."""
+
+    INTERVAL = 0.05
+
+    def __init__(self, path):
+        self.path = path
+        self.peak = 0
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__sample, daemon=True)
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        self.__thread.join()
+        self.peak = max(self.peak, self.usage())
+
+    def usage(self):
+        usage = 0
+        for dir_path, _, file_names in os.walk(self.path):
+            for name in file_names:
+                try:
+                    usage += os.lstat(os.path.join(dir_path, name)).st_blocks * 512
+                except FileNotFoundError:
+                    pass
+        # Temporary files are unlinked right after being created: only
+        # /proc (Linux) still shows them.
+        if os.path.isdir('/proc/self/fd'):
+            for fd in os.listdir('/proc/self/fd'):
+                try:
+                    target = os.readlink(os.path.join('/proc/self/fd', fd))
+                    if target.startswith(self.path) and target.endswith(' (deleted)'):
+                        usage += os.fstat(int(fd)).st_blocks * 512
+                except OSError:
+                    pass
+        return usage
+
+    def __sample(self):
+        while not self.__stop.wait(ScratchMonitor.INTERVAL):
+            self.peak = max(self.peak, self.usage())
+
+
+def run_backup_case(dataset_path, input_size, mode, fake_options, max_upload_memory, scratch_dir):
+    tempfile.tempdir = scratch_dir
+    options = MODES[mode]
+    fake = FakeDropbox(**fake_options)
+    metrics = RunMetrics()
+    client = DropboxClient(fake,
+                           upload_concurrency=options.get('upload_concurrency', 1),
+                           max_upload_memory=max_upload_memory,
+                           metrics=metrics)
+    service = BackupService(client,
+                            'benchmark',
+                            streaming=options.get('streaming', False),
+                            compress_threads=options.get('compress_threads', 1),
+                            metrics=metrics)
+    monitor = ScratchMonitor(scratch_dir)
+    monitor.start()
+    start_time = time.perf_counter()
+    service.backup_paths([dataset_path])
+    end_time = time.perf_counter()
+    monitor.stop()
+
+    stats = fake.stats
+    upload_time = stats['last_upload_time'] - stats['first_upload_time']
+    result = {
+        'input_mb': input_size / MB,
+        'uploaded_mb': stats['bytes_received'] / MB,
+        'seconds': end_time - start_time,
+        'total_mb_s': input_size / MB / (end_time - start_time),
+        'upload_mb_s': stats['bytes_received'] / MB / max(upload_time, 1e-6),
+        'peak_rss_mb': peak_rss_bytes() / MB,
+        'peak_scratch_mb': monitor.peak / MB,
+        'requests': stats['requests'],
+        'errors': stats['errors'],
+        'throttled': stats['throttled'],
+        'stages': metrics.report()['stages'],
+    }
+    if not options.get('streaming', False):
+        # The archive is fully generated before the upload starts.
+        archive_time = stats['first_upload_time'] - start_time
+        result['archive_mb_s'] = input_size / MB / archive_time
+    return result
+
+
+def run_cleanup_case(backup_count, fake_options):
+    fake_options = dict(fake_options, error_rate=0, lost_response_rate=0)
+    fake = FakeDropbox(**fake_options)
+    for day in range(backup_count):
+        timestamp = '{:04d}-01-01-{:02d}{:02d}'.format(2000 + day // 1440,
+                                                       day % 1440 // 60,
+                                                       day % 60)
+        fake.files_upload(b'backup', '/benchmark/{}.tar.gz'.format(timestamp))
+    service = BackupService(DropboxClient(fake), 'benchmark')
+    start_time = time.perf_counter()
+    service.cleanup_old_backups(10)
+    end_time = time.perf_counter()
+    return {
+        'seconds': end_time - start_time,
+        'files_per_s': (backup_count - 10) / (end_time - start_time),
+        'requests': fake.stats['requests'] - backup_count,
+    }
+
+
+def run_isolated(function, *args):
+    """Runs ``function`` in a new process and returns its result."""
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(function, args)
+
+
+def compare(results, baseline, tolerance):
+    """Returns the descriptions of the metrics which got worse than ``tolerance``."""
+    regressions = []
+    for case, metrics in sorted(results.items()):
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            current = metrics.get(metric)
+            previous = baseline.get(case, {}).get(metric)
+            if current is None or previous is None:
+                continue
+            if higher_is_better:
+                worse = current < previous * (1 - tolerance) - ABSOLUTE_SLACK
+            else:
+                worse = current > previous * (1 + tolerance) + ABSOLUTE_SLACK
+            change = (current - previous) / previous * 100 if previous else 0
+            print('{:<28} {:<16} {:>10.1f} {:>10.1f} {:>+8.1f}% {}'.format(
+                case, metric, previous, current, change, 'REGRESSION' if worse else ''))
+            if worse:
+                regressions.append('{} {}: {:.1f} -> {:.1f}'.format(case, metric, previous, current))
+    return regressions
+
+
+def print_results(results):
+    columns = [('total_mb_s', 'total MB/s'),
+               ('archive_mb_s', 'archive MB/s'),
+               ('upload_mb_s', 'upload MB/s'),
+               ('files_per_s', 'deleted/s'),
+               ('peak_rss_mb', 'RSS MB'),
+               ('peak_scratch_mb', 'scratch MB'),
+               ('errors', 'errors'),
+               ('throttled', 'throttled')]
+    print('{:<28}'.format('case') + ''.join('{:>14}'.format(title) for _, title in columns))
+    for case, metrics in sorted(results.items()):
+        print('{:<28}'.format(case) + ''.join(
+            '{:>14}'.format('-' if metrics.get(metric) is None else
+                            '{:.1f}'.format(metrics[metric])) for metric, _ in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark backups against a fake Dropbox.')
+    parser.add_argument('--datasets',
+                        nargs='+',
+                        choices=sorted(DATASETS),
+                        default=sorted(DATASETS),
+                        help='Synthetic datasets to back up')
+    parser.add_argument('--modes',
+                        nargs='+',
+                        choices=sorted(MODES),
+                        default=sorted(MODES),
+                        help='Backup configurations to run on every dataset')
+    parser.add_argument('--size',
+                        type=int,
+                        default=64,
+                        help='Size (in MB) of every dataset')
+    parser.add_argument('--max-upload-memory',
+                        type=int,
+                        default=32,
+                        help='Max amount of memory (in MB) used by uploads, files bigger than '
+                             'this are uploaded through sessions')
+    parser.add_argument('--cleanup-backups',
+                        type=int,
+                        default=5000,
+                        help='Number of backups in the folder for the cleanup case (0 to skip)')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0,
+                        help='Latency (in ms) of every request to the fake Dropbox')
+    parser.add_argument('--bandwidth',
+                        type=float,
+                        help='Bandwidth (in MB/s) of the link to the fake Dropbox')
+    parser.add_argument('--error-rate',
+                        type=float,
+                        default=0,
+                        help='Probability of an upload session request failing')
+    parser.add_argument('--lost-response-rate',
+                        type=float,
+                        default=0,
+                        help='Probability of losing the response of an append')
+    parser.add_argument('--max-concurrent-uploads',
+                        type=int,
+                        help='Upload requests in flight beyond which the fake Dropbox throttles '
+                             'them')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='Seed for the error injection')
+    parser.add_argument('--output',
+                        help='File to save the results to (JSON)')
+    parser.add_argument('--baseline',
+                        help='JSON file with the results to compare against')
+    parser.add_argument('--save-baseline',
+                        action='store_true',
+                        help='Save the results as the new baseline')
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=0.1,
+                        help='Relative change tolerated before reporting a regression')
+    args = parser.parse_args()
+
+    fake_options = {
+        'latency': args.latency / 1000,
+        'bandwidth': args.bandwidth * MB if args.bandwidth else None,
+        'error_rate': args.error_rate,
+        'lost_response_rate': args.lost_response_rate,
+        'max_concurrent_uploads': args.max_concurrent_uploads,
+        'seed': args.seed,
+    }
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        scratch_dir = os.path.join(work_dir, 'scratch')
+        os.makedirs(scratch_dir)
+        for dataset in args.datasets:
+            dataset_path = os.path.join(work_dir, dataset)
+            logging.info('Generating dataset %s', dataset)
+            input_size = generate_dataset(dataset, dataset_path, args.size * MB)
+            for mode in args.modes:
+                case = '{}/{}'.format(dataset, mode)
+                logging.info('Running %s', case)
+                results[case] = run_isolated(run_backup_case,
+                                             dataset_path,
+                                             input_size,
+                                             mode,
+                                             fake_options,
+                                             args.max_upload_memory * MB,
+                                             scratch_dir)
+    if args.cleanup_backups > 0:
+        logging.info('Running cleanup')
+        results['cleanup'] = run_isolated(run_cleanup_case, args.cleanup_backups, fake_options)
+
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+
+    regressions = []
+    if args.baseline is not None:
+        if args.save_baseline:
+            with open(args.baseline, 'w') as baseline_file:
+                json.dump(results, baseline_file, indent=2, sort_keys=True)
+            logging.info('Saved baseline to %s', args.baseline)
+        elif os.path.exists(args.baseline):
+            with open(args.baseline) as baseline_file:
+                regressions = compare(results, json.load(baseline_file), args.tolerance)
+        else:
+            logging.warning('Baseline %s not found: pass --save-baseline to create it',
+                            args.baseline)
+    if regressions:
+        logging.error('%d metrics regressed:\n%s', len(regressions), '\n'.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    main()
@@ -1,60 +1,791 @@
+import functools
+import hashlib
 import io
+import json
 import logging
+import os
+import random
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from dropbox.exceptions import ApiError, InternalServerError, RateLimitError
+from dropbox.files import (CommitInfo, DeleteArg, FileMetadata, UploadSessionCursor,
+                           UploadSessionFinishError, UploadSessionLookupError, UploadSessionType,
+                           WriteMode)
+from requests.exceptions import ChunkedEncodingError, ConnectionError, Timeout
+
+from backup_to_dropbox.metrics import RunMetrics
+from backup_to_dropbox.streams import HashingReader, PrefetchReader, pending_futures
+from backup_to_dropbox.throttle import AdaptiveConcurrency
+
+
+class UploadSessionState:
+    """Progress of an upload session, persisted in a JSON file so it can be resumed."""
+
+    def __init__(self, state_path):
+        self.state_path = state_path
+
+    def load(self):
+        try:
+            with open(self.state_path) as state_file:
+                return json.load(state_file)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logging.warning('Ignoring corrupted upload state "%s": %s', self.state_path, e)
+            return None
+
+    def save(self, path, checksum, session_id, offset):
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w') as state_file:
+            json.dump({'path': path,
+                       'checksum': checksum,
+                       'session_id': session_id,
+                       'offset': offset}, state_file)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(temp_path, self.state_path)
+
+    def clear(self):
+        try:
+            os.remove(self.state_path)
+        except FileNotFoundError:
+            pass
+
+
+class ContentHasher:
+    """Computes the Dropbox content hash of data given in pieces of any size.
+
+    It's the SHA-256 of the concatenated SHA-256 of every 4MB block of the
+    data, which Dropbox reports in the metadata of every file, so files can
+    be compared and uploads verified without downloading them.
+    """
+
+    BLOCK_SIZE = 4 * 1024 * 1024 # 4MB
+
+    def __init__(self):
+        self.__digest = hashlib.sha256()
+        self.__block = hashlib.sha256()
+        self.__block_size = 0
+        self.size = 0
+
+    def update(self, data):
+        view = memoryview(data).cast('B')
+        while view:
+            piece = view[:ContentHasher.BLOCK_SIZE - self.__block_size]
+            self.__block.update(piece)
+            self.__block_size += len(piece)
+            self.size += len(piece)
+            view = view[len(piece):]
+            if self.__block_size == ContentHasher.BLOCK_SIZE:
+                self.__digest.update(self.__block.digest())
+                self.__block = hashlib.sha256()
+                self.__block_size = 0
+
+    def hexdigest(self):
+        digest = self.__digest.copy()
+        if self.__block_size:
+            digest.update(self.__block.digest())
+        return digest.hexdigest()
+
+
+class AdaptiveChunkSizer:
+    """Picks the size of the next upload request from the performance of the previous ones.
+
+    Sizes are multiples of ``alignment`` between ``min_size`` and
+    ``max_size``. The size doubles while that doesn't make the throughput
+    drop, and halves when the throughput drops or a request takes longer
+    than ``target_latency`` seconds. If given, ``size_limit`` returns the
+    current max size, or ``None`` when there is none.
+    """
+
+    TARGET_LATENCY = 30 # seconds
+    THROUGHPUT_TOLERANCE = 0.9
+
+    def __init__(self, min_size, max_size, initial_size, alignment,
+                 target_latency=TARGET_LATENCY, size_limit=None):
+        self.__alignment = alignment
+        self.__size_limit = size_limit
+        self.__min_size = max(alignment, min_size - min_size % alignment)
+        self.__max_size = max(self.__min_size, max_size - max_size % alignment)
+        self.__target_latency = target_latency
+        self.__lock = threading.Lock()
+        self.__last_throughput = None
+        self.__size = self._clamp(initial_size)
+        logging.debug('Using upload chunks of %d bytes (between %d and %d)',
+                      self.__size,
+                      self.__min_size,
+                      self.__max_size)
+
+    @property
+    def chunk_size(self):
+        with self.__lock:
+            size = self.__size
+        limit = self.__size_limit() if self.__size_limit is not None else None
+        return size if limit is None else self._clamp(min(size, limit))
+
+    def record(self, size, elapsed):
+        """Records that a request sending ``size`` bytes took ``elapsed`` seconds."""
+        throughput = size / max(elapsed, 1e-6)
+        with self.__lock:
+            if elapsed > self.__target_latency:
+                next_size = self.__size // 2
+            elif self.__last_throughput is None or \
+                    throughput >= self.__last_throughput * AdaptiveChunkSizer.THROUGHPUT_TOLERANCE:
+                next_size = self.__size * 2
+            else:
+                next_size = self.__size // 2
+            self.__last_throughput = throughput
+            self.__size = self._clamp(next_size)
+            logging.debug('Sent %d bytes in %.2f seconds (%.1f MB/s): next chunks of %d bytes',
+                          size,
+                          elapsed,
+                          throughput / (1024 * 1024),
+                          self.__size)
+
+    def _clamp(self, size):
+        size -= size % self.__alignment
+        return min(self.__max_size, max(self.__min_size, size))
 
-from dropbox.exceptions import ApiError
-from dropbox.files import (CommitInfo, UploadSessionCursor, WriteMode)
 
 class DropboxClient:
 
     SINGLE_REQ_UPLOAD_SIZE_LIMIT = 150 * 1024 * 1024 # 150MB
+    UPLOAD_ALIGNMENT = 4 * 1024 * 1024 # 4MB
+    INITIAL_CHUNK_SIZE = 4 * UPLOAD_ALIGNMENT # 16MB
+    MAX_CHUNK_SIZE = 37 * UPLOAD_ALIGNMENT # 148MB
+    CONCURRENT_CHUNK_SIZE = 16 * UPLOAD_ALIGNMENT # 64MB
+    MAX_CHUNK_RETRIES = 3
+    MAX_THROTTLED_RETRIES = 10
+    THROTTLED_BACKOFF = 5 # seconds, when Dropbox doesn't say when to retry
+    CHECKSUM_BLOCK_SIZE = 4 * 1024 * 1024 # 4MB
+    DOWNLOAD_CHUNK_SIZE = 16 * 1024 * 1024 # 16MB
+    DELETE_BATCH_SIZE = 1000
+    DELETE_BATCH_POLL_INTERVAL = 1
+    MAX_DELETE_BATCH_POLL_INTERVAL = 10
+
+    TRANSIENT_ERRORS = (ConnectionError, ChunkedEncodingError, Timeout, InternalServerError)
 
-    def __init__(self, dbx_api_client):
+    def __init__(self, dbx_api_client, upload_concurrency=1, max_upload_memory=None,
+                 metrics=None, verify_uploads=False, bandwidth_limiter=None):
         self.__dropbox_client = dbx_api_client
+        self.__upload_concurrency = upload_concurrency
+        self.__max_upload_memory = max_upload_memory
+        self.__metrics = metrics if metrics is not None else RunMetrics()
+        self.__verify_uploads = verify_uploads
+        self.__bandwidth_limiter = bandwidth_limiter
+        self.__concurrency = AdaptiveConcurrency()
 
-    def upload_file(self, file_to_upload, path):
-        file_size = self._get_file_size(file_to_upload)
-        file_to_upload.seek(0)
+    def upload_file(self, file_to_upload, path, overwrite=False, session_state=None):
+        """Uploads ``file_to_upload`` to ``path``.
+
+        Big files are uploaded through sessions whose chunk size adapts to
+        the measured throughput, keeping at most ``max_upload_memory`` bytes
+        of the file in memory. If an ``UploadSessionState`` is given, they
+        are uploaded through a sequential session whose progress is saved in
+        it after every append, and an interrupted upload of the same file to
+        the same path is resumed from the last acknowledged offset.
+
+        Every request waits for the ``bandwidth_limiter`` and for the
+        concurrency allowed while Dropbox throttles requests (see
+        ``_upload_request``).
 
-        if file_size <= DropboxClient.SINGLE_REQ_UPLOAD_SIZE_LIMIT:
-            logging.debug('Using single request to upload file')
-            self.__dropbox_client.files_upload(file_to_upload.read(), path)
+        With ``verify_uploads``, the content hash of the data is computed
+        while it's sent and compared with the one of the uploaded file. A
+        corrupted upload is deleted and raises.
+
+        The time spent (including waiting for the data to upload) and the
+        bytes sent are recorded as the ``upload`` stage of ``metrics``,
+        together with the latency of every chunk and the retries.
+        """
+        with self.__metrics.stage('upload'):
+            if not self.__verify_uploads:
+                self._upload_file(file_to_upload, path, overwrite, session_state)
+                return
+            reader = HashingReader(file_to_upload, ContentHasher())
+            metadata = self._upload_file(reader, path, overwrite, session_state)
+            self._verify_upload(path, reader, metadata)
+
+    def _verify_upload(self, path, reader, metadata):
+        hasher = reader.hasher
+        if reader.hashed != metadata.size:
+            # Parts were skipped when resuming or realigning the upload.
+            if not reader.seekable():
+                logging.warning('Can not verify the upload of %s: part of it was not read', path)
+                return
+            hasher = ContentHasher()
+            reader.seek(0)
+            for block in iter(lambda: reader.read(ContentHasher.BLOCK_SIZE), b''):
+                hasher.update(block)
+        if metadata.content_hash != hasher.hexdigest():
+            self.__metrics.increment('upload_verification_failures')
+            logging.error('Content hash of %s is %s instead of %s: deleting it',
+                          path,
+                          metadata.content_hash,
+                          hasher.hexdigest())
+            try:
+                self.delete_file(path)
+            except Exception as e:
+                logging.error('Failed to delete corrupted upload %s: %s', path, e)
+            raise Exception('Upload of {} is corrupted'.format(path))
+        logging.debug('Verified upload of %s: content hash %s', path, metadata.content_hash)
+
+    def copy_file(self, from_path, to_path, content_hash=None):
+        """Copies ``from_path`` to ``to_path`` in Dropbox, without transferring its content.
+
+        If ``content_hash`` is given, the copy must have it or it's deleted
+        and raises.
+        """
+        result = self._retry('upload_retries',
+                             self.__dropbox_client.files_copy_v2,
+                             from_path,
+                             to_path)
+        if content_hash is not None and result.metadata.content_hash != content_hash:
+            self.delete_file(to_path)
+            raise Exception('Copy of {} to {} has content hash {} instead of {}'.format(
+                from_path, to_path, result.metadata.content_hash, content_hash))
+
+    def _upload_file(self, file_to_upload, path, overwrite, session_state):
+        """Uploads the file and returns the metadata of the uploaded file."""
+        chunk_sizer = self._chunk_sizer()
+        head = b''
+        if file_to_upload.seekable():
+            file_size = self._get_file_size(file_to_upload)
+            file_to_upload.seek(0)
+            if file_size <= self._single_request_limit():
+                logging.debug('Using single request to upload file')
+                return self._upload_in_single_request(file_to_upload.read(), path, overwrite)
+            if session_state is not None:
+                logging.debug('Using resumable upload session for this file')
+                return self._upload_with_resumable_session(file_to_upload,
+                                                           path,
+                                                           session_state,
+                                                           chunk_sizer,
+                                                           overwrite)
         else:
-            logging.debug('Using multi-request upload session for this file')
-            session = None
-            offset = 0
-            chunk = file_to_upload.read(DropboxClient.SINGLE_REQ_UPLOAD_SIZE_LIMIT)
-            while len(chunk) == DropboxClient.SINGLE_REQ_UPLOAD_SIZE_LIMIT:
-                if session is None:
-                    logging.debug('Initializing upload session')
-                    session = self.__dropbox_client.files_upload_session_start(chunk)
+            # The size of a stream is unknown until it is exhausted: the first
+            # chunk tells whether a single request is enough.
+            head = file_to_upload.read(chunk_sizer.chunk_size)
+            if len(head) < chunk_sizer.chunk_size:
+                logging.debug('Using single request to upload stream')
+                return self._upload_in_single_request(head, path, overwrite)
+
+        if self.__upload_concurrency > 1:
+            logging.debug('Using concurrent upload session with %d workers',
+                          self.__upload_concurrency)
+            return self._upload_with_concurrent_session(file_to_upload,
+                                                        path,
+                                                        chunk_sizer,
+                                                        head,
+                                                        overwrite)
+        logging.debug('Using multi-request upload session for this file')
+        return self._upload_with_session(file_to_upload, path, chunk_sizer, head or None, overwrite)
+
+    def _upload_in_single_request(self, data, path, overwrite=False):
+        upload_kwargs = {'mode': WriteMode('overwrite')} if overwrite else {}
+        metadata = self._retry_throttled(self._upload_request,
+                                         self.__dropbox_client.files_upload,
+                                         data,
+                                         path,
+                                         **upload_kwargs)
+        self.__metrics.add_bytes('upload', bytes_out=len(data))
+        return metadata
+
+    def _single_request_limit(self):
+        """Returns the size of the biggest file uploaded with a single request.
+
+        Session chunks are never smaller than ``UPLOAD_ALIGNMENT``, so a file
+        up to that size is always sent in one request, even when the memory
+        cap or the burst of the bandwidth limit is smaller.
+        """
+        limit = DropboxClient.SINGLE_REQ_UPLOAD_SIZE_LIMIT
+        if self.__max_upload_memory is not None:
+            limit = min(limit, self.__max_upload_memory)
+        if self.__bandwidth_limiter is not None:
+            burst_size = self.__bandwidth_limiter.burst_size()
+            if burst_size is not None:
+                limit = min(limit, burst_size)
+        return max(DropboxClient.UPLOAD_ALIGNMENT, limit)
+
+    def _chunk_sizer(self):
+        """Returns the chunk sizer for an upload, bounded by ``max_upload_memory``.
+
+        The chunks held in memory at the same time (see ``min_upload_memory``)
+        fit in it.
+        """
+        if self.__upload_concurrency > 1:
+            max_size = DropboxClient.CONCURRENT_CHUNK_SIZE
+        else:
+            max_size = DropboxClient.MAX_CHUNK_SIZE
+        if self.__max_upload_memory is not None:
+            chunks_in_memory = DropboxClient._chunks_in_memory(self.__upload_concurrency)
+            max_size = min(max_size, self.__max_upload_memory // chunks_in_memory)
+        size_limit = None
+        if self.__bandwidth_limiter is not None:
+            # Chunks sent at once faster than the limit are kept short.
+            size_limit = self.__bandwidth_limiter.burst_size
+        return AdaptiveChunkSizer(DropboxClient.UPLOAD_ALIGNMENT,
+                                  max_size,
+                                  DropboxClient.INITIAL_CHUNK_SIZE,
+                                  DropboxClient.UPLOAD_ALIGNMENT,
+                                  size_limit=size_limit)
+
+    @staticmethod
+    def min_upload_memory(upload_concurrency=1):
+        """Returns the smallest ``max_upload_memory`` holding the chunks of an upload.
+
+        Sequential sessions hold a single chunk in memory. Concurrent ones
+        hold one per worker, plus the one being read and the look-ahead one.
+        Chunks are never smaller than ``UPLOAD_ALIGNMENT``.
+        """
+        return DropboxClient.UPLOAD_ALIGNMENT * DropboxClient._chunks_in_memory(upload_concurrency)
+
+    @staticmethod
+    def _chunks_in_memory(upload_concurrency):
+        return upload_concurrency + 2 if upload_concurrency > 1 else 1
+
+    def _upload_with_resumable_session(self, file_to_upload, path, session_state, chunk_sizer,
+                                       overwrite=False):
+        checksum = DropboxClient._file_checksum(file_to_upload)
+
+        def save_progress(session_id, offset):
+            session_state.save(path, checksum, session_id, offset)
+
+        saved = session_state.load()
+        if saved is not None and saved.get('session_id') is not None and \
+                saved.get('path') == path and saved.get('checksum') == checksum:
+            logging.info('Resuming upload session %s at offset %d',
+                         saved['session_id'],
+                         saved['offset'])
+            file_to_upload.seek(saved['offset'])
+            try:
+                metadata = self._upload_with_session(file_to_upload,
+                                                     path,
+                                                     chunk_sizer,
+                                                     overwrite=overwrite,
+                                                     session_id=saved['session_id'],
+                                                     offset=saved['offset'],
+                                                     on_progress=save_progress)
+                session_state.clear()
+                return metadata
+            except ApiError as e:
+                if not DropboxClient._is_lost_session(e):
+                    raise
+                logging.warning('Upload session %s is no longer valid: starting over',
+                                saved['session_id'])
+                self.__metrics.increment('upload_restarts')
+        elif saved is not None:
+            logging.info('Saved upload session does not match the file: starting over')
+
+        save_progress(None, 0)
+        file_to_upload.seek(0)
+        metadata = self._upload_with_session(file_to_upload,
+                                             path,
+                                             chunk_sizer,
+                                             overwrite=overwrite,
+                                             on_progress=save_progress)
+        session_state.clear()
+        return metadata
+
+    def _upload_with_session(self, file_to_upload, path, chunk_sizer, chunk=None, overwrite=False,
+                             session_id=None, offset=0, on_progress=None):
+        """Uploads the file through a sequential session and returns the metadata of the file.
+
+        ``chunk`` is the first chunk if it has already been read. A chunk
+        shorter than requested is the last one and finishes the session, or
+        is uploaded with a single request when no session was started.
+        """
+        while True:
+            if chunk is None:
+                chunk_size = chunk_sizer.chunk_size
+                chunk = file_to_upload.read(chunk_size)
+                if len(chunk) < chunk_size:
+                    break
+            start_time = time.perf_counter()
+            if session_id is None:
+                logging.debug('Initializing upload session with %d bytes', len(chunk))
+                session = self._call_with_retries(self._upload_request,
+                                                  self.__dropbox_client.files_upload_session_start,
+                                                  chunk)
+                session_id = session.session_id
+                offset += len(chunk)
+                self.__metrics.add_bytes('upload', bytes_out=len(chunk))
+            else:
+                logging.debug('Appending %d bytes to session %s at offset %d',
+                              len(chunk),
+                              session_id,
+                              offset)
+                offset, _ = self._send_chunk(file_to_upload,
+                                             self.__dropbox_client.files_upload_session_append_v2,
+                                             session_id,
+                                             offset,
+                                             chunk)
+            self._record_chunk(chunk_sizer, len(chunk), time.perf_counter() - start_time)
+            if on_progress is not None:
+                on_progress(session_id, offset)
+            chunk = None
+
+        if session_id is None:
+            logging.debug('Using single request to upload the only chunk')
+            return self._upload_in_single_request(chunk, path, overwrite)
+        logging.debug('Finishing session %s', session_id)
+        commit_info = DropboxClient._commit_info(path, overwrite)
+        _, metadata = self._send_chunk(file_to_upload,
+                                       self.__dropbox_client.files_upload_session_finish,
+                                       session_id,
+                                       offset,
+                                       chunk,
+                                       commit_info)
+        return metadata
+
+    def _send_chunk(self, file_to_upload, api_call, session_id, offset, chunk, *args):
+        """Sends ``chunk`` at ``offset`` of a session.
+
+        Returns the offset right after it and the result of the call.
+
+        Transient and throttled errors are retried with backoff. When Dropbox
+        reports that the session is at a different offset (e.g. a previous
+        attempt was received but its response got lost) the upload is
+        realigned to it, seeking ``file_to_upload`` if the offset is outside
+        of ``chunk``.
+        """
+        attempt = 0
+        while True:
+            try:
+                result = self._retry_throttled(self._upload_request,
+                                               api_call,
+                                               chunk,
+                                               UploadSessionCursor(session_id, offset),
+                                               *args)
+                self.__metrics.add_bytes('upload', bytes_out=len(chunk))
+                return offset + len(chunk), result
+            except DropboxClient.TRANSIENT_ERRORS as e:
+                attempt += 1
+                if attempt > DropboxClient.MAX_CHUNK_RETRIES:
+                    raise
+                self.__metrics.increment('upload_retries')
+                DropboxClient._wait_before_retry(attempt, e)
+            except ApiError as e:
+                correct_offset = DropboxClient._correct_offset(e)
+                attempt += 1
+                if correct_offset is None or attempt > DropboxClient.MAX_CHUNK_RETRIES:
+                    raise
+                logging.warning('Session %s is at offset %d instead of %d: realigning',
+                                session_id,
+                                correct_offset,
+                                offset)
+                self.__metrics.increment('upload_realignments')
+                end = offset + len(chunk)
+                if offset < correct_offset <= end:
+                    chunk = chunk[correct_offset - offset:]
+                elif file_to_upload.seekable():
+                    file_to_upload.seek(correct_offset)
+                    chunk = file_to_upload.read(max(0, end - correct_offset))
                 else:
-                    logging.debug('Appending to session %s at offset %d',
-                                  session.session_id,
-                                  offset)
-                    self.__dropbox_client.files_upload_session_append_v2(
-                        chunk,
-                        UploadSessionCursor(session.session_id, offset)
-                    )
+                    raise
+                offset = correct_offset
+
+    def _upload_with_concurrent_session(self, file_to_upload, path, chunk_sizer, head=b'',
+                                        overwrite=False):
+        """Uploads the file appending chunks in parallel to a concurrent session.
+
+        Every chunk but the last one is a multiple of ``UPLOAD_ALIGNMENT`` as
+        required by Dropbox, and the last one closes the session. At most
+        ``upload_concurrency`` chunks are held in memory waiting for their
+        append to be acknowledged.
+        """
+        session = self._call_with_retries(self._upload_request,
+                                          self.__dropbox_client.files_upload_session_start,
+                                          b'',
+                                          session_type=UploadSessionType.concurrent)
+        logging.debug('Initialized concurrent upload session %s', session.session_id)
+        slots = threading.BoundedSemaphore(self.__upload_concurrency)
+        futures = []
+
+        def append(chunk, offset, close):
+            try:
+                logging.debug('Appending %d bytes to session %s at offset %d',
+                              len(chunk),
+                              session.session_id,
+                              offset)
+                start_time = time.perf_counter()
+                self._call_with_retries(
+                    self._upload_request,
+                    self.__dropbox_client.files_upload_session_append_v2,
+                    chunk,
+                    UploadSessionCursor(session.session_id, offset),
+                    close=close
+                )
+                self.__metrics.add_bytes('upload', bytes_out=len(chunk))
+                self._record_chunk(chunk_sizer, len(chunk), time.perf_counter() - start_time)
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=self.__upload_concurrency) as executor:
+            try:
+                offset = 0
+                chunks = DropboxClient._read_chunks(file_to_upload, chunk_sizer, head)
+                # One chunk of look-ahead tells which append has to close the session.
+                chunk = next(chunks)
+                for next_chunk in chunks:
+                    slots.acquire()
+                    futures = pending_futures(futures)
+                    futures.append(executor.submit(append, chunk, offset, False))
+                    offset += len(chunk)
+                    chunk = next_chunk
+                slots.acquire()
+                futures.append(executor.submit(append, chunk, offset, True))
                 offset += len(chunk)
-                chunk = file_to_upload.read(DropboxClient.SINGLE_REQ_UPLOAD_SIZE_LIMIT)
-
-            logging.debug('Finishing session %s', session.session_id)
-            commit_info = CommitInfo(path=path,
-                                     mode=WriteMode('add'),
-                                     autorename=False)
-            self.__dropbox_client.files_upload_session_finish(
-                chunk,
-                UploadSessionCursor(session.session_id, offset),
-                commit_info
-            )
+                for future in futures:
+                    future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+        logging.debug('Finishing session %s', session.session_id)
+        commit_info = DropboxClient._commit_info(path, overwrite)
+        return self._call_with_retries(self._upload_request,
+                                       self.__dropbox_client.files_upload_session_finish,
+                                       b'',
+                                       UploadSessionCursor(session.session_id, offset),
+                                       commit_info)
+
+    def _record_chunk(self, chunk_sizer, size, elapsed):
+        chunk_sizer.record(size, elapsed)
+        self.__metrics.observe('upload_chunk_seconds', elapsed)
+
+    @staticmethod
+    def _commit_info(path, overwrite):
+        return CommitInfo(path=path,
+                          mode=WriteMode('overwrite' if overwrite else 'add'),
+                          autorename=False)
+
+    def _call_with_retries(self, api_call, *args, **kwargs):
+        return self._retry('upload_retries', api_call, *args, **kwargs)
+
+    def _retry(self, counter, api_call, *args, **kwargs):
+        """Calls ``api_call`` retrying transient errors, counting the retries in ``counter``.
+
+        Throttled calls are retried too, see ``_retry_throttled``.
+        """
+        attempt = 0
+        while True:
+            try:
+                return self._retry_throttled(api_call, *args, **kwargs)
+            except DropboxClient.TRANSIENT_ERRORS as e:
+                attempt += 1
+                if attempt > DropboxClient.MAX_CHUNK_RETRIES:
+                    raise
+                self.__metrics.increment(counter)
+                DropboxClient._wait_before_retry(attempt, e)
+
+    def _retry_throttled(self, api_call, *args, **kwargs):
+        """Calls ``api_call`` retrying it while Dropbox throttles it (HTTP 429).
+
+        Every retry waits for the time given by Dropbox in ``Retry-After``
+        (``THROTTLED_BACKOFF`` seconds if it didn't give any) plus up to half
+        of it of random jitter, so throttled clients don't retry all at once.
+        Upload requests of the client are paused meanwhile and their
+        concurrency is reduced.
+        """
+        attempt = 0
+        while True:
+            try:
+                return api_call(*args, **kwargs)
+            except RateLimitError as e:
+                attempt += 1
+                if attempt > DropboxClient.MAX_THROTTLED_RETRIES:
+                    raise
+                retry_after = e.backoff if e.backoff is not None else \
+                    DropboxClient.THROTTLED_BACKOFF
+                retry_after *= 1 + random.random() / 2
+                self.__metrics.increment('throttled_requests')
+                self.__concurrency.throttled(retry_after)
+                time.sleep(retry_after)
+
+    def _upload_request(self, api_call, data, *args, **kwargs):
+        """Sends the upload request ``api_call`` of ``data`` once the limits allow it.
+
+        The upload requests of all the uploads of the client are only
+        limited after Dropbox throttled some, and ``data`` is accounted for
+        in the ``bandwidth_limiter``. The time waiting for the bandwidth
+        is recorded as the ``bandwidth_wait`` stage.
+        """
+        with self.__concurrency.request():
+            if self.__bandwidth_limiter is not None:
+                waited = self.__bandwidth_limiter.acquire(len(data))
+                self.__metrics.add_time('bandwidth_wait', waited, calls=1)
+            result = api_call(data, *args, **kwargs)
+        self.__concurrency.succeeded()
+        return result
+
+    @staticmethod
+    def _wait_before_retry(attempt, error):
+        backoff = 2 ** attempt * random.random()
+        logging.warning('Request failed (%s): retrying in %.1f seconds', error, backoff)
+        time.sleep(backoff)
+
+    @staticmethod
+    def _session_lookup_error(api_error):
+        error = api_error.error
+        if isinstance(error, UploadSessionFinishError):
+            return error.get_lookup_failed() if error.is_lookup_failed() else None
+        if isinstance(error, UploadSessionLookupError):
+            return error
+        return None
+
+    @staticmethod
+    def _correct_offset(api_error):
+        """Returns the offset reported by Dropbox when the one sent was incorrect."""
+        lookup_error = DropboxClient._session_lookup_error(api_error)
+        if lookup_error is None or not lookup_error.is_incorrect_offset():
+            return None
+        return lookup_error.get_incorrect_offset().correct_offset
+
+    @staticmethod
+    def _is_lost_session(api_error):
+        lookup_error = DropboxClient._session_lookup_error(api_error)
+        return lookup_error is not None and lookup_error.is_not_found()
+
+    @staticmethod
+    def _file_checksum(file_handle):
+        digest = hashlib.sha256()
+        file_handle.seek(0)
+        for block in iter(lambda: file_handle.read(DropboxClient.CHECKSUM_BLOCK_SIZE), b''):
+            digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _read_chunks(file_to_upload, chunk_sizer, head=b''):
+        """Yields the chunks of the file, starting with ``head`` if it has already been read.
+
+        Every chunk is read straight into the ``bytes`` object sent to
+        Dropbox, so no intermediate copies are made.
+        """
+        if head:
+            yield head
+        while True:
+            chunk_size = chunk_sizer.chunk_size
+            chunk = file_to_upload.read(chunk_size)
+            if chunk:
+                yield chunk
+            if len(chunk) < chunk_size:
+                return
+
+    def download_file(self, path):
+        """Returns the content of ``path``, retrying the download on transient errors."""
+        return self._retry('download_retries',
+                           DropboxClient._read_download,
+                           self.__dropbox_client,
+                           path)
+
+    def open_download(self, path, workers=1, offset=0, end=None):
+        """Returns a stream with the content of ``path``, from ``offset`` to ``end`` (excluded).
+
+        The file is downloaded with HTTP range requests of
+        ``DOWNLOAD_CHUNK_SIZE`` bytes, ``workers`` of them in parallel, which
+        are reassembled in order as the stream is read. Each request is retried up to
+        ``MAX_CHUNK_RETRIES`` times on transient errors. Nothing is requested
+        past ``end``, or past the end of the file if it's ``None``.
+        """
+        metadata = self._retry('download_retries', self.__dropbox_client.files_get_metadata, path)
+        end = metadata.size if end is None else min(end, metadata.size)
+        logging.debug('Downloading bytes %d to %d of %s with %d workers', offset, end, path, workers)
+        chunk_size = DropboxClient.DOWNLOAD_CHUNK_SIZE
+        fetches = (functools.partial(self._download_range,
+                                     path,
+                                     offset,
+                                     min(chunk_size, end - offset))
+                   for offset in range(offset, end, chunk_size))
+        return io.BufferedReader(PrefetchReader(fetches, workers))
+
+    def _download_range(self, path, offset, length):
+        ranged_client = self.__dropbox_client.clone(
+            headers={'Range': 'bytes={}-{}'.format(offset, offset + length - 1)})
+
+        def download():
+            data = DropboxClient._read_download(ranged_client, path)
+            if len(data) != length:
+                raise Exception('Expected {} bytes at offset {} of {}, got {}'.format(length,
+                                                                                     offset,
+                                                                                     path,
+                                                                                     len(data)))
+            return data
+
+        start_time = time.perf_counter()
+        with self.__metrics.stage('download'):
+            data = self._retry('download_retries', download)
+            self.__metrics.add_bytes('download', bytes_in=len(data))
+        self.__metrics.observe('download_chunk_seconds', time.perf_counter() - start_time)
+        return data
+
+    @staticmethod
+    def _read_download(dropbox_client, path):
+        # The content is read within the retries: the connection may drop while it's read.
+        _, response = dropbox_client.files_download(path)
+        try:
+            return response.content
+        finally:
+            response.close()
 
     def delete_file(self, path):
-        self.__dropbox_client.files_delete_v2(path)
+        self._retry_throttled(self.__dropbox_client.files_delete_v2, path)
+
+    def delete_files(self, paths):
+        """Deletes ``paths`` using batch requests of up to ``DELETE_BATCH_SIZE`` files.
+
+        Paths which don't exist are ignored. An exception is raised if any
+        other file could not be deleted.
+        """
+        paths = list(paths)
+        failures = []
+        for start in range(0, len(paths), DropboxClient.DELETE_BATCH_SIZE):
+            batch = paths[start:start + DropboxClient.DELETE_BATCH_SIZE]
+            logging.debug('Deleting batch of %d files', len(batch))
+            launch = self._retry_throttled(self.__dropbox_client.files_delete_batch,
+                                           [DeleteArg(path) for path in batch])
+            if launch.is_complete():
+                result = launch.get_complete()
+            else:
+                result = self._wait_for_delete_batch(launch.get_async_job_id())
+            for path, entry in zip(batch, result.entries):
+                if entry.is_failure() and not DropboxClient._is_not_found(entry.get_failure()):
+                    failures.append('{}: {}'.format(path, entry.get_failure()))
+        self.__metrics.increment('deleted_files', len(paths) - len(failures))
+        if failures:
+            raise Exception('Failed to delete {} files: {}'.format(len(failures),
+                                                                   '; '.join(failures)))
+
+    def _wait_for_delete_batch(self, job_id):
+        poll_interval = DropboxClient.DELETE_BATCH_POLL_INTERVAL
+        while True:
+            time.sleep(poll_interval)
+            status = self._retry_throttled(self.__dropbox_client.files_delete_batch_check, job_id)
+            if status.is_complete():
+                return status.get_complete()
+            if status.is_failed():
+                raise Exception('Batch delete failed: {}'.format(status.get_failed()))
+            poll_interval = min(2 * poll_interval, DropboxClient.MAX_DELETE_BATCH_POLL_INTERVAL)
+
+    @staticmethod
+    def _is_not_found(delete_error):
+        return delete_error.is_path_lookup() and delete_error.get_path_lookup().is_not_found()
 
     def list_files(self, folder_path):
+        return [entry.name for entry in self._list_folder(folder_path)]
+
+    def list_content_hashes(self, folder_path):
+        """Returns the names of the files in ``folder_path`` mapped to their content hash."""
+        return {entry.name: entry.content_hash
+                for entry in self._list_folder(folder_path)
+                if isinstance(entry, FileMetadata)}
+
+    def _list_folder(self, folder_path):
         try:
-            return [entry.name for \
-                    entry in self.__dropbox_client.files_list_folder(folder_path).entries]
+            result = self._retry_throttled(self.__dropbox_client.files_list_folder, folder_path)
         except ApiError as e:
             folder_list_error = e.error
             if not folder_list_error.is_path():
@@ -63,6 +794,12 @@ class DropboxClient:
             if lookup_error.is_not_found():
                 return []
             raise
+        entries = list(result.entries)
+        while result.has_more:
+            result = self._retry_throttled(self.__dropbox_client.files_list_folder_continue,
+                                           result.cursor)
+            entries.extend(result.entries)
+        return entries
 
     def _get_file_size(self, file_handle):
         current_tell = file_handle.tell()
@@ -0,0 +1,360 @@
+import bz2
+import collections
+import gzip
+import io
+import logging
+import lzma
+import os
+import os.path
+import struct
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """Gzip writer compressing blocks of the input in parallel, like pigz does.
+
+    The input is split in blocks which are compressed independently by a
+    pool of threads (zlib releases the GIL while compressing). Each block is
+    primed with the last 32KB of the previous one as dictionary and all but
+    the last one are ended with a sync flush, so concatenating them yields a
+    single deflate stream: the output is a regular single-member gzip file.
+    """
+
+    BLOCK_SIZE = 1024 * 1024 # 1MB
+    DICTIONARY_SIZE = 32 * 1024 # 32KB
+
+    def __init__(self, fileobj, level=9, threads=None, block_size=BLOCK_SIZE, mtime=None):
+        self.__fileobj = fileobj
+        self.__level = level
+        self.__threads = threads or os.cpu_count() or 1
+        self.__block_size = block_size
+        self.__executor = ThreadPoolExecutor(max_workers=self.__threads)
+        self.__pending = collections.deque()
+        self.__buffer = bytearray()
+        self.__dictionary = b''
+        self.__crc = 0
+        self.__size = 0
+        self.__write_header(int(time.time()) if mtime is None else mtime)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed file')
+        self.__crc = zlib.crc32(data, self.__crc)
+        self.__size += len(data)
+        self.__buffer += data
+        while len(self.__buffer) >= self.__block_size:
+            self.__submit(bytes(self.__buffer[:self.__block_size]), last=False)
+            del self.__buffer[:self.__block_size]
+        return len(data)
+
+    def tell(self):
+        return self.__size
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.__submit(bytes(self.__buffer), last=True)
+            self.__buffer.clear()
+            while self.__pending:
+                self.__fileobj.write(self.__pending.popleft().result())
+            self.__fileobj.write(struct.pack('<II', self.__crc, self.__size & 0xffffffff))
+        finally:
+            self.__executor.shutdown(wait=True)
+            super().close()
+
+    def __write_header(self, mtime):
+        xfl = b'\002' if self.__level == 9 else (b'\004' if self.__level == 1 else b'\000')
+        self.__fileobj.write(b'\037\213\010\000' + struct.pack('<I', mtime) + xfl + b'\377')
+
+    def __submit(self, block, last):
+        self.__pending.append(self.__executor.submit(ParallelGzipWriter._compress_block,
+                                                     block,
+                                                     self.__dictionary,
+                                                     self.__level,
+                                                     last))
+        self.__dictionary = block[-ParallelGzipWriter.DICTIONARY_SIZE:]
+        # Bound the memory used by blocks waiting to be compressed or written.
+        while len(self.__pending) > 2 * self.__threads:
+            self.__fileobj.write(self.__pending.popleft().result())
+
+    @staticmethod
+    def _compress_block(block, dictionary, level, last):
+        if dictionary:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(block) + \
+            compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class SeekableGzipWriter(io.RawIOBase):
+    """Gzip writer starting a new gzip member every ``block_size`` bytes of input.
+
+    Every block can be decompressed on its own, starting at its offset in
+    the output, and the whole output is still a regular (multi-member) gzip
+    file. ``blocks`` lists the ``(input offset, output offset)`` of each
+    block written so far. Blocks are compressed in parallel like in
+    ``ParallelGzipWriter``.
+    """
+
+    BLOCK_SIZE = 1024 * 1024 # 1MB
+
+    def __init__(self, fileobj, level=9, threads=1, block_size=None, mtime=None):
+        self.__fileobj = fileobj
+        self.__level = level
+        self.__threads = threads or os.cpu_count() or 1
+        self.__block_size = block_size or SeekableGzipWriter.BLOCK_SIZE
+        self.__mtime = int(time.time()) if mtime is None else mtime
+        self.__executor = ThreadPoolExecutor(max_workers=self.__threads)
+        self.__pending = collections.deque()
+        self.__buffer = bytearray()
+        self.__size = 0
+        self.__output_size = 0
+        self.blocks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed file')
+        self.__size += len(data)
+        self.__buffer += data
+        while len(self.__buffer) >= self.__block_size:
+            self.__submit(bytes(self.__buffer[:self.__block_size]))
+            del self.__buffer[:self.__block_size]
+        return len(data)
+
+    def tell(self):
+        return self.__size
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.__buffer or not self.__size:
+                self.__submit(bytes(self.__buffer))
+                self.__buffer.clear()
+            while self.__pending:
+                self.__write_block()
+        finally:
+            self.__executor.shutdown(wait=True)
+            super().close()
+
+    def __submit(self, block):
+        self.__pending.append((self.__size - len(self.__buffer),
+                               self.__executor.submit(SeekableGzipWriter._compress_member,
+                                                      block,
+                                                      self.__level,
+                                                      self.__mtime)))
+        # Bound the memory used by blocks waiting to be compressed or written.
+        while len(self.__pending) > 2 * self.__threads:
+            self.__write_block()
+
+    def __write_block(self):
+        input_offset, future = self.__pending.popleft()
+        member = future.result()
+        self.blocks.append((input_offset, self.__output_size))
+        self.__fileobj.write(member)
+        self.__output_size += len(member)
+
+    @staticmethod
+    def _compress_member(block, level, mtime):
+        xfl = b'\002' if level == 9 else (b'\004' if level == 1 else b'\000')
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return b'\037\213\010\000' + struct.pack('<I', mtime) + xfl + b'\377' + \
+            compressor.compress(block) + compressor.flush() + \
+            struct.pack('<II', zlib.crc32(block), len(block) & 0xffffffff)
+
+
+class UncompressedWriter(io.RawIOBase):
+    """Writes data as is into ``fileobj``, leaving it open when closed."""
+
+    # The output can be read from any offset: it has no compression blocks.
+    blocks = None
+
+    def __init__(self, fileobj):
+        self.__fileobj = fileobj
+        self.__size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed file')
+        self.__fileobj.write(data)
+        self.__size += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.__size
+
+
+class Codec:
+    """Compression format used for the backup archives.
+
+    ``open_writer`` returns a writable file object compressing everything
+    into ``fileobj``. Closing it finishes the compressed stream but leaves
+    ``fileobj`` open.
+    """
+
+    name = None
+    extension = None
+    levels = range(0)
+    default_level = None
+    seekable = False
+
+    def open_writer(self, fileobj, level=None, threads=1):
+        raise NotImplementedError()
+
+    def open_seekable_writer(self, fileobj, level=None, threads=1):
+        """Like ``open_writer``, but the writer lists the ``blocks`` of its output.
+
+        A block is a point of the output from which it can be decompressed,
+        given as ``(input offset, output offset)``. ``blocks`` is ``None``
+        when any point can be read from, i.e. there's no compression.
+        """
+        raise NotImplementedError()
+
+
+class NoCompressionCodec(Codec):
+
+    name = 'none'
+    extension = '.tar'
+    seekable = True
+
+    def open_writer(self, fileobj, level=None, threads=1):
+        return UncompressedWriter(fileobj)
+
+    def open_seekable_writer(self, fileobj, level=None, threads=1):
+        return UncompressedWriter(fileobj)
+
+
+class GzipCodec(Codec):
+
+    name = 'gz'
+    extension = '.tar.gz'
+    levels = range(0, 10)
+    default_level = 9
+    seekable = True
+    # A fixed mtime in the header, so the same tar stream always gives the same file.
+    MTIME = 0
+
+    def open_writer(self, fileobj, level=None, threads=1):
+        level = self.default_level if level is None else level
+        if threads > 1:
+            return ParallelGzipWriter(fileobj, level=level, threads=threads,
+                                      mtime=GzipCodec.MTIME)
+        return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=level,
+                             mtime=GzipCodec.MTIME)
+
+    def open_seekable_writer(self, fileobj, level=None, threads=1):
+        level = self.default_level if level is None else level
+        return SeekableGzipWriter(fileobj, level=level, threads=threads, mtime=GzipCodec.MTIME)
+
+
+class Bzip2Codec(Codec):
+
+    name = 'bz2'
+    extension = '.tar.bz2'
+    levels = range(1, 10)
+    default_level = 9
+
+    def open_writer(self, fileobj, level=None, threads=1):
+        level = self.default_level if level is None else level
+        return bz2.BZ2File(fileobj, mode='wb', compresslevel=level)
+
+
+class XzCodec(Codec):
+
+    name = 'xz'
+    extension = '.tar.xz'
+    levels = range(0, 10)
+    default_level = 6
+
+    def open_writer(self, fileobj, level=None, threads=1):
+        level = self.default_level if level is None else level
+        return lzma.LZMAFile(fileobj, mode='wb', preset=level)
+
+
+CODECS = {codec.name: codec for codec in (NoCompressionCodec(),
+                                          GzipCodec(),
+                                          Bzip2Codec(),
+                                          XzCodec())}
+
+
+def get_codec(name):
+    return CODECS[name]
+
+
+class CompressionBenchmark:
+    """Measures speed and ratio of every codec over a sample of the data to back up."""
+
+    DEFAULT_SAMPLE_SIZE = 64 * 1024 * 1024 # 64MB
+    MAX_BYTES_PER_FILE = 1024 * 1024 # 1MB
+    LEVELS = {
+        'none': [None],
+        'gz': [1, 6, 9],
+        'bz2': [1, 9],
+        'xz': [0, 6, 9],
+    }
+
+    def __init__(self, sample_size=DEFAULT_SAMPLE_SIZE, threads=1):
+        self.__sample_size = sample_size
+        self.__threads = threads
+
+    def run(self, paths):
+        """Returns a list of ``(codec, level, mb_per_second, ratio)`` tuples."""
+        sample = self.sample(paths)
+        logging.info('Benchmarking compression codecs over a %d bytes sample', len(sample))
+        results = []
+        for name, levels in CompressionBenchmark.LEVELS.items():
+            for level in levels:
+                output = io.BytesIO()
+                start_time = time.perf_counter()
+                with get_codec(name).open_writer(output, level, self.__threads) as writer:
+                    writer.write(sample)
+                elapsed = time.perf_counter() - start_time
+                throughput = len(sample) / (1024 * 1024) / elapsed if elapsed > 0 else float('inf')
+                ratio = len(output.getvalue()) / len(sample) if sample else 1.0
+                results.append((name, level, throughput, ratio))
+        return results
+
+    def sample(self, paths):
+        """Reads the beginning of files under ``paths`` until the sample size is reached.
+
+        At most ``MAX_BYTES_PER_FILE`` bytes are taken from each file so the
+        sample is spread over as many files as possible.
+        """
+        sample = bytearray()
+        for file_path in CompressionBenchmark._iter_files(paths):
+            remaining = self.__sample_size - len(sample)
+            if remaining <= 0:
+                break
+            try:
+                with open(file_path, 'rb') as sampled_file:
+                    sample += sampled_file.read(min(remaining, CompressionBenchmark.MAX_BYTES_PER_FILE))
+            except OSError as e:
+                logging.debug('Skipping "%s" from the sample: %s', file_path, e)
+        return bytes(sample)
+
+    @staticmethod
+    def _iter_files(paths):
+        for path in paths:
+            if os.path.isfile(path):
+                yield path
+            elif os.path.isdir(path):
+                for dir_path, dir_names, file_names in os.walk(path):
+                    dir_names.sort()
+                    for file_name in sorted(file_names):
+                        file_path = os.path.join(dir_path, file_name)
+                        if not os.path.islink(file_path):
+                            yield file_path
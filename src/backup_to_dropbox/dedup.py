@@ -0,0 +1,252 @@
+import hashlib
+import io
+import logging
+import os
+import os.path
+import random
+import sqlite3
+import threading
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+from backup_to_dropbox.streams import pending_futures
+
+
+class ContentDefinedChunker:
+    """Splits a stream in chunks whose boundaries depend on the content.
+
+    Every byte value is mapped to a pseudo-random bit and a boundary is
+    declared where the bits of the last ``n`` bytes form a fixed anchor
+    pattern, ``n`` being chosen so the expected distance between anchors is
+    ``avg_size - min_size``. The fingerprint only depends on a sliding window
+    of ``n`` bytes (like a rolling hash), so inserting or removing data only
+    changes the chunks around the modification. Mapping and search are done
+    with ``bytes.translate`` and ``bytes.find``, which run at C speed instead
+    of hashing byte by byte in Python. The first ``min_size`` bytes of every
+    chunk are skipped, which avoids tiny chunks.
+    """
+
+    MIN_SIZE = 1024 * 1024 # 1MB
+    AVG_SIZE = 2 * 1024 * 1024 # 2MB
+    MAX_SIZE = 8 * 1024 * 1024 # 8MB
+    READ_SIZE = 16 * 1024 * 1024 # 16MB
+
+    # The seed must never change: chunk boundaries (and therefore the
+    # deduplication against already stored chunks) depend on it.
+    _SEED = 0x6275646463
+
+    def __init__(self, min_size=MIN_SIZE, avg_size=AVG_SIZE, max_size=MAX_SIZE):
+        generator = random.Random(ContentDefinedChunker._SEED)
+        anchor_length = max(1, (avg_size - min_size).bit_length() - 1)
+        self.__bit_table = bytes(generator.choice(b'01') for _ in range(256))
+        self.__anchor = bytes(generator.choice(b'01') for _ in range(anchor_length))
+        self.__min_size = max(min_size, anchor_length)
+        self.__max_size = max_size
+
+    def split(self, stream):
+        """Yields the chunks of ``stream`` as ``bytes`` objects."""
+        buffer = bytearray()
+        eof = False
+        while True:
+            if not eof and len(buffer) < self.__max_size:
+                data = stream.read(ContentDefinedChunker.READ_SIZE)
+                if data:
+                    buffer += data
+                    continue
+                eof = True
+            if not buffer:
+                return
+            boundary = self._find_boundary(buffer)
+            yield bytes(buffer[:boundary])
+            del buffer[:boundary]
+
+    def _find_boundary(self, buffer):
+        if len(buffer) <= self.__min_size:
+            return len(buffer)
+        end = min(len(buffer), self.__max_size)
+        window_start = self.__min_size - len(self.__anchor)
+        fingerprints = buffer[window_start:end].translate(self.__bit_table)
+        anchor_position = fingerprints.find(self.__anchor)
+        if anchor_position < 0:
+            return end
+        return self.__min_size + anchor_position
+
+
+class ChunkIndex:
+    """Local cache of the chunks known to be stored in Dropbox."""
+
+    SYNCED_KEY = 'synced'
+
+    def __init__(self, db_path):
+        self.__db = sqlite3.connect(db_path, check_same_thread=False)
+        self.__lock = threading.Lock()
+        self.__db.execute('CREATE TABLE IF NOT EXISTS chunks (name TEXT PRIMARY KEY) WITHOUT ROWID')
+        self.__db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    @property
+    def synced(self):
+        with self.__lock:
+            return self.__db.execute('SELECT 1 FROM meta WHERE key = ?',
+                                     (ChunkIndex.SYNCED_KEY,)).fetchone() is not None
+
+    def replace_all(self, names):
+        with self.__lock:
+            self.__db.execute('DELETE FROM chunks')
+            self.__db.executemany('INSERT OR IGNORE INTO chunks VALUES (?)',
+                                  ((name,) for name in names))
+            self.__db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                              (ChunkIndex.SYNCED_KEY, '1'))
+            self.__db.commit()
+
+    def __contains__(self, name):
+        with self.__lock:
+            return self.__db.execute('SELECT 1 FROM chunks WHERE name = ?',
+                                     (name,)).fetchone() is not None
+
+    def add(self, name):
+        with self.__lock:
+            self.__db.execute('INSERT OR IGNORE INTO chunks VALUES (?)', (name,))
+
+    def remove(self, name):
+        with self.__lock:
+            self.__db.execute('DELETE FROM chunks WHERE name = ?', (name,))
+
+    def commit(self):
+        with self.__lock:
+            self.__db.commit()
+
+    def rollback(self):
+        with self.__lock:
+            self.__db.rollback()
+
+
+class Snapshot:
+    """List of the chunks which, concatenated, make up the archive of a backup."""
+
+    MAGIC = b'BTDSNAP1'
+    ENCRYPTED_FLAG = 1
+    DIGEST_SIZE = 32
+
+    def __init__(self, digests, encrypted):
+        self.digests = digests
+        self.encrypted = encrypted
+
+    @property
+    def chunk_names(self):
+        return [Snapshot.chunk_name(digest, self.encrypted) for digest in self.digests]
+
+    def to_bytes(self):
+        flags = Snapshot.ENCRYPTED_FLAG if self.encrypted else 0
+        return Snapshot.MAGIC + bytes([flags]) + b''.join(self.digests)
+
+    @staticmethod
+    def from_bytes(data):
+        if not data.startswith(Snapshot.MAGIC):
+            raise ValueError('Not a backup snapshot')
+        flags = data[len(Snapshot.MAGIC)]
+        body = data[len(Snapshot.MAGIC) + 1:]
+        digests = [body[i:i + Snapshot.DIGEST_SIZE]
+                   for i in range(0, len(body), Snapshot.DIGEST_SIZE)]
+        return Snapshot(digests, bool(flags & Snapshot.ENCRYPTED_FLAG))
+
+    @staticmethod
+    def chunk_name(digest, encrypted):
+        return digest.hex() + ('.enc' if encrypted else '')
+
+
+class ChunkStore:
+    """Stores chunks in Dropbox, once each, named after the SHA-256 of their content.
+
+    Chunks are zlib-compressed and, if an encryption service is given,
+    encrypted before being uploaded. Chunks already present in the local
+    index are never uploaded again.
+    """
+
+    CHUNKS_FOLDER = 'chunks'
+
+    def __init__(self, dropbox_client, index, encryption_service=None,
+                 compress_level=6, upload_workers=1):
+        self.__dropbox_client = dropbox_client
+        self.__index = index
+        self.__encryption_service = encryption_service
+        self.__compress_level = compress_level
+        self.__upload_workers = upload_workers
+
+    def store(self, base_dir, chunks):
+        """Stores every chunk under ``base_dir`` and returns the resulting ``Snapshot``."""
+        self._sync_index(base_dir)
+        encrypted = self.__encryption_service is not None
+        digests = []
+        stored, reused = 0, 0
+        slots = threading.BoundedSemaphore(2 * self.__upload_workers)
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.__upload_workers) as executor:
+            try:
+                for chunk in chunks:
+                    digest = hashlib.sha256(chunk).digest()
+                    digests.append(digest)
+                    name = Snapshot.chunk_name(digest, encrypted)
+                    if name in self.__index:
+                        reused += 1
+                        continue
+                    # Flag it right away so repeated chunks in this backup are uploaded once.
+                    self.__index.add(name)
+                    stored += 1
+                    slots.acquire()
+                    futures = pending_futures(futures)
+                    futures.append(executor.submit(self._upload_chunk,
+                                                   base_dir,
+                                                   name,
+                                                   chunk,
+                                                   slots))
+                for future in futures:
+                    future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                self.__index.rollback()
+                raise
+        self.__index.commit()
+        logging.info('Stored %d new chunks, %d already present', stored, reused)
+        return Snapshot(digests, encrypted)
+
+    def collect_garbage(self, base_dir, kept_snapshots):
+        """Deletes the chunks not referenced by any of ``kept_snapshots``."""
+        referenced = set()
+        for snapshot in kept_snapshots:
+            referenced.update(snapshot.chunk_names)
+        stored = self.__dropbox_client.list_files(self._chunks_dir(base_dir))
+        unreferenced = [name for name in stored if name not in referenced]
+        logging.info('Found %d chunks: removing %d unreferenced ones',
+                     len(stored),
+                     len(unreferenced))
+        # Forget them first: a chunk wrongly believed to be stored is never uploaded again.
+        for name in unreferenced:
+            self.__index.remove(name)
+        self.__index.commit()
+        self.__dropbox_client.delete_files(os.path.join(self._chunks_dir(base_dir), name)
+                                           for name in unreferenced)
+
+    def _sync_index(self, base_dir):
+        if not self.__index.synced:
+            logging.info('Rebuilding local chunk index from Dropbox')
+            self.__index.replace_all(self.__dropbox_client.list_files(self._chunks_dir(base_dir)))
+
+    def _upload_chunk(self, base_dir, name, chunk, slots):
+        try:
+            chunk_file = io.BytesIO(zlib.compress(chunk, self.__compress_level))
+            if self.__encryption_service is not None:
+                chunk_file = self.__encryption_service.encrypt(chunk_file)
+            with chunk_file:
+                self.__dropbox_client.upload_file(chunk_file,
+                                                  os.path.join(self._chunks_dir(base_dir), name),
+                                                  overwrite=True)
+        except BaseException:
+            self.__index.remove(name)
+            raise
+        finally:
+            slots.release()
+
+    def _chunks_dir(self, base_dir):
+        return os.path.join(base_dir, ChunkStore.CHUNKS_FOLDER)
@@ -0,0 +1,202 @@
+import bisect
+import struct
+import zlib
+
+
+class ArchiveIndex:
+    """Index of the members of a seekable archive, to fetch some of them without reading it all.
+
+    It maps the name of every member to the offset of its header in the tar
+    stream, and lists the blocks of the archive: the points at which the
+    compression was reset, as ``(tar offset, archive offset)`` pairs. With no
+    blocks the archive isn't compressed and both offsets are the same.
+
+    Names are sorted and stored prefix-compressed, except every
+    ``RESTART_INTERVAL`` names which are stored whole: lookups binary search
+    those and decode at most ``RESTART_INTERVAL`` entries. The whole index is
+    zlib-compressed.
+    """
+
+    MAGIC = b'BTDINDX1'
+    RESTART_INTERVAL = 64
+    HEADER = struct.Struct('<?II') # compressed archive, blocks, restart points
+    BLOCK = struct.Struct('<QQ')
+    RESTART = struct.Struct('<Q')
+
+    def __init__(self, compressed, blocks, restarts, entries):
+        self.compressed = compressed
+        self.blocks = blocks
+        self.__block_offsets = [tar_offset for tar_offset, _ in blocks]
+        self.__restarts = restarts
+        self.__entries = entries
+        self.__member_offsets = None
+
+    def lookup(self, name):
+        """Returns the offset of the member called ``name``, or ``None``."""
+        key = ArchiveIndex._encode(name)
+        for entry_key, offset in self.__scan(key):
+            if entry_key == key:
+                return offset
+            if entry_key > key:
+                break
+        return None
+
+    def members(self, path=''):
+        """Yields ``(name, offset)`` for the member ``path`` and every member under it."""
+        key = ArchiveIndex._encode(path)
+        if key:
+            offset = self.lookup(path)
+            if offset is not None:
+                yield path, offset
+            key += b'/'
+        for entry_key, offset in self.__scan(key):
+            if entry_key < key:
+                continue
+            if not entry_key.startswith(key):
+                break
+            yield ArchiveIndex._decode(entry_key), offset
+
+    def block(self, offset):
+        """Returns the ``(tar offset, archive offset)`` to start reading from to get to ``offset``."""
+        if not self.compressed:
+            return offset, offset
+        return self.blocks[bisect.bisect_right(self.__block_offsets, offset) - 1]
+
+    def member_end(self, offset):
+        """Returns the offset of the member following the one at ``offset``, or ``None``."""
+        if self.__member_offsets is None:
+            self.__member_offsets = sorted(offset for _, offset in self.__scan(b''))
+        position = bisect.bisect_right(self.__member_offsets, offset)
+        if position == len(self.__member_offsets):
+            return None
+        return self.__member_offsets[position]
+
+    def block_end(self, offset):
+        """Returns the archive offset up to which the archive is read to get to ``offset``.
+
+        That's the end of the block holding the data right before ``offset``,
+        or ``None`` if ``offset`` is ``None`` or in the last block.
+        """
+        if offset is None or not self.compressed:
+            return offset
+        position = bisect.bisect_left(self.__block_offsets, offset)
+        if position == len(self.blocks):
+            return None
+        return self.blocks[position][1]
+
+    def to_bytes(self):
+        body = [ArchiveIndex.HEADER.pack(self.compressed, len(self.blocks), len(self.__restarts))]
+        body.extend(ArchiveIndex.BLOCK.pack(*block) for block in self.blocks)
+        body.extend(ArchiveIndex.RESTART.pack(restart) for restart in self.__restarts)
+        body.append(self.__entries)
+        return ArchiveIndex.MAGIC + zlib.compress(b''.join(body))
+
+    @staticmethod
+    def from_bytes(data):
+        if not data.startswith(ArchiveIndex.MAGIC):
+            raise ValueError('Not an archive index')
+        body = zlib.decompress(data[len(ArchiveIndex.MAGIC):])
+        compressed, block_count, restart_count = ArchiveIndex.HEADER.unpack_from(body)
+        position = ArchiveIndex.HEADER.size
+        blocks = list(ArchiveIndex.BLOCK.iter_unpack(
+            body[position:position + block_count * ArchiveIndex.BLOCK.size]))
+        position += block_count * ArchiveIndex.BLOCK.size
+        restarts = [restart for restart, in ArchiveIndex.RESTART.iter_unpack(
+            body[position:position + restart_count * ArchiveIndex.RESTART.size])]
+        position += restart_count * ArchiveIndex.RESTART.size
+        return ArchiveIndex(compressed, blocks, restarts, body[position:])
+
+    @staticmethod
+    def build(members, blocks=None):
+        """Returns the index of ``members``, ``(name, offset)`` pairs in any order.
+
+        ``blocks`` are the blocks of a compressed archive, ``None`` if the
+        archive is not compressed.
+        """
+        entries = bytearray()
+        restarts = []
+        previous = b''
+        for count, (key, offset) in enumerate(sorted((ArchiveIndex._encode(name), offset)
+                                                     for name, offset in members)):
+            shared = 0
+            if count % ArchiveIndex.RESTART_INTERVAL == 0:
+                restarts.append(len(entries))
+            else:
+                limit = min(len(previous), len(key))
+                while shared < limit and previous[shared] == key[shared]:
+                    shared += 1
+            entries += ArchiveIndex._varint(shared)
+            entries += ArchiveIndex._varint(len(key) - shared)
+            entries += key[shared:]
+            entries += ArchiveIndex._varint(offset)
+            previous = key
+        return ArchiveIndex(blocks is not None, list(blocks or []), restarts, bytes(entries))
+
+    def __scan(self, key):
+        """Yields the entries from the last restart point not after ``key`` to the end."""
+        low, high = 0, len(self.__restarts)
+        while high - low > 1:
+            middle = (low + high) // 2
+            if self.__restart_key(middle) <= key:
+                low = middle
+            else:
+                high = middle
+        if not self.__restarts:
+            return
+        position = self.__restarts[low]
+        entry_key = b''
+        while position < len(self.__entries):
+            shared, position = ArchiveIndex._read_varint(self.__entries, position)
+            length, position = ArchiveIndex._read_varint(self.__entries, position)
+            entry_key = entry_key[:shared] + self.__entries[position:position + length]
+            offset, position = ArchiveIndex._read_varint(self.__entries, position + length)
+            yield entry_key, offset
+
+    def __restart_key(self, index):
+        position = self.__restarts[index]
+        _, position = ArchiveIndex._read_varint(self.__entries, position)
+        length, position = ArchiveIndex._read_varint(self.__entries, position)
+        return self.__entries[position:position + length]
+
+    @staticmethod
+    def _encode(name):
+        return name.encode('utf-8', 'surrogateescape')
+
+    @staticmethod
+    def _decode(key):
+        return key.decode('utf-8', 'surrogateescape')
+
+    @staticmethod
+    def _varint(value):
+        encoded = bytearray()
+        while value >= 0x80:
+            encoded.append((value & 0x7f) | 0x80)
+            value >>= 7
+        encoded.append(value)
+        return encoded
+
+    @staticmethod
+    def _read_varint(data, position):
+        value = 0
+        shift = 0
+        while True:
+            byte = data[position]
+            position += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value, position
+            shift += 7
+
+
+class ArchiveIndexBuilder:
+    """Collects the members of an archive while it's written, to build its ``ArchiveIndex``."""
+
+    def __init__(self):
+        self.__members = []
+        self.blocks = None
+
+    def add(self, name, offset):
+        self.__members.append((name, offset))
+
+    def build(self):
+        return ArchiveIndex.build(self.__members, self.blocks)
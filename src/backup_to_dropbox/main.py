@@ -1,22 +1,63 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
+import json
 import logging
+import os
+import os.path
+import signal
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+
 import dropbox
 
 from backup_to_dropbox.clients import DropboxClient
-from backup_to_dropbox.services import BackupService, GpgEncryptionService
+from backup_to_dropbox.compression import CODECS, CompressionBenchmark, get_codec
+from backup_to_dropbox.dedup import ChunkIndex, ChunkStore
+from backup_to_dropbox.manifest import IncrementalBackupState
+from backup_to_dropbox.metrics import RunMetrics, save_prometheus_textfile, save_report
+from backup_to_dropbox.profiler import SamplingProfiler
+from backup_to_dropbox.scheduler import CronSchedule, DiskSlots, Job, Scheduler
+from backup_to_dropbox.services import BackupService, GpgEncryptionService, RestoreService
+from backup_to_dropbox.throttle import BandwidthLimiter, BandwidthSchedule
+from backup_to_dropbox.walker import FileWalker, read_patterns
 
 
 def main():
-    parser = argparse.ArgumentParser(description='Backup data using Dropbox as storage.')
+    parser = backup_parser()
+    args = parser.parse_args()
+    if args.benchmark_compression:
+        benchmark_compression(args)
+        return
+    check_backup_args(parser, args)
+
+    start_time = time.perf_counter()
+    metrics = RunMetrics()
+    profiler = None
+    if args.profile is not None:
+        profiler = SamplingProfiler()
+        profiler.start()
+    succeeded = False
+    try:
+        run_backup(args, create_dropbox_api(args.api_key), metrics)
+        succeeded = True
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            profiler.save(args.profile)
+            logging.info('Saved profile to %s', args.profile)
+        save_metrics(args, metrics.report(backup_name=args.backup_name, succeeded=succeeded))
+    end_time = time.perf_counter()
+    logging.info('Backup finished. Time elapsed: %.2f', end_time - start_time)
+
+def backup_parser(prog=None):
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Backup data using Dropbox as storage.')
     parser.add_argument('--api-key',
-                        required=True,
                         help='Dropbox API Key to use for authentication')
     parser.add_argument('--backup-name',
-                        required=True,
                         help='Name for the backup in Dropbox')
     parser.add_argument('--max-backups',
                         type=int,
@@ -27,29 +68,436 @@ def main():
                         help='Folder to use as GPG home')
     parser.add_argument('--gpg-pubkeyring',
                         help='GPG public key keyring to use')
+    parser.add_argument('--streaming',
+                        action='store_true',
+                        help='Upload the archive while it is being generated instead of '
+                             'writing it to a temporary file first')
+    parser.add_argument('--stream-buffer-size',
+                        type=int,
+                        default=64,
+                        help='Max amount of memory (in MB) used to buffer the archive '
+                             'between generation and upload in streaming mode')
+    parser.add_argument('--compression',
+                        choices=sorted(CODECS),
+                        default='gz',
+                        help='Compression format to use for the archive')
+    parser.add_argument('--compress-threads',
+                        type=int,
+                        default=1,
+                        help='Number of threads used to compress the archive (gz only)')
+    parser.add_argument('--compress-level',
+                        type=int,
+                        choices=range(0, 10),
+                        metavar='{0-9}',
+                        help='Compression level to use (default depends on the format)')
+    parser.add_argument('--benchmark-compression',
+                        action='store_true',
+                        help='Report speed and ratio of every compression format over a '
+                             'sample of the paths instead of performing a backup')
+    parser.add_argument('--benchmark-sample-size',
+                        type=int,
+                        default=64,
+                        help='Amount of data (in MB) sampled from the paths when '
+                             'benchmarking compression')
+    parser.add_argument('--upload-concurrency',
+                        type=int,
+                        default=1,
+                        help='Number of chunks to upload in parallel for big backups')
+    parser.add_argument('--bandwidth-limit',
+                        action='append',
+                        default=[],
+                        metavar='PROFILE',
+                        help='Max upload rate in MB/s, all day (e.g. "20") or between two times '
+                             '(e.g. "08:00-20:00=20"), unlimited otherwise (can be given '
+                             'multiple times)')
+    parser.add_argument('--max-upload-memory',
+                        type=int,
+                        help='Max amount of memory (in MB) holding data of a file being uploaded')
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help='Only archive the files changed since the previous backup')
+    parser.add_argument('--full-every',
+                        type=int,
+                        help='Number of incremental backups after which a full one is generated')
+    parser.add_argument('--manifest-hash',
+                        action='store_true',
+                        help='Compare the content of files whose metadata changed before '
+                             'including them in incremental backups')
+    parser.add_argument('--dedup',
+                        action='store_true',
+                        help='Store the backup as deduplicated chunks shared by all the backups')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='Keep the file being uploaded in the state folder and resume its '
+                             'upload on the next run if it gets interrupted')
+    parser.add_argument('--state-dir',
+                        help='Folder where local state is kept between runs '
+                             '(default: ~/.cache/backup-to-dropbox/<backup-name>)')
+    parser.add_argument('--volume-size',
+                        type=int,
+                        help='Split the backup in archives of about this size (in MB) before '
+                             'compression, built and uploaded in parallel')
+    parser.add_argument('--volume-workers',
+                        type=int,
+                        help='Number of processes building volumes (default: number of CPUs)')
+    parser.add_argument('--seekable',
+                        action='store_true',
+                        help='Write the archive in blocks compressed independently and upload an '
+                             'index of its members next to it, so single paths can be fetched '
+                             'without downloading it all (gz and none compression only)')
+    parser.add_argument('--skip-unchanged',
+                        action='store_true',
+                        help='Copy the archive of the previous backup in Dropbox instead of '
+                             'uploading it again when it has the same content')
+    parser.add_argument('--no-verify-uploads',
+                        dest='verify_uploads',
+                        action='store_false',
+                        help='Do not compare the content hash of every uploaded file with the '
+                             'one of the data sent')
+    parser.add_argument('--exclude',
+                        action='append',
+                        default=[],
+                        metavar='PATTERN',
+                        help='Glob pattern of the paths to leave out of the backup (can be '
+                             'given multiple times)')
+    parser.add_argument('--exclude-from',
+                        action='append',
+                        default=[],
+                        metavar='FILE',
+                        help='File with exclude patterns, one per line (can be given multiple '
+                             'times)')
+    parser.add_argument('--walk-threads',
+                        type=int,
+                        default=FileWalker.DEFAULT_THREADS,
+                        help='Number of threads listing directories and reading file metadata')
+    parser.add_argument('--report',
+                        help='File to write a JSON report with the time, CPU, bytes and retries '
+                             'of every stage of the run to')
+    parser.add_argument('--prometheus-textfile',
+                        help='File to write the measurements of the run to in the Prometheus '
+                             'text format, for the textfile collector of the node exporter')
+    parser.add_argument('--profile',
+                        help='Sample the stacks of all the threads during the run and write them '
+                             'to this file in collapsed stack format, for flame graphs')
     parser.add_argument('paths',
                         nargs='+',
                         help='List of paths to include in the backup')
+    return parser
 
-    args = parser.parse_args()
-    start_time = time.perf_counter()
+def check_backup_args(parser, args):
+    if args.api_key is None or args.backup_name is None:
+        parser.error('the following arguments are required: --api-key, --backup-name')
+    codec = get_codec(args.compression)
+    if args.compress_level is not None and args.compress_level not in codec.levels:
+        parser.error('compression level {} is not supported by {}'.format(args.compress_level,
+                                                                          codec.name))
+    if args.volume_size is not None and (args.dedup or args.resume):
+        parser.error('--volume-size can not be combined with --dedup or --resume')
+    if args.streaming and args.resume:
+        parser.error('--streaming can not be combined with --resume')
+    if args.seekable:
+        if not codec.seekable:
+            parser.error('--seekable is not supported by {} compression'.format(codec.name))
+        if args.gpg_encrypt is not None or args.dedup or args.volume_size is not None:
+            parser.error('--seekable can not be combined with --gpg-encrypt, --dedup or '
+                         '--volume-size')
+    try:
+        BandwidthSchedule(args.bandwidth_limit)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.max_upload_memory is not None:
+        min_upload_memory = DropboxClient.min_upload_memory(args.upload_concurrency) // (1024 * 1024)
+        if args.max_upload_memory < min_upload_memory:
+            parser.error('--max-upload-memory must be at least {} MB with an upload concurrency '
+                         'of {}'.format(min_upload_memory, args.upload_concurrency))
+    if args.skip_unchanged and (args.streaming or args.gpg_encrypt is not None or args.dedup or
+                                args.volume_size is not None):
+        parser.error('--skip-unchanged can not be combined with --streaming, --gpg-encrypt, '
+                     '--dedup or --volume-size')
+
+def run_backup(args, dropbox_api, metrics, disk_slots=None, bandwidth_limiter=None):
+    """Backs up the paths of ``args`` through ``dropbox_api`` and cleans up old backups.
+
+    The ``--bandwidth-limit`` of ``args``, if any, takes precedence over
+    ``bandwidth_limiter``.
+    """
+    codec = get_codec(args.compression)
     logging.info('Creating Dropbox client')
-    dropbox_client = DropboxClient(dropbox.Dropbox(args.api_key, timeout=None))
+    max_upload_memory = None
+    if args.max_upload_memory is not None:
+        max_upload_memory = args.max_upload_memory * 1024 * 1024
+    if args.bandwidth_limit:
+        bandwidth_limiter = BandwidthLimiter(BandwidthSchedule(args.bandwidth_limit))
+    dropbox_client = DropboxClient(dropbox_api,
+                                   upload_concurrency=args.upload_concurrency,
+                                   max_upload_memory=max_upload_memory,
+                                   metrics=metrics,
+                                   verify_uploads=args.verify_uploads,
+                                   bandwidth_limiter=bandwidth_limiter)
 
     encryption_service = None
     if args.gpg_encrypt is not None:
         from pretty_bad_protocol import gnupg
 
         gnupg_api = gnupg.GPG(homedir=args.gpg_home, keyring=args.gpg_pubkeyring)
-        encryption_service = GpgEncryptionService(args.gpg_encrypt, gnupg_api)
+        encryption_service = GpgEncryptionService(args.gpg_encrypt, gnupg_api, metrics=metrics)
+
+    state_dir = args.state_dir
+    if state_dir is None:
+        state_dir = os.path.join(os.path.expanduser('~/.cache/backup-to-dropbox'),
+                                 args.backup_name)
+
+    incremental_state = None
+    if args.incremental:
+        incremental_state = IncrementalBackupState(state_dir,
+                                                   full_every=args.full_every,
+                                                   hash_files=args.manifest_hash)
+
+    chunk_store = None
+    if args.dedup:
+        os.makedirs(state_dir, exist_ok=True)
+        chunk_compress_level = 6 if args.compress_level is None else args.compress_level
+        chunk_store = ChunkStore(dropbox_client,
+                                 ChunkIndex(os.path.join(state_dir, 'chunks.sqlite')),
+                                 encryption_service,
+                                 compress_level=chunk_compress_level,
+                                 upload_workers=args.upload_concurrency)
+
+    exclude_patterns = list(args.exclude)
+    for patterns_path in args.exclude_from:
+        exclude_patterns.extend(read_patterns(patterns_path))
+
+    resume_dir = None
+    if args.resume:
+        os.makedirs(state_dir, exist_ok=True)
+        resume_dir = state_dir
+
+    volume_size = None
+    if args.volume_size is not None:
+        volume_size = args.volume_size * 1024 * 1024
+
+    backup_service = BackupService(dropbox_client,
+                                   args.backup_name,
+                                   encryption_service,
+                                   streaming=args.streaming,
+                                   stream_buffer_size=args.stream_buffer_size * 1024 * 1024,
+                                   codec=codec,
+                                   compress_level=args.compress_level,
+                                   compress_threads=args.compress_threads,
+                                   incremental_state=incremental_state,
+                                   chunk_store=chunk_store,
+                                   resume_dir=resume_dir,
+                                   metrics=metrics,
+                                   exclude_patterns=exclude_patterns,
+                                   walk_threads=args.walk_threads,
+                                   volume_size=volume_size,
+                                   volume_workers=args.volume_workers,
+                                   seekable=args.seekable,
+                                   skip_unchanged=args.skip_unchanged,
+                                   disk_slots=disk_slots)
+
+    def cleanup_old_backups():
+        with metrics.stage('cleanup'):
+            backup_service.cleanup_old_backups(args.max_backups - 1)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        cleanup = None
+        if args.max_backups is not None:
+            logging.info('Performing cleanup of old backups')
+            if chunk_store is None:
+                cleanup = executor.submit(cleanup_old_backups)
+            else:
+                # Garbage collection would delete the chunks being uploaded by this backup.
+                cleanup_old_backups()
+        backup_service.backup_paths(args.paths)
+        if cleanup is not None:
+            cleanup.result()
+
+def daemon():
+    parser = argparse.ArgumentParser(description='Run the backup jobs of a configuration file on '
+                                                 'their schedules.')
+    parser.add_argument('config',
+                        help='JSON file with the jobs to run')
+
+    args = parser.parse_args()
+    with open(args.config) as config_file:
+        config = json.load(config_file)
+    # A single pool of connections is shared by the clients of all the jobs.
+    session = dropbox.create_session(max_connections=config.get('max_connections', 16))
+    dropbox_apis = {}
+    disk_slots = DiskSlots(config.get('disk_slots', 1))
+    bandwidth_limiter = None
+    if config.get('bandwidth_limit'):
+        try:
+            schedule = BandwidthSchedule(config['bandwidth_limit'])
+        except ValueError as e:
+            parser.error(str(e))
+        # The limit applies to all the jobs together.
+        bandwidth_limiter = BandwidthLimiter(schedule)
+    jobs = []
+    for job_config in config.get('jobs', []):
+        options = dict(config.get('defaults', {}))
+        options.update(job_config)
+        if 'name' not in options or 'schedule' not in options:
+            parser.error('every job needs a name and a schedule')
+        try:
+            schedule = CronSchedule(options.pop('schedule'))
+        except ValueError as e:
+            parser.error('job "{}": {}'.format(options['name'], e))
+        priority = options.pop('priority', 0)
+        job_args = job_backup_args(options)
+        if job_args.api_key not in dropbox_apis:
+            dropbox_apis[job_args.api_key] = create_dropbox_api(job_args.api_key, session)
+        jobs.append(Job(job_args.backup_name,
+                        schedule,
+                        functools.partial(run_job,
+                                          job_args,
+                                          dropbox_apis[job_args.api_key],
+                                          disk_slots,
+                                          bandwidth_limiter),
+                        priority=priority))
+
+    scheduler = Scheduler(jobs, max_concurrent_jobs=config.get('max_concurrent_jobs', 1))
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: scheduler.stop())
+    logging.info('Running %d jobs', len(jobs))
+    scheduler.run()
+
+def job_backup_args(options):
+    """Returns the arguments of the backup of a job of the configuration of the daemon.
 
-    backup_service = BackupService(dropbox_client, args.backup_name, encryption_service)
-    if args.max_backups is not None:
-        logging.info('Performing cleanup of old backups')
-        backup_service.cleanup_old_backups(args.max_backups - 1)
-    backup_service.backup_paths(args.paths)
+    Options are named like the command line flags of the backup (``-`` or
+    ``_`` separated) and ``name`` is the backup name. Flags are set with
+    ``true`` and flags given several times take a list.
+    """
+    options = dict(options)
+    name = options.pop('name')
+    paths = options.pop('paths', [])
+    argv = ['--backup-name', name]
+    for key, value in sorted(options.items()):
+        flag = '--' + key.replace('_', '-')
+        values = value if isinstance(value, list) else [value]
+        for value in values:
+            if value is True:
+                argv.append(flag)
+            elif value is not False and value is not None:
+                argv.extend((flag, str(value)))
+    parser = backup_parser(prog='job "{}"'.format(name))
+    args = parser.parse_args(argv + ['--'] + paths)
+    if args.profile is not None or args.benchmark_compression:
+        parser.error('--profile and --benchmark-compression are not supported by jobs')
+    check_backup_args(parser, args)
+    return args
+
+def run_job(args, dropbox_api, disk_slots, bandwidth_limiter):
+    start_time = time.perf_counter()
+    metrics = RunMetrics()
+    succeeded = False
+    try:
+        run_backup(args, dropbox_api, metrics, disk_slots, bandwidth_limiter)
+        succeeded = True
+    finally:
+        save_metrics(args, metrics.report(backup_name=args.backup_name, succeeded=succeeded))
     end_time = time.perf_counter()
-    logging.info('Backup finished. Time elapsed: %.2f', end_time - start_time)
+    logging.info('Backup %s finished. Time elapsed: %.2f', args.backup_name, end_time - start_time)
+
+def restore():
+    parser = restore_parser('Restore a backup stored in Dropbox.')
+    parser.add_argument('--gpg-decrypt',
+                        action='store_true',
+                        help='Decrypt the backup with GPG')
+    parser.add_argument('--gpg-home',
+                        help='Folder to use as GPG home')
+    parser.add_argument('--gpg-pubkeyring',
+                        help='GPG public key keyring to use')
+    parser.add_argument('paths',
+                        nargs='*',
+                        help='Only restore these paths (default: everything)')
+
+    args = parser.parse_args()
+    start_time = time.perf_counter()
+    dropbox_client = DropboxClient(create_dropbox_api(args.api_key))
+
+    encryption_service = None
+    if args.gpg_decrypt:
+        from pretty_bad_protocol import gnupg
+
+        gnupg_api = gnupg.GPG(homedir=args.gpg_home, keyring=args.gpg_pubkeyring)
+        encryption_service = GpgEncryptionService(None, gnupg_api)
+
+    restore_service = RestoreService(dropbox_client,
+                                     args.backup_name,
+                                     encryption_service,
+                                     download_workers=args.download_workers)
+    os.makedirs(args.destination, exist_ok=True)
+    restore_service.restore(args.backup, args.destination, args.paths)
+    end_time = time.perf_counter()
+    logging.info('Restore finished. Time elapsed: %.2f', end_time - start_time)
+
+def fetch():
+    parser = restore_parser('Fetch some paths of a seekable backup stored in Dropbox, '
+                            'downloading only the parts of the archives holding them.')
+    parser.add_argument('paths',
+                        nargs='+',
+                        help='Paths to fetch')
+
+    args = parser.parse_args()
+    start_time = time.perf_counter()
+    dropbox_client = DropboxClient(create_dropbox_api(args.api_key))
+    restore_service = RestoreService(dropbox_client,
+                                     args.backup_name,
+                                     download_workers=args.download_workers)
+    os.makedirs(args.destination, exist_ok=True)
+    restore_service.fetch(args.backup, args.destination, args.paths)
+    end_time = time.perf_counter()
+    logging.info('Fetch finished. Time elapsed: %.2f', end_time - start_time)
+
+def create_dropbox_api(api_key, session=None):
+    # Throttled requests are retried by DropboxClient, which also slows down its uploads.
+    return dropbox.Dropbox(api_key, timeout=None, session=session, max_retries_on_rate_limit=0)
+
+def restore_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--api-key',
+                        required=True,
+                        help='Dropbox API Key to use for authentication')
+    parser.add_argument('--backup-name',
+                        required=True,
+                        help='Name of the backup in Dropbox')
+    parser.add_argument('--destination',
+                        default='.',
+                        help='Folder to extract the backup into (default: current folder)')
+    parser.add_argument('--download-workers',
+                        type=int,
+                        default=4,
+                        help='Number of parts of the backup downloaded in parallel')
+    parser.add_argument('backup',
+                        help='Timestamp of the backup to restore (e.g. 2020-05-10-1715), name of '
+                             'one of its files or "latest"')
+    return parser
+
+def save_metrics(args, report):
+    for stage, stats in sorted(report['stages'].items()):
+        logging.debug('Stage %s: %.2fs wall, %.2fs CPU, %d bytes in, %d bytes out',
+                      stage,
+                      stats['wall_time'],
+                      stats['cpu_time'],
+                      stats['bytes_in'],
+                      stats['bytes_out'])
+    if args.report is not None:
+        save_report(report, args.report)
+        logging.info('Saved run report to %s', args.report)
+    if args.prometheus_textfile is not None:
+        save_prometheus_textfile(report, args.prometheus_textfile)
+
+def benchmark_compression(args):
+    benchmark = CompressionBenchmark(sample_size=args.benchmark_sample_size * 1024 * 1024,
+                                     threads=args.compress_threads)
+    results = benchmark.run(args.paths)
+    print('{:<6} {:>5} {:>10} {:>7}'.format('codec', 'level', 'MB/s', 'ratio'))
+    for codec, level, throughput, ratio in results:
+        print('{:<6} {:>5} {:>10.1f} {:>7.3f}'.format(codec, '-' if level is None else level,
+                                                       throughput, ratio))
 
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -0,0 +1,199 @@
+import collections
+import hashlib
+import logging
+import os
+import os.path
+import sqlite3
+import stat
+
+
+FileState = collections.namedtuple('FileState', ['size', 'mtime_ns', 'inode', 'hash'])
+
+
+class FileManifest:
+    """State of every path included in a backup, stored in a sqlite database.
+
+    Paths are stored as bytes in a ``WITHOUT ROWID`` table keyed by path, so
+    lookups are served from the on-disk b-tree and the manifest of millions
+    of files never needs to be loaded in memory.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.__db = sqlite3.connect(db_path, check_same_thread=False)
+        self.__db.execute('CREATE TABLE IF NOT EXISTS files ('
+                          'path BLOB PRIMARY KEY, '
+                          'size INTEGER NOT NULL, '
+                          'mtime_ns INTEGER NOT NULL, '
+                          'inode INTEGER NOT NULL, '
+                          'hash BLOB) WITHOUT ROWID')
+        self.__db.execute('CREATE TABLE IF NOT EXISTS meta ('
+                          'key TEXT PRIMARY KEY, '
+                          'value TEXT NOT NULL)')
+
+    def lookup(self, path):
+        row = self.__db.execute('SELECT size, mtime_ns, inode, hash FROM files WHERE path = ?',
+                                (os.fsencode(path),)).fetchone()
+        return FileState(*row) if row is not None else None
+
+    def add(self, path, file_state):
+        self.__db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                          (os.fsencode(path),) + tuple(file_state))
+
+    def paths_missing_from(self, other):
+        """Yields, sorted, the paths in this manifest which are not in ``other``."""
+        self.__db.execute('ATTACH DATABASE ? AS other', (other.db_path,))
+        try:
+            cursor = self.__db.execute('SELECT path FROM files '
+                                       'EXCEPT SELECT path FROM other.files '
+                                       'ORDER BY path')
+            for (path,) in cursor:
+                yield os.fsdecode(path)
+        finally:
+            self.__db.execute('DETACH DATABASE other')
+
+    def get_meta(self, key, default=None):
+        row = self.__db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def set_meta(self, key, value):
+        self.__db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, str(value)))
+
+    def commit(self):
+        self.__db.commit()
+
+    def close(self):
+        self.__db.commit()
+        self.__db.close()
+
+
+class IncrementalBackupState:
+    """Local state needed to generate incremental backups.
+
+    The manifest of the last successful backup is kept in ``state_dir``. A
+    full backup is generated when there's no previous manifest or when
+    ``full_every`` incremental backups have been generated since the last
+    full one.
+    """
+
+    MANIFEST_FILE = 'manifest.sqlite'
+    CHAIN_LENGTH_KEY = 'incrementals_since_full'
+
+    def __init__(self, state_dir, full_every=None, hash_files=False):
+        self.__state_dir = state_dir
+        self.__full_every = full_every
+        self.__hash_files = hash_files
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.__state_dir, IncrementalBackupState.MANIFEST_FILE)
+
+    def next_is_full(self):
+        if not os.path.exists(self.manifest_path):
+            return True
+        if self.__full_every is None:
+            return False
+        previous = FileManifest(self.manifest_path)
+        try:
+            chain_length = int(previous.get_meta(IncrementalBackupState.CHAIN_LENGTH_KEY, 0))
+        finally:
+            previous.close()
+        return chain_length >= self.__full_every
+
+    def start(self):
+        os.makedirs(self.__state_dir, exist_ok=True)
+        is_full = self.next_is_full()
+        new_manifest_path = self.manifest_path + '.new'
+        if os.path.exists(new_manifest_path):
+            os.remove(new_manifest_path)
+
+        previous = None if is_full else FileManifest(self.manifest_path)
+        chain_length = 0
+        if previous is not None:
+            chain_length = int(previous.get_meta(IncrementalBackupState.CHAIN_LENGTH_KEY, 0)) + 1
+        current = FileManifest(new_manifest_path)
+        current.set_meta(IncrementalBackupState.CHAIN_LENGTH_KEY, chain_length)
+        logging.info('Generating %s backup', 'full' if is_full else 'incremental')
+        return ManifestTracker(previous, current, self.manifest_path, self.__hash_files)
+
+
+class ManifestTracker:
+    """Records the files of the backup being generated and compares them with the previous one."""
+
+    HASH_BLOCK_SIZE = 1024 * 1024 # 1MB
+
+    def __init__(self, previous, current, manifest_path, hash_files):
+        self.__previous = previous
+        self.__current = current
+        self.__manifest_path = manifest_path
+        self.__hash_files = hash_files
+        self.__closed = False
+
+    @property
+    def is_full(self):
+        return self.__previous is None
+
+    @property
+    def manifest_path(self):
+        """Path of the manifest being generated, valid once ``close`` has been called."""
+        return self.__current.db_path
+
+    def has_changed(self, path, stat_result):
+        """Records ``path`` in the new manifest and tells whether it needs to be archived.
+
+        Only regular files are ever considered unchanged: they are when size,
+        mtime and inode match the previous manifest or, if hashing is enabled,
+        when their content hash does.
+        """
+        file_state = FileState(stat_result.st_size,
+                               stat_result.st_mtime_ns,
+                               stat_result.st_ino,
+                               None)
+        previous_state = self.__previous.lookup(path) if self.__previous is not None else None
+        changed = True
+        if stat.S_ISREG(stat_result.st_mode):
+            if previous_state is not None and previous_state[:3] == file_state[:3]:
+                changed = False
+                file_state = previous_state
+            elif self.__hash_files:
+                file_state = file_state._replace(hash=ManifestTracker._hash_file(path))
+                changed = previous_state is None or file_state.hash is None or \
+                    previous_state.hash != file_state.hash
+        self.__current.add(path, file_state)
+        return changed
+
+    def deleted_paths(self):
+        if self.__previous is None:
+            return iter(())
+        self.__current.commit()
+        return self.__previous.paths_missing_from(self.__current)
+
+    def close(self):
+        if self.__closed:
+            return
+        self.__closed = True
+        self.__current.close()
+        if self.__previous is not None:
+            self.__previous.close()
+
+    def commit(self):
+        """Makes the new manifest the reference for the next incremental backup."""
+        self.close()
+        os.replace(self.__current.db_path, self.__manifest_path)
+
+    def discard(self):
+        self.close()
+        if os.path.exists(self.__current.db_path):
+            os.remove(self.__current.db_path)
+
+    @staticmethod
+    def _hash_file(path):
+        digest = hashlib.sha256()
+        try:
+            with open(path, 'rb') as hashed_file:
+                for block in iter(lambda: hashed_file.read(ManifestTracker.HASH_BLOCK_SIZE), b''):
+                    digest.update(block)
+        except OSError as e:
+            logging.warning('Failed to hash "%s": %s', path, e)
+            return None
+        return digest.digest()
@@ -0,0 +1,239 @@
+import io
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+
+
+# CPU time of the calling thread, so stages running concurrently don't add up
+# each other's time. Python 3.6 only has the CPU time of the whole process.
+thread_time = getattr(time, 'thread_time', time.process_time)
+
+
+def peak_rss_bytes():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes by macOS and in kilobytes everywhere else.
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class StageStats:
+    """Time and bytes accumulated by every run of a stage of the backup."""
+
+    def __init__(self):
+        self.calls = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def to_dict(self):
+        stats = {'calls': self.calls,
+                 'wall_time': self.wall_time,
+                 'cpu_time': self.cpu_time,
+                 'bytes_in': self.bytes_in,
+                 'bytes_out': self.bytes_out}
+        if self.bytes_in and self.bytes_out:
+            stats['ratio'] = self.bytes_out / self.bytes_in
+        return stats
+
+
+class RunMetrics:
+    """Thread-safe collector of the measurements of a backup run.
+
+    Stages accumulate wall time, CPU time of the thread running them and
+    the bytes they consume and produce. Counters track events such as
+    retries, and samples keep values whose distribution matters, such as
+    the latency of every upload request.
+    """
+
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__started_at = time.time()
+        self.__start_time = time.perf_counter()
+        self.__stages = {}
+        self.__counters = {}
+        self.__samples = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Measures the time spent running the ``with`` block as part of stage ``name``."""
+        start_time = time.perf_counter()
+        start_cpu_time = thread_time()
+        try:
+            yield
+        finally:
+            self.add_time(name,
+                          time.perf_counter() - start_time,
+                          thread_time() - start_cpu_time,
+                          calls=1)
+
+    def add_time(self, stage, wall_time, cpu_time=0.0, calls=0):
+        with self.__lock:
+            stats = self.__stage(stage)
+            stats.calls += calls
+            stats.wall_time += wall_time
+            stats.cpu_time += cpu_time
+
+    def add_bytes(self, stage, bytes_in=0, bytes_out=0):
+        with self.__lock:
+            stats = self.__stage(stage)
+            stats.bytes_in += bytes_in
+            stats.bytes_out += bytes_out
+
+    def add_stages(self, stages):
+        """Adds the ``stages`` of a report, e.g. one measured in a worker process."""
+        for name, stats in stages.items():
+            self.add_time(name, stats['wall_time'], stats['cpu_time'], stats['calls'])
+            self.add_bytes(name, stats['bytes_in'], stats['bytes_out'])
+
+    def add_counters(self, counters):
+        """Adds the ``counters`` of a report, e.g. one measured in a worker process."""
+        for counter, value in counters.items():
+            self.increment(counter, value)
+
+    def increment(self, counter, value=1):
+        with self.__lock:
+            self.__counters[counter] = self.__counters.get(counter, 0) + value
+
+    def observe(self, name, value):
+        with self.__lock:
+            self.__samples.setdefault(name, []).append(value)
+
+    def report(self, **info):
+        """Returns all the measurements as a JSON serializable dict, including ``info``."""
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        with self.__lock:
+            report = dict(info)
+            report.update({
+                'started_at': datetime.fromtimestamp(self.__started_at).isoformat(),
+                'start_timestamp': self.__started_at,
+                'wall_time': time.perf_counter() - self.__start_time,
+                'cpu_time': {'user': usage.ru_utime,
+                             'system': usage.ru_stime,
+                             'children_user': children_usage.ru_utime,
+                             'children_system': children_usage.ru_stime},
+                'peak_rss_bytes': peak_rss_bytes(),
+                'stages': {name: stats.to_dict() for name, stats in self.__stages.items()},
+                'counters': dict(self.__counters),
+                'samples': {name: RunMetrics._summarize(values)
+                            for name, values in self.__samples.items()},
+            })
+        return report
+
+    def __stage(self, name):
+        stats = self.__stages.get(name)
+        if stats is None:
+            stats = self.__stages[name] = StageStats()
+        return stats
+
+    @staticmethod
+    def _summarize(values):
+        values = sorted(values)
+        return {'count': len(values),
+                'sum': sum(values),
+                'min': values[0],
+                'max': values[-1],
+                'quantiles': {str(quantile): values[min(len(values) - 1,
+                                                        int(quantile * len(values)))]
+                              for quantile in RunMetrics.QUANTILES}}
+
+
+class MeteredWriter(io.RawIOBase):
+    """Writes into ``fileobj`` counting the bytes written and the time spent writing them.
+
+    The totals are kept in the instance, so it must be used from a single
+    thread.
+    """
+
+    def __init__(self, fileobj):
+        self.__fileobj = fileobj
+        self.bytes_written = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        start_time = time.perf_counter()
+        start_cpu_time = thread_time()
+        self.__fileobj.write(data)
+        self.cpu_time += thread_time() - start_cpu_time
+        self.wall_time += time.perf_counter() - start_time
+        self.bytes_written += len(data)
+        return len(data)
+
+
+def save_report(report, path):
+    _write_atomically(path, json.dumps(report, indent=2, sort_keys=True) + '\n')
+
+
+def save_prometheus_textfile(report, path, prefix='backup_to_dropbox'):
+    """Saves ``report`` in the text format read by the textfile collector of the node exporter.
+
+    The file is replaced atomically so the collector never reads half of it.
+    """
+    labels = {'backup': report.get('backup_name', '')}
+    lines = []
+
+    def metric(name, help_text, metric_type, values):
+        lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+        lines.append('# TYPE {}_{} {}'.format(prefix, name, metric_type))
+        for suffix, extra_labels, value in values:
+            lines.append('{}_{}{}{{{}}} {}'.format(prefix,
+                                                   name,
+                                                   suffix,
+                                                   _format_labels(dict(labels, **extra_labels)),
+                                                   repr(float(value))))
+
+    metric('last_run_timestamp_seconds', 'Time the last backup run started.', 'gauge',
+           [('', {}, report['start_timestamp'])])
+    metric('last_run_success', 'Whether the last backup run succeeded.', 'gauge',
+           [('', {}, 1 if report.get('succeeded') else 0)])
+    metric('duration_seconds', 'Wall time of the last backup run.', 'gauge',
+           [('', {}, report['wall_time'])])
+    metric('cpu_seconds', 'CPU time used by the last backup run.', 'gauge',
+           [('', {'mode': mode}, value) for mode, value in sorted(report['cpu_time'].items())])
+    metric('peak_rss_bytes', 'Peak resident memory of the last backup run.', 'gauge',
+           [('', {}, report['peak_rss_bytes'])])
+    stages = sorted(report['stages'].items())
+    for field, name, help_text in [
+            ('wall_time', 'stage_wall_seconds', 'Wall time spent in each stage.'),
+            ('cpu_time', 'stage_cpu_seconds', 'CPU time of the threads running each stage.'),
+            ('bytes_in', 'stage_bytes_in', 'Bytes consumed by each stage.'),
+            ('bytes_out', 'stage_bytes_out', 'Bytes produced by each stage.')]:
+        metric(name, help_text, 'gauge',
+               [('', {'stage': stage}, stats[field]) for stage, stats in stages])
+    for counter, value in sorted(report['counters'].items()):
+        metric(counter, 'Number of {} in the last backup run.'.format(counter.replace('_', ' ')),
+               'gauge', [('', {}, value)])
+    for name, summary in sorted(report['samples'].items()):
+        values = [('', {'quantile': quantile}, value)
+                  for quantile, value in sorted(summary['quantiles'].items())]
+        values.append(('_sum', {}, summary['sum']))
+        values.append(('_count', {}, summary['count']))
+        metric(name, 'Distribution of {} in the last backup run.'.format(name.replace('_', ' ')),
+               'summary', values)
+    _write_atomically(path, '\n'.join(lines) + '\n')
+
+
+def _format_labels(labels):
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\')
+                                                     .replace('"', r'\"')
+                                                     .replace('\n', r'\n'))
+                    for name, value in sorted(labels.items()))
+
+
+def _write_atomically(path, content):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as output_file:
+        output_file.write(content)
+    os.replace(temp_path, path)
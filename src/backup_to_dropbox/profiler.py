@@ -0,0 +1,52 @@
+import collections
+import os.path
+import sys
+import threading
+
+
+class SamplingProfiler:
+    """Samples the stack of every thread each ``interval`` seconds.
+
+    Unlike cProfile, it sees the threads generating, compressing and
+    uploading the archive, and its overhead doesn't depend on the number of
+    function calls. Samples are taken in wall time, so threads waiting for
+    I/O or for each other show up too. They are saved in the collapsed
+    stack format read by ``flamegraph.pl`` and speedscope.
+    """
+
+    DEFAULT_INTERVAL = 0.01 # seconds
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.__interval = interval
+        self.__samples = collections.Counter()
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__sample, name='profiler', daemon=True)
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        self.__thread.join()
+
+    def save(self, path):
+        with open(path, 'w') as output_file:
+            for stack, count in sorted(self.__samples.items()):
+                output_file.write('{} {}\n'.format(stack, count))
+
+    def __sample(self):
+        own_id = threading.get_ident()
+        while not self.__stop.wait(self.__interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(code.co_name,
+                                                     os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, 'thread-{}'.format(thread_id)))
+                self.__samples[';'.join(reversed(stack))] += 1
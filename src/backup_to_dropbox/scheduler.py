@@ -0,0 +1,200 @@
+import contextlib
+import logging
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+
+class CronSchedule:
+    """Times matching a cron expression: minute, hour, day of month, month and day of week.
+
+    Fields take ``*``, numbers, ranges (``1-5``), steps (``*/15``, ``0-30/10``)
+    and lists of them (``1,15``). Like cron, when both the day of the month
+    and the day of the week are restricted, a day matching either of them
+    matches. ``@hourly``, ``@daily``, ``@weekly`` and ``@monthly`` are
+    accepted too.
+    """
+
+    ALIASES = {'@hourly': '0 * * * *',
+               '@daily': '0 0 * * *',
+               '@weekly': '0 0 * * 0',
+               '@monthly': '0 0 1 * *'}
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+    MAX_YEARS = 5
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = CronSchedule.ALIASES.get(expression, expression).split()
+        if len(fields) != len(CronSchedule.FIELDS):
+            raise ValueError('Invalid schedule "{}": it must have 5 fields'.format(expression))
+        values = [CronSchedule._parse_field(field, low, high, expression)
+                  for field, (low, high) in zip(fields, CronSchedule.FIELDS)]
+        self.__minutes, self.__hours, self.__days, self.__months, weekdays = values
+        # Both 0 and 7 are Sunday, which is 6 for datetime.weekday().
+        self.__weekdays = {(weekday - 1) % 7 for weekday in weekdays}
+        self.__any_day = fields[2].startswith('*')
+        self.__any_weekday = fields[4].startswith('*')
+
+    def next_after(self, moment):
+        """Returns the first time of the schedule after ``moment``, to the minute."""
+        candidate = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * CronSchedule.MAX_YEARS)
+        while candidate < limit:
+            if candidate.month not in self.__months:
+                candidate = (candidate.replace(day=1, hour=0, minute=0) +
+                             timedelta(days=31)).replace(day=1)
+            elif not self.__matches_day(candidate):
+                candidate = candidate.replace(hour=0, minute=0) + timedelta(days=1)
+            elif candidate.hour not in self.__hours:
+                candidate = candidate.replace(minute=0) + timedelta(hours=1)
+            elif candidate.minute not in self.__minutes:
+                candidate += timedelta(minutes=1)
+            else:
+                return candidate
+        raise ValueError('Schedule "{}" never matches'.format(self.expression))
+
+    def __matches_day(self, candidate):
+        day_matches = candidate.day in self.__days
+        weekday_matches = candidate.weekday() in self.__weekdays
+        if self.__any_day or self.__any_weekday:
+            return day_matches and weekday_matches
+        return day_matches or weekday_matches
+
+    @staticmethod
+    def _parse_field(field, low, high, expression):
+        values = set()
+        for part in field.split(','):
+            value_range, _, step = part.partition('/')
+            try:
+                if value_range == '*':
+                    start, end = low, high
+                else:
+                    start, _, end = value_range.partition('-')
+                    start = int(start)
+                    end = int(end) if end else (high if step else start)
+                step = int(step) if step else 1
+            except ValueError:
+                raise ValueError('Invalid schedule "{}": bad field "{}"'.format(expression, field))
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError('Invalid schedule "{}": field "{}" is out of range'.format(
+                    expression, field))
+            values.update(range(start, end + 1, step))
+        return values
+
+
+class Job:
+    """Task the ``Scheduler`` runs at the times of its ``CronSchedule``.
+
+    Among the jobs due at the same time, those with a higher ``priority``
+    start first.
+    """
+
+    def __init__(self, name, schedule, run, priority=0):
+        self.name = name
+        self.schedule = schedule
+        self.run = run
+        self.priority = priority
+        self.next_run = None
+        self.running = False
+
+
+class Scheduler:
+    """Runs jobs at their scheduled times from a pool of at most ``max_concurrent_jobs`` threads.
+
+    A due job waits for a free thread when all of them are busy. A job is
+    never run twice at the same time: if it's still running when it's due
+    again, it runs once more as soon as it finishes, however many runs were
+    missed. A failed run is logged and the job runs again at its next time.
+    """
+
+    MAX_WAIT = 60 # seconds, so changes of the clock are noticed
+
+    def __init__(self, jobs, max_concurrent_jobs=1, clock=datetime.now):
+        self.__jobs = list(jobs)
+        self.__max_concurrent_jobs = max(1, max_concurrent_jobs)
+        self.__clock = clock
+        self.__condition = threading.Condition()
+        self.__stopped = False
+
+    def run(self):
+        """Runs the jobs until ``stop`` is called, and waits for the running ones to finish."""
+        now = self.__clock()
+        for job in self.__jobs:
+            job.next_run = job.schedule.next_after(now)
+            logging.info('Job %s will run at %s', job.name, job.next_run)
+        with ThreadPoolExecutor(max_workers=self.__max_concurrent_jobs,
+                                thread_name_prefix='job') as executor:
+            with self.__condition:
+                running = 0
+                while not self.__stopped:
+                    now = self.__clock()
+                    due = sorted((job for job in self.__jobs
+                                  if not job.running and job.next_run <= now),
+                                 key=lambda job: (-job.priority, job.next_run))
+                    for job in due[:self.__max_concurrent_jobs - running]:
+                        job.running = True
+                        job.next_run = job.schedule.next_after(now)
+                        running += 1
+                        executor.submit(self.__run_job, job)
+                    idle = [job.next_run for job in self.__jobs if not job.running]
+                    timeout = Scheduler.MAX_WAIT
+                    if idle and running < self.__max_concurrent_jobs:
+                        timeout = min(timeout, (min(idle) - now).total_seconds())
+                    self.__condition.wait(max(timeout, 0))
+                    running = sum(job.running for job in self.__jobs)
+
+    def stop(self):
+        """Makes ``run`` return once the running jobs finish, without starting any more."""
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify_all()
+
+    def __run_job(self, job):
+        logging.info('Starting job %s', job.name)
+        try:
+            job.run()
+            logging.info('Job %s finished', job.name)
+        except Exception:
+            logging.exception('Job %s failed', job.name)
+        finally:
+            with self.__condition:
+                job.running = False
+                logging.info('Job %s will run at %s', job.name, job.next_run)
+                self.__condition.notify_all()
+
+
+class DiskSlots:
+    """Limits how many jobs read from the same disk at the same time.
+
+    Disks are told apart by the device of the paths. ``hold`` waits for a
+    slot of every disk of the paths, so jobs reading from different disks
+    don't wait for each other.
+    """
+
+    def __init__(self, slots_per_disk=1):
+        self.__slots_per_disk = max(1, slots_per_disk)
+        self.__lock = threading.Lock()
+        self.__slots = {}
+
+    @contextlib.contextmanager
+    def hold(self, paths):
+        devices = set()
+        for path in paths:
+            try:
+                devices.add(os.stat(path).st_dev)
+            except FileNotFoundError:
+                continue
+        with contextlib.ExitStack() as stack:
+            # Always in the same order, so two jobs can't wait for each other.
+            for device in sorted(devices):
+                stack.enter_context(self.__device_slots(device))
+            yield
+
+    def __device_slots(self, device):
+        with self.__lock:
+            slots = self.__slots.get(device)
+            if slots is None:
+                slots = self.__slots[device] = threading.BoundedSemaphore(self.__slots_per_disk)
+            return slots
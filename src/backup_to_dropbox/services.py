@@ -1,55 +1,724 @@
+import collections
+import contextlib
+import copy
+import functools
+import gzip
+import hashlib
+import io
+import json
 import logging
+import multiprocessing
 import os
 import os.path
+import re
+import shutil
+import stat
+import subprocess
 import tarfile
+import threading
+import time
+import zlib
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from tempfile import TemporaryDirectory, NamedTemporaryFile, TemporaryFile
+from tempfile import SpooledTemporaryFile, TemporaryDirectory, TemporaryFile, mkstemp
+
+from dropbox.exceptions import ApiError
+
+from backup_to_dropbox.clients import ContentHasher, UploadSessionState
+from backup_to_dropbox.compression import GzipCodec, NoCompressionCodec
+from backup_to_dropbox.dedup import ChunkStore, ContentDefinedChunker, Snapshot
+from backup_to_dropbox.index import ArchiveIndex, ArchiveIndexBuilder
+from backup_to_dropbox.metrics import MeteredWriter, RunMetrics, thread_time
+from backup_to_dropbox.sparse import add_sparse_file, data_extents
+from backup_to_dropbox.streams import ChunkPipe, ForwardSeekReader, HashingWriter, PrefetchReader
+from backup_to_dropbox.walker import ExcludeMatcher, FileWalker, forget_inode, make_tarinfo
 
 
 
 class BackupService:
 
-    def __init__(self, dropbox_client, backup_name, encryption_service=None):
+    TIMESTAMP_FORMAT = r'%Y-%m-%d-%H%M'
+    BACKUP_NAME_RE = re.compile(r'^(\d{4}-\d{2}-\d{2}-\d{4})[.-]')
+    INCREMENTAL_SUFFIX = '.incr'
+    MANIFEST_SUFFIX = '.manifest.gz'
+    SNAPSHOT_SUFFIX = '.snapshot'
+    VOLUME_FORMAT = '-part{:04d}'
+    VOLUMES_SUFFIX = '.volumes.json'
+    VOLUME_ENTRY_OVERHEAD = 512 # bytes
+    INDEX_SUFFIX = '.index'
+    DELETED_PATHS_MEMBER = '.backup-to-dropbox-deleted'
+    PENDING_UPLOAD_FILE = 'pending-upload'
+    PENDING_UPLOAD_STATE_FILE = 'pending-upload.json'
+
+    def __init__(self, dropbox_client, backup_name, encryption_service=None,
+                 streaming=False, stream_buffer_size=ChunkPipe.DEFAULT_MAX_BUFFER_SIZE,
+                 codec=None, compress_level=None, compress_threads=1,
+                 incremental_state=None, chunk_store=None, resume_dir=None, metrics=None,
+                 exclude_patterns=(), walk_threads=FileWalker.DEFAULT_THREADS,
+                 volume_size=None, volume_workers=None, seekable=False, skip_unchanged=False,
+                 disk_slots=None):
         self.__dropbox_client = dropbox_client
         self.__base_dir = os.path.join('/', backup_name)
         self.__encryption_service = encryption_service
+        self.__streaming = streaming
+        self.__stream_buffer_size = stream_buffer_size
+        self.__codec = codec if codec is not None else GzipCodec()
+        self.__compress_level = compress_level
+        self.__compress_threads = compress_threads
+        self.__incremental_state = incremental_state
+        self.__chunk_store = chunk_store
+        self.__resume_dir = resume_dir
+        self.__metrics = metrics if metrics is not None else RunMetrics()
+        self.__exclude_matcher = ExcludeMatcher(exclude_patterns) if exclude_patterns else None
+        self.__walk_threads = walk_threads
+        self.__volume_size = volume_size
+        self.__volume_workers = volume_workers or os.cpu_count() or 1
+        self.__seekable = seekable
+        self.__skip_unchanged = skip_unchanged
+        self.__disk_slots = disk_slots
 
     def backup_paths(self, paths):
+        if self.__resume_dir is not None:
+            self._resume_pending_upload()
         execution_time = BackupService.now()
-        backup_file = self._generate_backup_file(paths)
-        filename = '{}.tar.gz'.format(execution_time.strftime(r'%Y-%m-%d-%H%M'))
+        timestamp = execution_time.strftime(BackupService.TIMESTAMP_FORMAT)
+        tracker = None
+        if self.__incremental_state is not None:
+            tracker = self.__incremental_state.start()
+
+        try:
+            if self.__chunk_store is not None:
+                self._upload_snapshot(paths, timestamp, tracker)
+            elif self.__volume_size is not None:
+                self._upload_volumes(paths, timestamp, tracker)
+            else:
+                self._upload_archive(paths, timestamp, tracker)
+            if tracker is not None:
+                tracker.close()
+                self._upload_manifest(tracker.manifest_path, timestamp)
+                tracker.commit()
+        finally:
+            if tracker is not None:
+                tracker.discard()
+
+    def _upload_archive(self, paths, timestamp, tracker):
+        producer = None
+        index = ArchiveIndexBuilder() if self.__seekable else None
+        # Encrypted archives differ every time, and the hash of a stream is known too late.
+        content_hasher = None
+        if self.__skip_unchanged and not self.__streaming and self.__encryption_service is None:
+            content_hasher = ContentHasher()
+        if self.__streaming or self.__resume_dir is not None:
+            # To resume, the archive is piped to the staged file: that's its only copy on disk.
+            backup_file, producer = self._generate_backup_stream(paths, tracker, index=index)
+        else:
+            backup_file = self._generate_backup_file(paths, tracker, index, content_hasher)
+        filename = timestamp
+        if tracker is not None and not tracker.is_full:
+            filename += BackupService.INCREMENTAL_SUFFIX
+        filename += self.__codec.extension
+
+        archive_file = backup_file
+        try:
+            if self.__encryption_service is not None:
+                backup_file = self.__encryption_service.encrypt_stream(archive_file)
+                filename += '.enc'
+
+            if self.__resume_dir is not None:
+                self._stage_upload(backup_file, content_hasher)
+            if content_hasher is None or \
+                    not self._copy_unchanged(timestamp, filename, content_hasher):
+                logging.info('Uploading backup: %s', self._get_dropbox_path(filename))
+                if self.__resume_dir is None:
+                    self.__dropbox_client.upload_file(backup_file,
+                                                      self._get_dropbox_path(filename))
+                else:
+                    self._upload_pending(self._get_dropbox_path(filename))
+            elif self.__resume_dir is not None:
+                os.remove(os.path.join(self.__resume_dir, BackupService.PENDING_UPLOAD_FILE))
+        finally:
+            backup_file.close()
+            archive_file.close()
+            if producer is not None:
+                producer.join()
+
+        if index is not None:
+            self._upload_index(index.build(), filename)
+
+    def _copy_unchanged(self, timestamp, filename, content_hasher):
+        """Copies the archive of the newest backup as ``filename`` if it's the same as this one.
+
+        Archives are compared by their content hash, which Dropbox lists
+        with the files. Returns whether the archive was copied, so it doesn't
+        have to be uploaded.
+        """
+        content_hashes = self.__dropbox_client.list_content_hashes(self.__base_dir)
+        backups = [backup for backup in BackupService._group_backups(content_hashes)
+                   if backup[0] < timestamp]
+        if not backups:
+            return False
+        previous = backups[-1][0] + filename[len(timestamp):]
+        content_hash = content_hasher.hexdigest()
+        if content_hashes.get(previous) != content_hash:
+            return False
+        logging.info('Backup is unchanged since %s: copying it to %s',
+                     backups[-1][0],
+                     self._get_dropbox_path(filename))
+        try:
+            self.__dropbox_client.copy_file(self._get_dropbox_path(previous),
+                                            self._get_dropbox_path(filename),
+                                            content_hash)
+        except ApiError as e:
+            # E.g. the previous backup was deleted by the cleanup in the meantime.
+            logging.warning('Failed to copy %s (%s): uploading the backup instead', previous, e)
+            return False
+        self.__metrics.increment('unchanged_bytes_not_uploaded', content_hasher.size)
+        return True
+
+    def _upload_index(self, index, archive_filename):
+        filename = archive_filename + BackupService.INDEX_SUFFIX
+        logging.info('Uploading archive index: %s', self._get_dropbox_path(filename))
+        self.__dropbox_client.upload_file(io.BytesIO(index.to_bytes()),
+                                          self._get_dropbox_path(filename))
+
+    def _stage_upload(self, backup_file, content_hasher=None):
+        """Writes the file to upload in ``resume_dir`` so an interrupted upload can be resumed.
+
+        ``content_hasher`` is updated with the file as it's written.
+        """
+        staged_path = os.path.join(self.__resume_dir, BackupService.PENDING_UPLOAD_FILE)
+        try:
+            with open(staged_path, 'wb') as staged_file:
+                output = staged_file if content_hasher is None else \
+                    HashingWriter(staged_file, content_hasher)
+                shutil.copyfileobj(backup_file, output, 1024 * 1024)
+        except BaseException:
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
+            raise
+
+    def _upload_pending(self, dropbox_path):
+        staged_path = os.path.join(self.__resume_dir, BackupService.PENDING_UPLOAD_FILE)
+        session_state = UploadSessionState(os.path.join(self.__resume_dir,
+                                                        BackupService.PENDING_UPLOAD_STATE_FILE))
+        with open(staged_path, 'rb') as staged_file:
+            self.__dropbox_client.upload_file(staged_file,
+                                              dropbox_path,
+                                              session_state=session_state)
+        os.remove(staged_path)
+        session_state.clear()
 
+    def _resume_pending_upload(self):
+        """Finishes the upload interrupted in a previous run, if there's any."""
+        staged_path = os.path.join(self.__resume_dir, BackupService.PENDING_UPLOAD_FILE)
+        if not os.path.exists(staged_path):
+            return
+        saved = UploadSessionState(os.path.join(self.__resume_dir,
+                                                BackupService.PENDING_UPLOAD_STATE_FILE)).load()
+        if saved is None:
+            logging.warning('Discarding pending upload without session state')
+            os.remove(staged_path)
+            return
+        if self._is_uploaded(staged_path, saved['path']):
+            # The upload was committed but its response got lost.
+            logging.info('Interrupted upload of %s had completed', saved['path'])
+            os.remove(staged_path)
+            UploadSessionState(os.path.join(self.__resume_dir,
+                                            BackupService.PENDING_UPLOAD_STATE_FILE)).clear()
+            return
+        logging.info('Resuming interrupted upload: %s', saved['path'])
+        self._upload_pending(saved['path'])
+
+    def _is_uploaded(self, staged_path, dropbox_path):
+        """Returns whether ``dropbox_path`` exists with the content of the staged file."""
+        content_hash = self.__dropbox_client.list_content_hashes(
+            os.path.dirname(dropbox_path)).get(os.path.basename(dropbox_path))
+        if content_hash is None:
+            return False
+        content_hasher = ContentHasher()
+        with open(staged_path, 'rb') as staged_file:
+            for block in iter(lambda: staged_file.read(ContentHasher.BLOCK_SIZE), b''):
+                content_hasher.update(block)
+        return content_hasher.hexdigest() == content_hash
+
+    def _upload_snapshot(self, paths, timestamp, tracker):
+        """Stores the uncompressed archive as deduplicated chunks and uploads its snapshot."""
+        archive_stream, producer = self._generate_backup_stream(paths,
+                                                                tracker,
+                                                                codec=NoCompressionCodec())
+        try:
+            snapshot = self.__chunk_store.store(self.__base_dir,
+                                                ContentDefinedChunker().split(archive_stream))
+        finally:
+            archive_stream.close()
+            producer.join()
+
+        filename = timestamp
+        if tracker is not None and not tracker.is_full:
+            filename += BackupService.INCREMENTAL_SUFFIX
+        filename += BackupService.SNAPSHOT_SUFFIX
+        logging.info('Uploading snapshot: %s', self._get_dropbox_path(filename))
+        self.__dropbox_client.upload_file(io.BytesIO(snapshot.to_bytes()),
+                                          self._get_dropbox_path(filename))
+
+    def _upload_volumes(self, paths, timestamp, tracker):
+        """Uploads the backup as self-contained archives of about ``volume_size`` input bytes.
+
+        Volumes are built by a pool of worker processes while the paths are
+        still being walked, and each one is uploaded as soon as it's built.
+        The JSON file listing the volumes is uploaded last, so its presence
+        tells the backup is complete. Volumes already uploaded are deleted if
+        the backup fails.
+        """
+        suffix = BackupService.INCREMENTAL_SUFFIX if tracker is not None and not tracker.is_full \
+            else ''
+        suffix += self.__codec.extension
+        if self.__encryption_service is not None:
+            suffix += '.enc'
+        slots = threading.BoundedSemaphore(2 * self.__volume_workers)
+        futures = []
+        uploaded = []
+
+        def submit(number, entries, deleted_paths_path=None):
+            slots.acquire()
+            for future in futures:
+                if future.done() and future.exception() is not None:
+                    raise future.exception()
+            filename = timestamp + BackupService.VOLUME_FORMAT.format(number) + suffix
+            futures.append(uploaders.submit(self._upload_volume,
+                                            pool,
+                                            volume_dir,
+                                            filename,
+                                            entries,
+                                            deleted_paths_path,
+                                            slots,
+                                            uploaded))
+
+        with TemporaryDirectory() as volume_dir, \
+                multiprocessing.get_context('spawn').Pool(self.__volume_workers) as pool, \
+                ThreadPoolExecutor(max_workers=2 * self.__volume_workers) as uploaders, \
+                self._hold_disks(paths):
+            try:
+                volumes = self._partition(self._walk(paths, tracker))
+                # One volume of look-ahead tells which one gets the deleted paths.
+                entries = next(volumes)
+                number = 1
+                for next_entries in volumes:
+                    submit(number, entries)
+                    number += 1
+                    entries = next_entries
+                deleted_paths_path = None
+                if tracker is not None:
+                    deleted_paths_path = os.path.join(volume_dir, 'deleted-paths')
+                    with open(deleted_paths_path, 'wb') as deleted_paths:
+                        BackupService._write_deleted_paths(deleted_paths, tracker)
+                submit(number, entries, deleted_paths_path)
+                results = [future.result() for future in futures]
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                for future in futures:
+                    if not future.cancelled():
+                        future.exception()
+                if uploaded:
+                    self._delete_partial_backup(uploaded)
+                raise
+
+        self._upload_volume_list(timestamp, results)
+
+    def _partition(self, entries):
+        """Yields lists of entries adding up to at most ``volume_size`` bytes (at least one)."""
+        volume = []
+        volume_size = 0
+        for entry in entries:
+            entry_size = BackupService.VOLUME_ENTRY_OVERHEAD
+            if BackupService._may_be_sparse(entry.stat):
+                # Only the data of sparse files is archived.
+                entry_size += entry.stat.st_blocks * 512
+            elif stat.S_ISREG(entry.stat.st_mode):
+                entry_size += entry.stat.st_size
+            if volume and volume_size + entry_size > self.__volume_size:
+                yield volume
+                volume = []
+                volume_size = 0
+            volume.append(entry)
+            volume_size += entry_size
+        yield volume
+
+    def _upload_volume(self, pool, volume_dir, filename, entries, deleted_paths_path, slots,
+                       uploaded):
+        volume_path = os.path.join(volume_dir, filename)
+        try:
+            report = pool.apply(BackupService._build_volume, (volume_path,
+                                                              entries,
+                                                              self.__codec,
+                                                              self.__compress_level,
+                                                              self.__compress_threads,
+                                                              deleted_paths_path))
+            self.__metrics.add_stages(report['stages'])
+            self.__metrics.add_counters(report['counters'])
+            with open(volume_path, 'rb') as volume_file:
+                upload_file = volume_file
+                if self.__encryption_service is not None:
+                    upload_file = self.__encryption_service.encrypt_stream(volume_file)
+                try:
+                    logging.info('Uploading volume: %s', self._get_dropbox_path(filename))
+                    self.__dropbox_client.upload_file(upload_file, self._get_dropbox_path(filename))
+                finally:
+                    upload_file.close()
+            uploaded.append(self._get_dropbox_path(filename))
+            return {'name': filename,
+                    'entries': len(entries),
+                    'size': report['stages']['archive']['bytes_in'],
+                    'archive_size': report['stages']['archive']['bytes_out'],
+                    'first_path': entries[0].path if entries else None,
+                    'last_path': entries[-1].path if entries else None}
+        finally:
+            if os.path.exists(volume_path):
+                os.remove(volume_path)
+            slots.release()
+
+    @staticmethod
+    def _build_volume(volume_path, entries, codec, compress_level, compress_threads,
+                      deleted_paths_path=None):
+        """Writes the archive of a volume. Runs in a worker process and returns its metrics."""
+        metrics = RunMetrics()
+        finish = None if deleted_paths_path is None else \
+            functools.partial(BackupService._add_deleted_paths_file, deleted_paths_path)
+        with open(volume_path, 'wb') as volume_file:
+            BackupService._write_entries(volume_file,
+                                         entries,
+                                         codec,
+                                         compress_level,
+                                         compress_threads,
+                                         metrics,
+                                         finish)
+        return metrics.report()
+
+    def _upload_volume_list(self, timestamp, volumes):
+        filename = timestamp + BackupService.VOLUMES_SUFFIX
+        volume_list = TemporaryFile()
+        volume_list.write(json.dumps({'volumes': volumes}, indent=2).encode('utf-8'))
+        volume_list.seek(0)
         if self.__encryption_service is not None:
-            backup_file = self.__encryption_service.encrypt(backup_file)
+            volume_list = self.__encryption_service.encrypt(volume_list)
             filename += '.enc'
+        logging.info('Uploading volume list: %s', self._get_dropbox_path(filename))
+        with volume_list:
+            self.__dropbox_client.upload_file(volume_list, self._get_dropbox_path(filename))
+
+    def _delete_partial_backup(self, dropbox_paths):
+        logging.warning('Deleting %d volumes of the failed backup', len(dropbox_paths))
+        try:
+            self.__dropbox_client.delete_files(dropbox_paths)
+        except Exception as e:
+            logging.error('Failed to delete the volumes of the failed backup: %s', e)
 
-        logging.info('Uploading backup: %s', self._get_dropbox_path(filename))
-        self.__dropbox_client.upload_file(backup_file, self._get_dropbox_path(filename))
+    def _upload_manifest(self, manifest_path, timestamp):
+        filename = timestamp + BackupService.MANIFEST_SUFFIX
+        manifest_file = TemporaryFile()
+        with open(manifest_path, 'rb') as raw_manifest, \
+                gzip.GzipFile(fileobj=manifest_file, mode='wb') as compressed_manifest:
+            shutil.copyfileobj(raw_manifest, compressed_manifest)
 
+        if self.__encryption_service is not None:
+            manifest_file = self.__encryption_service.encrypt(manifest_file)
+            filename += '.enc'
+
+        logging.info('Uploading manifest: %s', self._get_dropbox_path(filename))
+        self.__dropbox_client.upload_file(manifest_file, self._get_dropbox_path(filename))
 
     def cleanup_old_backups(self, max_to_keep):
-        current_backups = self.__dropbox_client.list_files(self.__base_dir)
+        """Deletes the oldest backups so at most ``max_to_keep`` of them are left.
+
+        All the files generated by the same run (archive or volumes, manifest) are
+        considered a single backup. A full backup is never deleted while an
+        incremental backup which depends on it is kept, nor when the next
+        backup is going to be an incremental one on top of it.
+
+        It's safe to run it while a backup is being generated: backups from
+        the current minute onwards are ignored.
+        """
+        next_is_incremental = self.__incremental_state is not None and \
+            not self.__incremental_state.next_is_full()
+        cutoff = BackupService.now().strftime(BackupService.TIMESTAMP_FORMAT)
+        backups = [backup for backup in self._list_backups() if backup[0] < cutoff]
+
+        if len(backups) > max_to_keep:
+            backups_to_delete = len(backups) - max_to_keep
+            oldest_needed = BackupService._find_full_backup(backups, backups_to_delete)
+            if next_is_incremental:
+                oldest_needed = min(oldest_needed,
+                                    BackupService._find_full_backup(backups, len(backups) - 1))
+            if oldest_needed < backups_to_delete:
+                logging.info('Keeping %d extra backups needed by incremental backups',
+                             backups_to_delete - oldest_needed)
+                backups_to_delete = oldest_needed
 
-        if len(current_backups) > max_to_keep:
-            files_to_delete = len(current_backups) - max_to_keep
             logging.info('Found %d backups: removing the oldes %d',
-                         len(current_backups),
-                         files_to_delete)
-            current_backups.sort()
-            for file in current_backups[:files_to_delete]:
-                logging.info('Deleting file: %s', self._get_dropbox_path(file))
-                self.__dropbox_client.delete_file(self._get_dropbox_path(file))
-
-    def _generate_backup_file(self, paths):
-        raw_file = TemporaryFile()
-        with tarfile.open(fileobj=raw_file, mode='w:gz') as targz_file:
-            for path in filter(lambda p: BackupService.isfile(p) or BackupService.isdir(p), paths):
-                logging.debug('Adding path "%s" to backup', path)
-                targz_file.add(path)
+                         len(backups),
+                         backups_to_delete)
+            files_to_delete = []
+            for timestamp, files in backups[:backups_to_delete]:
+                for file in files:
+                    logging.info('Deleting file: %s', self._get_dropbox_path(file))
+                    files_to_delete.append(self._get_dropbox_path(file))
+            self.__dropbox_client.delete_files(files_to_delete)
+
+            if self.__chunk_store is not None and backups_to_delete > 0:
+                self._collect_garbage(backups[backups_to_delete:])
+
+    def _collect_garbage(self, kept_backups):
+        kept_snapshots = []
+        for timestamp, files in kept_backups:
+            for file in files:
+                if file.endswith(BackupService.SNAPSHOT_SUFFIX):
+                    snapshot_data = self.__dropbox_client.download_file(self._get_dropbox_path(file))
+                    kept_snapshots.append(Snapshot.from_bytes(snapshot_data))
+        self.__chunk_store.collect_garbage(self.__base_dir, kept_snapshots)
 
+    def _list_backups(self):
+        return BackupService._group_backups(self.__dropbox_client.list_files(self.__base_dir))
+
+    @staticmethod
+    def _group_backups(files):
+        """Returns ``(timestamp, files)`` tuples for every backup, sorted from oldest to newest."""
+        backups = {}
+        for file in files:
+            match = BackupService.BACKUP_NAME_RE.match(file)
+            if match is None:
+                continue
+            backups.setdefault(match.group(1), []).append(file)
+        return sorted((timestamp, sorted(files)) for timestamp, files in backups.items())
+
+    @staticmethod
+    def _find_full_backup(backups, index):
+        """Returns the index of the full backup the one at ``index`` depends on."""
+        if index >= len(backups) or index < 0:
+            return index
+        while index > 0 and BackupService._is_incremental(backups[index][1]):
+            index -= 1
+        return index
+
+    @staticmethod
+    def _is_incremental(files):
+        return any(BackupService.INCREMENTAL_SUFFIX + '.' in file for file in files)
+
+    def _generate_backup_file(self, paths, tracker=None, index=None, content_hasher=None):
+        """Writes the archive to a temporary file.
+
+        If an ``ArchiveIndexBuilder`` is given as ``index``, the archive is
+        written in the seekable format of the codec and its members are added
+        to ``index``. ``content_hasher`` is updated with the archive as it's
+        written.
+        """
+        raw_file = TemporaryFile()
+        output = raw_file if content_hasher is None else HashingWriter(raw_file, content_hasher)
+        self._write_archive(output, paths, tracker, index=index)
         return raw_file
 
+    def _generate_backup_stream(self, paths, tracker=None, codec=None, index=None):
+        """Starts writing the archive from a background thread.
+
+        Returns the readable end of the pipe the archive is written to and the
+        producer thread. Errors while generating the archive are raised from
+        the reader, so the upload never commits an incomplete archive.
+        """
+        pipe = ChunkPipe(self.__stream_buffer_size)
+
+        def produce():
+            try:
+                self._write_archive(pipe.writer, paths, tracker, codec, index)
+                pipe.writer.close()
+            except BaseException as e:
+                logging.error('Failed to generate backup stream: %s', e)
+                pipe.writer.abort(e)
+
+        producer = threading.Thread(target=produce, name='backup-archiver', daemon=True)
+        producer.start()
+        return pipe.reader, producer
+
+    def _write_archive(self, fileobj, paths, tracker=None, codec=None, index=None):
+        finish = None
+        if tracker is not None:
+            finish = functools.partial(BackupService._add_deleted_paths, tracker=tracker)
+        with self._hold_disks(paths):
+            BackupService._write_entries(fileobj,
+                                         self._walk(paths, tracker),
+                                         codec if codec is not None else self.__codec,
+                                         self.__compress_level,
+                                         self.__compress_threads,
+                                         self.__metrics,
+                                         finish,
+                                         index)
+
+    @contextlib.contextmanager
+    def _hold_disks(self, paths):
+        """Holds the ``disk_slots`` of the disks of ``paths`` while they are read, if given.
+
+        The time spent waiting for them is recorded as the ``disk_wait`` stage.
+        """
+        if self.__disk_slots is None:
+            yield
+            return
+        start_time = time.perf_counter()
+        with self.__disk_slots.hold(paths):
+            self.__metrics.add_time('disk_wait', time.perf_counter() - start_time, calls=1)
+            yield
+
+    @staticmethod
+    def _write_entries(fileobj, entries, codec, compress_level, compress_threads, metrics,
+                       finish=None, index=None):
+        """Writes an archive of ``entries`` into ``fileobj``.
+
+        ``finish`` is called with the tar file once all the entries have been
+        added, to add any extra member. The offset of every entry and the
+        blocks of the seekable output are recorded in ``index``, if given.
+        """
+        start_time = time.perf_counter()
+        start_cpu_time = thread_time()
+        output = MeteredWriter(fileobj)
+        if index is not None:
+            compressed_file = codec.open_seekable_writer(output, compress_level, compress_threads)
+        else:
+            compressed_file = codec.open_writer(output, compress_level, compress_threads)
+        archive_input = MeteredWriter(compressed_file)
+        try:
+            with compressed_file, tarfile.open(fileobj=archive_input, mode='w|') as targz_file:
+                for entry in entries:
+                    offset = targz_file.offset
+                    tarinfo = BackupService._add_entry(targz_file, entry, metrics)
+                    if index is not None and tarinfo is not None:
+                        index.add(tarinfo.name, offset)
+                if finish is not None:
+                    offset = targz_file.offset
+                    finish(targz_file)
+                    if index is not None and targz_file.offset > offset:
+                        index.add(BackupService.DELETED_PATHS_MEMBER, offset)
+            if index is not None:
+                index.blocks = compressed_file.blocks
+        finally:
+            BackupService._record_archive_metrics(metrics,
+                                                  time.perf_counter() - start_time,
+                                                  thread_time() - start_cpu_time,
+                                                  archive_input,
+                                                  output)
+
+    @staticmethod
+    def _record_archive_metrics(metrics, wall_time, cpu_time, archive_input, output):
+        """Splits the time spent generating the archive between its stages.
+
+        ``archive_input`` measured the writes of the tar stream into the
+        compressor, and ``output`` the writes of the compressor into the
+        temporary file or the stream being uploaded (i.e. waiting for the
+        upload). What's left is walking the paths and reading the files.
+        """
+        metrics.add_time('archive', wall_time, cpu_time, calls=1)
+        metrics.add_bytes('archive', archive_input.bytes_written, output.bytes_written)
+        metrics.add_time('walk',
+                         wall_time - archive_input.wall_time,
+                         cpu_time - archive_input.cpu_time)
+        metrics.add_time('compress',
+                         archive_input.wall_time - output.wall_time,
+                         archive_input.cpu_time - output.cpu_time)
+        metrics.add_bytes('compress', archive_input.bytes_written, output.bytes_written)
+        metrics.add_time('archive_output', output.wall_time, output.cpu_time)
+        metrics.add_bytes('archive_output', bytes_out=output.bytes_written)
+
+    def _walk(self, paths, tracker=None):
+        """Yields the entries to archive under ``paths``, skipping excluded and unchanged files."""
+        walker = FileWalker(self.__exclude_matcher, self.__walk_threads)
+        roots = [path for path in paths if BackupService.isfile(path) or BackupService.isdir(path)]
+        archived, skipped = 0, 0
+        for entry in walker.walk(roots):
+            if tracker is not None and not tracker.has_changed(entry.path, entry.stat):
+                skipped += 1
+                continue
+            yield entry
+            archived += 1
+        logging.debug('Archived %d entries, %d unchanged', archived, skipped)
+
+        for stats in walker.excluded():
+            logging.info('Exclude pattern "%s" skipped %d files (%d bytes) and %d directories',
+                         stats['pattern'],
+                         stats['files'],
+                         stats['bytes'],
+                         stats['directories'])
+            self.__metrics.increment('excluded_files', stats['files'])
+            self.__metrics.increment('excluded_bytes', stats['bytes'])
+            self.__metrics.increment('excluded_directories', stats['directories'])
+
+    @staticmethod
+    def _add_entry(targz_file, entry, metrics):
+        """Adds ``entry`` to the archive and returns its ``TarInfo``, ``None`` if it's skipped.
+
+        Only the data extents of sparse files are read, and they are stored in
+        the GNU sparse format. The data of a file with several hard links is
+        only read for the first of them, the rest are stored as links to it.
+        """
+        tarinfo = make_tarinfo(targz_file, entry)
+        if tarinfo is None:
+            logging.warning('Skipping "%s": unsupported file type', entry.path)
+            return None
+        if tarinfo.islnk():
+            metrics.increment('hardlink_bytes_skipped', entry.stat.st_size)
+        if not tarinfo.isreg():
+            targz_file.addfile(tarinfo)
+            return tarinfo
+        try:
+            data_file = open(entry.path, 'rb')
+        except FileNotFoundError:
+            logging.warning('Skipping file "%s": it no longer exists', entry.path)
+            # Its other links have to store the data instead.
+            forget_inode(targz_file, entry, tarinfo.name)
+            return None
+        with data_file:
+            extents = None
+            if BackupService._may_be_sparse(entry.stat):
+                extents = data_extents(data_file, tarinfo.size)
+            if extents is None:
+                targz_file.addfile(tarinfo, data_file)
+            else:
+                add_sparse_file(targz_file, tarinfo, data_file, extents)
+                metrics.increment('sparse_files')
+                metrics.increment('sparse_bytes_skipped',
+                                  tarinfo.size - sum(size for _, size in extents))
+        return tarinfo
+
+    @staticmethod
+    def _may_be_sparse(stat_result):
+        """Tells whether the file has less space allocated than its size, e.g. due to holes."""
+        blocks = getattr(stat_result, 'st_blocks', None)
+        return stat.S_ISREG(stat_result.st_mode) and blocks is not None and \
+            blocks * 512 < stat_result.st_size
+
+    @staticmethod
+    def _add_deleted_paths(targz_file, tracker):
+        """Adds a member listing, NUL separated, the paths deleted since the previous backup."""
+        with SpooledTemporaryFile(max_size=1024 * 1024) as deleted_paths:
+            BackupService._write_deleted_paths(deleted_paths, tracker)
+            BackupService._add_deleted_paths_member(targz_file, deleted_paths)
+
+    @staticmethod
+    def _write_deleted_paths(fileobj, tracker):
+        for deleted_path in tracker.deleted_paths():
+            fileobj.write(os.fsencode(deleted_path) + b'\0')
+
+    @staticmethod
+    def _add_deleted_paths_file(deleted_paths_path, targz_file):
+        with open(deleted_paths_path, 'rb') as deleted_paths:
+            deleted_paths.seek(0, io.SEEK_END)
+            BackupService._add_deleted_paths_member(targz_file, deleted_paths)
+
+    @staticmethod
+    def _add_deleted_paths_member(targz_file, deleted_paths):
+        tarinfo = tarfile.TarInfo(BackupService.DELETED_PATHS_MEMBER)
+        tarinfo.size = deleted_paths.tell()
+        # Left at 0, so an unchanged backup gives the same archive.
+        deleted_paths.seek(0)
+        targz_file.addfile(tarinfo, deleted_paths)
+
     def _get_dropbox_path(self, filename):
         return os.path.join(self.__base_dir, filename)
 
@@ -66,28 +735,479 @@ class BackupService:
         return os.path.isdir(path)
 
 
+class RestoreService:
+    """Restores backups uploaded by ``BackupService``.
+
+    Archives are downloaded with parallel range requests and extracted while
+    they arrive, through gpg when they are encrypted, so they are never
+    written to disk. Restoring an incremental backup restores the full
+    backup it depends on and every incremental one up to it, deleting the
+    paths each of them recorded as deleted.
+
+    Backups made with a seekable archive can also be fetched: only the
+    members under the given paths are downloaded, using the index uploaded
+    next to every archive.
+    """
+
+    LATEST = 'latest'
+    FETCH_GAP = 4 * 1024 * 1024 # 4MB
+
+    def __init__(self, dropbox_client, backup_name, encryption_service=None, download_workers=4):
+        self.__dropbox_client = dropbox_client
+        self.__base_dir = os.path.join('/', backup_name)
+        self.__encryption_service = encryption_service
+        self.__download_workers = download_workers
+
+    def restore(self, backup, destination, paths=()):
+        """Extracts ``backup`` into ``destination``.
+
+        ``backup`` is the timestamp of the backup, the name of one of its
+        files or ``latest``. When ``paths`` are given, only the entries under
+        them are restored.
+        """
+        backups = BackupService._group_backups(self.__dropbox_client.list_files(self.__base_dir))
+        index = RestoreService._find_backup(backups, backup)
+        paths = [os.path.splitdrive(path)[1].replace(os.sep, '/').strip('/') for path in paths]
+        for timestamp, files in backups[BackupService._find_full_backup(backups, index):index + 1]:
+            logging.info('Restoring backup %s into %s', timestamp, destination)
+            snapshots = [file for file in files if file.endswith(BackupService.SNAPSHOT_SUFFIX)]
+            if snapshots:
+                self._restore_snapshot(snapshots[0], destination, paths)
+                continue
+            archives = [file for file in files if RestoreService._is_archive(file)]
+            if len(archives) > 1 and not any(BackupService.VOLUMES_SUFFIX in file
+                                             for file in files):
+                logging.warning('Backup %s has no list of volumes: it may be incomplete',
+                                timestamp)
+            for archive in archives:
+                self._restore_archive(archive, destination, paths)
+
+    def fetch(self, backup, destination, paths):
+        """Extracts the entries under ``paths`` of ``backup`` into ``destination``.
+
+        Works like ``restore`` but, instead of downloading whole archives,
+        it looks the entries up in the index of every archive and only
+        downloads the blocks holding them. Every archive of the backup, and
+        of the ones it depends on, must be seekable.
+        """
+        backups = BackupService._group_backups(self.__dropbox_client.list_files(self.__base_dir))
+        index = RestoreService._find_backup(backups, backup)
+        paths = [os.path.splitdrive(path)[1].replace(os.sep, '/').strip('/') for path in paths]
+        chain = backups[BackupService._find_full_backup(backups, index):index + 1]
+        for timestamp, files in chain:
+            for file in files:
+                if RestoreService._is_archive(file) and \
+                        file + BackupService.INDEX_SUFFIX not in files:
+                    raise Exception('{} has no index: restore the backup instead'.format(file))
+        for timestamp, files in chain:
+            logging.info('Fetching from backup %s into %s', timestamp, destination)
+            for file in files:
+                if RestoreService._is_archive(file):
+                    self._fetch_archive(file, destination, paths)
+
+    @staticmethod
+    def _find_backup(backups, backup):
+        if not backups:
+            raise Exception('No backups found')
+        if backup == RestoreService.LATEST:
+            return len(backups) - 1
+        match = BackupService.BACKUP_NAME_RE.match(backup)
+        timestamp = match.group(1) if match is not None else backup
+        for index, (backup_timestamp, _) in enumerate(backups):
+            if backup_timestamp == timestamp:
+                return index
+        raise Exception('Backup not found: {}'.format(backup))
+
+    @staticmethod
+    def _is_archive(file):
+        for suffix in (BackupService.MANIFEST_SUFFIX,
+                       BackupService.VOLUMES_SUFFIX,
+                       BackupService.SNAPSHOT_SUFFIX,
+                       BackupService.INDEX_SUFFIX):
+            if file.endswith(suffix) or file.endswith(suffix + '.enc'):
+                return False
+        return True
+
+    def _restore_archive(self, file, destination, paths):
+        logging.info('Downloading archive: %s', self._get_dropbox_path(file))
+        download = self.__dropbox_client.open_download(self._get_dropbox_path(file),
+                                                       self.__download_workers)
+        archive_stream = download
+        try:
+            if file.endswith('.enc'):
+                if self.__encryption_service is None:
+                    raise Exception('{} is encrypted: GPG is needed to restore it'.format(file))
+                archive_stream = self.__encryption_service.decrypt_stream(download)
+            if file.endswith(GzipCodec.extension) or file.endswith(GzipCodec.extension + '.enc'):
+                # Seekable archives have a gzip member per block, which the
+                # stream mode of tarfile stops reading after the first one.
+                with gzip.GzipFile(fileobj=archive_stream, mode='rb') as tar_stream:
+                    RestoreService._extract(tar_stream, destination, paths, mode='r|')
+            else:
+                RestoreService._extract(archive_stream, destination, paths)
+        finally:
+            archive_stream.close()
+            download.close()
+
+    def _fetch_archive(self, file, destination, paths):
+        logging.info('Downloading archive index: %s',
+                     self._get_dropbox_path(file + BackupService.INDEX_SUFFIX))
+        index = ArchiveIndex.from_bytes(self.__dropbox_client.download_file(
+            self._get_dropbox_path(file + BackupService.INDEX_SUFFIX)))
+        offsets = {offset for path in paths for _, offset in index.members(path)}
+        deleted_paths_offset = index.lookup(BackupService.DELETED_PATHS_MEMBER)
+        if deleted_paths_offset is not None:
+            offsets.add(deleted_paths_offset)
+        if not offsets:
+            return
+        logging.info('Fetching %d members from archive: %s',
+                     len(offsets),
+                     self._get_dropbox_path(file))
+
+        deleted_paths = []
+        directories = []
+        download = archive = None
+        try:
+            for run, end in RestoreService._group_fetches(index, offsets):
+                if download is not None:
+                    download.close()
+                download, reader = self._open_archive_at(file, index, run[0], end)
+                for offset in run:
+                    reader.seek(offset)
+                    archive = tarfile.TarFile(fileobj=reader, mode='r')
+                    member = archive.firstmember
+                    if member.name == BackupService.DELETED_PATHS_MEMBER:
+                        deleted_paths = archive.extractfile(member).read().split(b'\0')[:-1]
+                        continue
+                    if member.islnk() and \
+                            not os.path.lexists(os.path.join(destination, member.linkname)):
+                        # The data is in the member linked to, which wasn't fetched.
+                        self._fetch_link_target(file, index, member, destination)
+                        continue
+                    member = RestoreService._extract_member(archive, member, destination)
+                    if member.isdir():
+                        directories.append(member)
+            for member in reversed(directories):
+                target_path = os.path.join(destination, member.name)
+                archive.chown(member, target_path, False)
+                archive.utime(member, target_path)
+                archive.chmod(member, target_path)
+        finally:
+            if download is not None:
+                download.close()
+
+        for deleted_path in deleted_paths:
+            name = os.fsdecode(deleted_path).lstrip('/')
+            if RestoreService._is_selected(name, paths):
+                RestoreService._delete(os.path.join(destination, name))
+
+    @staticmethod
+    def _group_fetches(index, offsets):
+        """Returns the members at ``offsets`` grouped by the download reading them.
+
+        Every group is a list of offsets with the archive offset at which
+        its download ends (``None`` for the end of the archive): the end of
+        the block holding the end of its last member. Members whose blocks
+        are less than ``FETCH_GAP`` bytes apart share a download.
+        """
+        groups = []
+        for offset in sorted(offsets):
+            start = index.block(offset)[1]
+            end = index.block_end(index.member_end(offset))
+            if groups and (groups[-1][1] is None or
+                           start - groups[-1][1] <= RestoreService.FETCH_GAP):
+                groups[-1][0].append(offset)
+                groups[-1][1] = end
+            else:
+                groups.append([[offset], end])
+        return groups
+
+    def _fetch_link_target(self, file, index, member, destination):
+        offset = index.lookup(member.linkname)
+        if offset is None:
+            raise Exception('{} links to {}, which is not in {}'.format(member.name,
+                                                                        member.linkname,
+                                                                        file))
+        download, reader = self._open_archive_at(file,
+                                                 index,
+                                                 offset,
+                                                 index.block_end(index.member_end(offset)))
+        with download:
+            reader.seek(offset)
+            archive = tarfile.TarFile(fileobj=reader, mode='r')
+            target = copy.copy(archive.firstmember)
+            target.name = member.name
+            RestoreService._extract_member(archive, target, destination)
+
+    def _open_archive_at(self, file, index, offset, end=None):
+        """Returns the download of ``file`` and a reader of its tar stream, before ``offset``.
+
+        Only the archive up to ``end`` is downloaded, all of it if ``None``.
+        """
+        tar_offset, archive_offset = index.block(offset)
+        download = self.__dropbox_client.open_download(self._get_dropbox_path(file),
+                                                       self.__download_workers,
+                                                       archive_offset,
+                                                       end)
+        stream = gzip.GzipFile(fileobj=download, mode='rb') if index.compressed else download
+        return download, ForwardSeekReader(stream, tar_offset)
+
+    def _restore_snapshot(self, file, destination, paths):
+        logging.info('Downloading snapshot: %s', self._get_dropbox_path(file))
+        snapshot = Snapshot.from_bytes(
+            self.__dropbox_client.download_file(self._get_dropbox_path(file)))
+        chunks = PrefetchReader((functools.partial(self._load_chunk, digest, snapshot.encrypted)
+                                 for digest in snapshot.digests),
+                                self.__download_workers)
+        with chunks:
+            RestoreService._extract(chunks, destination, paths)
+
+    def _load_chunk(self, digest, encrypted):
+        name = Snapshot.chunk_name(digest, encrypted)
+        chunk_file = io.BytesIO(self.__dropbox_client.download_file(
+            os.path.join(self.__base_dir, ChunkStore.CHUNKS_FOLDER, name)))
+        if encrypted:
+            if self.__encryption_service is None:
+                raise Exception('Chunks are encrypted: GPG is needed to restore them')
+            with self.__encryption_service.decrypt_stream(chunk_file) as decrypted:
+                chunk_file = io.BytesIO(decrypted.read())
+        chunk = zlib.decompress(chunk_file.getvalue())
+        if hashlib.sha256(chunk).digest() != digest:
+            raise Exception('Chunk {} is corrupted'.format(name))
+        return chunk
+
+    @staticmethod
+    def _extract(archive_stream, destination, paths, mode='r|*'):
+        deleted_paths = []
+        directories = []
+        with tarfile.open(fileobj=archive_stream, mode=mode) as archive:
+            for member in archive:
+                if member.name == BackupService.DELETED_PATHS_MEMBER:
+                    deleted_paths = archive.extractfile(member).read().split(b'\0')[:-1]
+                    continue
+                if not RestoreService._is_selected(member.name, paths):
+                    continue
+                member = RestoreService._extract_member(archive, member, destination)
+                if member.isdir():
+                    directories.append(member)
+            # Like extractall(), set the metadata of directories once their content is extracted.
+            for member in reversed(directories):
+                target_path = os.path.join(destination, member.name)
+                archive.chown(member, target_path, False)
+                archive.utime(member, target_path)
+                archive.chmod(member, target_path)
+        # Read up to the end so the download completes and gpg checks the data.
+        while archive_stream.read(GpgStream.COPY_SIZE):
+            pass
+
+        for deleted_path in deleted_paths:
+            name = os.fsdecode(deleted_path).lstrip('/')
+            if RestoreService._is_selected(name, paths):
+                RestoreService._delete(os.path.join(destination, name))
+
+    @staticmethod
+    def _extract_member(archive, member, destination):
+        """Extracts ``member``, except the metadata of directories, and returns it as extracted."""
+        if hasattr(tarfile, 'tar_filter'):
+            # Rejects absolute paths and links out of the destination, like tar does.
+            member = tarfile.tar_filter(member, destination)
+            archive.extract(member,
+                            destination,
+                            set_attrs=not member.isdir(),
+                            filter='fully_trusted')
+        else:
+            archive.extract(member, destination, set_attrs=not member.isdir())
+        return member
+
+    @staticmethod
+    def _is_selected(name, paths):
+        return not paths or any(name == path or name.startswith(path + '/') for path in paths)
+
+    @staticmethod
+    def _delete(path):
+        logging.debug('Deleting path removed before the backup: %s', path)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+    def _get_dropbox_path(self, filename):
+        return os.path.join(self.__base_dir, filename)
+
 
 class GpgEncryptionService:
 
-    def __init__(self, destination, gpg_api):
+    def __init__(self, destination, gpg_api, metrics=None):
         self.__gpg = gpg_api
         self.__dest = destination
         self.__temp_dir = TemporaryDirectory()
+        self.__metrics = metrics if metrics is not None else RunMetrics()
 
     def encrypt(self, fileobj_input):
         logging.info('Encrypting file using GPG encryption to key: %s', self.__dest)
-        fileobj_input.seek(0)
-        encrypted_file = os.path.join(self.__temp_dir.name, 'encrypted-file')
+        if fileobj_input.seekable():
+            fileobj_input.seek(0)
+        file_descriptor, encrypted_file = mkstemp(dir=self.__temp_dir.name)
+        os.close(file_descriptor)
         try:
-            res = self.__gpg.encrypt(fileobj_input,
-                                     self.__dest,
-                                     output=encrypted_file,
-                                     armor=False)
+            with self.__metrics.stage('encrypt'):
+                res = self.__gpg.encrypt(fileobj_input,
+                                         self.__dest,
+                                         output=encrypted_file,
+                                         armor=False)
             if not res.ok:
                 raise Exception(res.status)
         except Exception as e:
             logging.error('Failed to encrypt backup file: {}'.format(e))
+            os.remove(encrypted_file)
             raise
 
+        self.__metrics.add_bytes('encrypt', bytes_out=os.path.getsize(encrypted_file))
         fileobj_input.close()
-        return open(encrypted_file, 'rb')
+        encrypted_fileobj = open(encrypted_file, 'rb')
+        # The open handle keeps the data around until it's closed.
+        os.remove(encrypted_file)
+        return encrypted_fileobj
+
+    def encrypt_stream(self, fileobj_input):
+        """Returns a stream with the encrypted contents of ``fileobj_input``.
+
+        The input is fed to gpg's stdin from a background thread while gpg's
+        stdout is read from the returned stream, so nothing is written to
+        disk and only the OS pipe buffers are held in memory. Reading the end
+        of the stream raises if gpg (or reading the input) failed.
+        """
+        logging.info('Encrypting stream using GPG encryption to key: %s', self.__dest)
+        if fileobj_input.seekable():
+            fileobj_input.seek(0)
+        process = self._open_gpg(['--always-trust', '--encrypt', '--recipient', self.__dest])
+        return io.BufferedReader(GpgStream(process, fileobj_input, self.__metrics),
+                                 buffer_size=GpgStream.COPY_SIZE)
+
+    def decrypt_stream(self, fileobj_input):
+        """Returns a stream with the decrypted contents of ``fileobj_input``.
+
+        It works like ``encrypt_stream``. The secret key has to be in the
+        keyring and, if it's protected, its passphrase is asked for by the
+        gpg agent.
+        """
+        logging.info('Decrypting stream using GPG')
+        process = self._open_gpg(['--decrypt'])
+        return io.BufferedReader(GpgStream(process, fileobj_input, self.__metrics, 'decrypt'),
+                                 buffer_size=GpgStream.COPY_SIZE)
+
+    def _open_gpg(self, args):
+        """Starts gpg with ``args`` and the binary, home folder and keyrings of ``gpg_api``.
+
+        It reads from stdin, writes to stdout and reports its status to stderr.
+        """
+        command = [self.__gpg.binary, '--no-options', '--no-emit-version', '--no-tty',
+                   '--status-fd', '2']
+        if self.__gpg.homedir:
+            command += ['--homedir', self.__gpg.homedir]
+        if self.__gpg.keyring:
+            command += ['--no-default-keyring', '--keyring', self.__gpg.keyring]
+        if self.__gpg.secring:
+            command += ['--secret-keyring', self.__gpg.secring]
+        logging.debug('Running %s', ' '.join(command + args))
+        return subprocess.Popen(command + args,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+
+
+class GpgStream(io.RawIOBase):
+    """Readable end of a gpg process being fed from a background thread.
+
+    The time from its creation until gpg exits and the bytes going through
+    it are recorded as the ``stage`` of ``metrics``.
+    """
+
+    COPY_SIZE = 1024 * 1024 # 1MB
+    MAX_STATUS_LINES = 20
+
+    def __init__(self, process, fileobj_input, metrics=None, stage='encrypt'):
+        self.__process = process
+        self.__stage = stage
+        self.__input = fileobj_input
+        self.__input_error = None
+        self.__metrics = metrics if metrics is not None else RunMetrics()
+        self.__start_time = time.perf_counter()
+        self.__bytes_in = 0
+        self.__bytes_out = 0
+        self.__recorded = False
+        self.__status = collections.deque(maxlen=GpgStream.MAX_STATUS_LINES)
+        self.__feeder = threading.Thread(target=self.__feed, name='gpg-feeder', daemon=True)
+        self.__status_reader = threading.Thread(target=self.__read_status,
+                                                name='gpg-status',
+                                                daemon=True)
+        self.__feeder.start()
+        self.__status_reader.start()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = self.__process.stdout.readinto(buffer)
+        self.__bytes_out += count
+        if count == 0 and len(buffer) > 0:
+            self.__check_result()
+        return count
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.__process.poll() is None:
+                self.__process.kill()
+            self.__process.wait()
+            self.__feeder.join()
+            self.__status_reader.join()
+            self.__process.stdout.close()
+            self.__record_metrics()
+        finally:
+            super().close()
+
+    def __check_result(self):
+        self.__feeder.join()
+        return_code = self.__process.wait()
+        self.__status_reader.join()
+        self.__record_metrics()
+        if self.__input_error is not None:
+            raise self.__input_error
+        if return_code != 0:
+            message = 'gpg exited with status {}: {}'.format(return_code,
+                                                             ' '.join(self.__status))
+            logging.error('Failed to %s stream: %s', self.__stage, message)
+            raise Exception(message)
+
+    def __feed(self):
+        try:
+            while True:
+                data = self.__input.read(GpgStream.COPY_SIZE)
+                if not data:
+                    break
+                self.__process.stdin.write(data)
+                self.__bytes_in += len(data)
+        except BrokenPipeError:
+            pass
+        except BaseException as e:
+            self.__input_error = e
+            self.__process.kill()
+        finally:
+            try:
+                self.__process.stdin.close()
+            except OSError:
+                pass
+
+    def __record_metrics(self):
+        if self.__recorded:
+            return
+        self.__recorded = True
+        self.__metrics.add_time(self.__stage, time.perf_counter() - self.__start_time, calls=1)
+        self.__metrics.add_bytes(self.__stage, self.__bytes_in, self.__bytes_out)
+
+    def __read_status(self):
+        for line in self.__process.stderr:
+            self.__status.append(line.decode('utf-8', 'replace').strip())
+        self.__process.stderr.close()
@@ -0,0 +1,82 @@
+import copy
+import errno
+import os
+import tarfile
+
+
+def data_extents(fileobj, size):
+    """Returns the ``(offset, size)`` of the data extents of a sparse file, ``None`` if it isn't.
+
+    Extents are found with ``SEEK_DATA`` and ``SEEK_HOLE``, so the holes are
+    never read. ``None`` is also returned when the filesystem can't tell
+    where the holes are. If the file ends in a hole, the last extent is
+    ``(size, 0)``, like GNU tar does.
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        return None
+    fd = fileobj.fileno()
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                data_offset = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                break # Only a hole up to the end.
+            if data_offset >= size:
+                break
+            hole_offset = min(os.lseek(fd, data_offset, os.SEEK_HOLE), size)
+            extents.append((data_offset, hole_offset - data_offset))
+            offset = hole_offset
+    except OSError as e:
+        if e.errno in (errno.EINVAL, errno.EOPNOTSUPP):
+            return None
+        raise
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+    if sum(extent_size for _, extent_size in extents) == size:
+        return None
+    if not extents or sum(extents[-1]) < size:
+        extents.append((size, 0))
+    return extents
+
+
+def add_sparse_file(archive, tarinfo, fileobj, extents):
+    """Adds the regular file ``tarinfo`` to ``archive`` in the GNU sparse format 1.0.
+
+    Only the ``extents`` of ``fileobj`` are read and stored, after a map of
+    them. ``tarfile`` can't write sparse members, so the headers and the
+    data are written the same way ``TarFile.addfile`` does. GNU tar, bsdtar
+    and ``tarfile`` restore the holes when extracting it.
+    """
+    sparse_map = '{}\n'.format(len(extents)) + ''.join('{}\n{}\n'.format(offset, size)
+                                                       for offset, size in extents)
+    sparse_map = sparse_map.encode('ascii')
+    sparse_map += tarfile.NUL * (-len(sparse_map) % tarfile.BLOCKSIZE)
+    data_size = sum(size for _, size in extents)
+
+    header = copy.copy(tarinfo)
+    directory, _, name = tarinfo.name.rpartition('/')
+    header.name = (directory + '/' if directory else '') + 'GNUSparseFile.0/' + name
+    header.size = len(sparse_map) + data_size
+    # The path goes first, so readers aware of the format take GNU.sparse.name instead.
+    header.pax_headers = {'path': header.name,
+                          'GNU.sparse.major': '1',
+                          'GNU.sparse.minor': '0',
+                          'GNU.sparse.name': tarinfo.name,
+                          'GNU.sparse.realsize': str(tarinfo.size)}
+    buf = header.tobuf(tarfile.PAX_FORMAT, archive.encoding, archive.errors)
+    archive.fileobj.write(buf)
+    archive.offset += len(buf)
+
+    archive.fileobj.write(sparse_map)
+    for offset, size in extents:
+        fileobj.seek(offset)
+        tarfile.copyfileobj(fileobj, archive.fileobj, size)
+    remainder = data_size % tarfile.BLOCKSIZE
+    if remainder:
+        archive.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+    archive.offset += len(sparse_map) + data_size + (-data_size % tarfile.BLOCKSIZE)
+    archive.members.append(tarinfo)
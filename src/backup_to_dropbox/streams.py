@@ -0,0 +1,342 @@
+import collections
+import io
+import queue
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ChunkPipe:
+    """In-memory pipe connecting a producer thread with a consumer.
+
+    Data written to ``writer`` is grouped in chunks of ``chunk_size`` bytes
+    and handed over to ``reader`` through a bounded queue, so at most
+    ``max_buffer_size`` bytes are held by the pipe at any given time.
+    """
+
+    DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024 # 4MB
+    DEFAULT_MAX_BUFFER_SIZE = 64 * 1024 * 1024 # 64MB
+
+    _EOF = object()
+    _POLL_INTERVAL = 0.5
+
+    def __init__(self, max_buffer_size=DEFAULT_MAX_BUFFER_SIZE, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.chunk_size = min(chunk_size, max_buffer_size)
+        self.__queue = queue.Queue(maxsize=max(1, max_buffer_size // self.chunk_size))
+        self.__reader_closed = threading.Event()
+        self.__error = None
+        self.reader = PipeReader(self)
+        self.writer = PipeWriter(self)
+
+    def _put(self, item):
+        while True:
+            if self.__reader_closed.is_set():
+                raise BrokenPipeError('Pipe reader has been closed')
+            try:
+                self.__queue.put(item, timeout=ChunkPipe._POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self):
+        if self.__error is not None:
+            raise self.__error
+        while True:
+            if self.__reader_closed.is_set():
+                raise ValueError('read from closed pipe')
+            try:
+                item = self.__queue.get(timeout=ChunkPipe._POLL_INTERVAL)
+                break
+            except queue.Empty:
+                pass
+        if item is ChunkPipe._EOF:
+            return None
+        if isinstance(item, BaseException):
+            self.__error = item
+            raise item
+        return item
+
+    def _close_reader(self):
+        self.__reader_closed.set()
+        # Drain whatever is queued so a blocked producer notices the closed reader.
+        while True:
+            try:
+                self.__queue.get_nowait()
+            except queue.Empty:
+                return
+
+
+class PipeWriter(io.RawIOBase):
+
+    def __init__(self, pipe):
+        self.__pipe = pipe
+        self.__buffer = bytearray()
+        self.__written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed pipe')
+        self.__buffer += data
+        while len(self.__buffer) >= self.__pipe.chunk_size:
+            self.__pipe._put(bytes(self.__buffer[:self.__pipe.chunk_size]))
+            del self.__buffer[:self.__pipe.chunk_size]
+        self.__written += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.__written
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.__buffer:
+                self.__pipe._put(bytes(self.__buffer))
+                self.__buffer.clear()
+            self.__pipe._put(ChunkPipe._EOF)
+        finally:
+            super().close()
+
+    def abort(self, error):
+        """Closes the writer making the reader raise ``error`` instead of seeing EOF."""
+        if self.closed:
+            return
+        self.__buffer.clear()
+        try:
+            self.__pipe._put(error)
+        except BrokenPipeError:
+            pass
+        finally:
+            super().close()
+
+
+class PipeReader(io.RawIOBase):
+
+    def __init__(self, pipe):
+        self.__pipe = pipe
+        self.__pending = memoryview(b'')
+        self.__eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        """Fills ``buffer`` completely unless the end of the stream is reached first."""
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < len(view):
+            if not self.__pending:
+                if self.__eof:
+                    break
+                chunk = self.__pipe._get()
+                if chunk is None:
+                    self.__eof = True
+                    break
+                self.__pending = memoryview(chunk)
+            count = min(len(view) - filled, len(self.__pending))
+            view[filled:filled + count] = self.__pending[:count]
+            self.__pending = self.__pending[count:]
+            filled += count
+        return filled
+
+    def read(self, size=-1):
+        """Reads ``size`` bytes copying the queued chunks only once, or not at all if aligned."""
+        if size is None or size < 0:
+            return self.readall()
+        pieces = []
+        remaining = size
+        while remaining > 0:
+            if not self.__pending:
+                if self.__eof:
+                    break
+                chunk = self.__pipe._get()
+                if chunk is None:
+                    self.__eof = True
+                    break
+                self.__pending = memoryview(chunk)
+            piece = self.__pending[:remaining]
+            self.__pending = self.__pending[len(piece):]
+            pieces.append(piece)
+            remaining -= len(piece)
+        if len(pieces) == 1 and len(pieces[0]) == len(pieces[0].obj):
+            return pieces[0].obj
+        return b''.join(pieces)
+
+    def close(self):
+        if not self.closed:
+            self.__pipe._close_reader()
+        super().close()
+
+
+class PrefetchReader(io.RawIOBase):
+    """Stream of the data returned by ``fetches``, run in parallel but read in order.
+
+    ``fetches`` is an iterable of callables returning bytes, e.g. downloads
+    of consecutive ranges of a file. Up to ``workers`` of them run ahead of
+    the reader, so at most ``workers`` results are held in memory besides
+    the one being read. An error raised by a fetch is raised when the
+    reader gets to its data.
+    """
+
+    def __init__(self, fetches, workers=1):
+        self.__fetches = iter(fetches)
+        self.__workers = max(1, workers)
+        self.__executor = ThreadPoolExecutor(max_workers=self.__workers,
+                                             thread_name_prefix='prefetch')
+        self.__futures = collections.deque()
+        self.__pending = memoryview(b'')
+        self.__submit()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        while not self.__pending:
+            if not self.__futures:
+                return 0
+            self.__pending = memoryview(self.__futures.popleft().result())
+            self.__submit()
+        count = min(len(view), len(self.__pending))
+        view[:count] = self.__pending[:count]
+        self.__pending = self.__pending[count:]
+        return count
+
+    def close(self):
+        if not self.closed:
+            for future in self.__futures:
+                future.cancel()
+            self.__futures.clear()
+            self.__executor.shutdown(wait=True)
+        super().close()
+
+    def __submit(self):
+        while len(self.__futures) < self.__workers:
+            fetch = next(self.__fetches, None)
+            if fetch is None:
+                return
+            self.__futures.append(self.__executor.submit(fetch))
+
+
+class ForwardSeekReader(io.RawIOBase):
+    """Makes a stream which starts at ``offset`` of some data seekable, but only forwards.
+
+    Positions are those in the whole data. Seeking skips the data up to the
+    target, so ``tarfile`` can read members from the middle of an archive
+    being downloaded as long as they are read in order.
+    """
+
+    SKIP_SIZE = 1024 * 1024 # 1MB
+
+    def __init__(self, fileobj, offset=0):
+        self.__fileobj = fileobj
+        self.__position = offset
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.__position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.__position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('can only seek from the start or the current position')
+        if offset < self.__position:
+            raise io.UnsupportedOperation('can not seek backwards')
+        while self.__position < offset:
+            skipped = self.__fileobj.read(min(offset - self.__position,
+                                              ForwardSeekReader.SKIP_SIZE))
+            if not skipped:
+                break
+            self.__position += len(skipped)
+        return self.__position
+
+    def readinto(self, buffer):
+        """Fills ``buffer`` completely unless the end of the stream is reached first."""
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < len(view):
+            data = self.__fileobj.read(len(view) - filled)
+            if not data:
+                break
+            view[filled:filled + len(data)] = data
+            filled += len(data)
+        self.__position += filled
+        return filled
+
+
+class HashingWriter(io.RawIOBase):
+    """Writes into ``fileobj`` updating ``hasher`` with the data written."""
+
+    def __init__(self, fileobj, hasher):
+        self.__fileobj = fileobj
+        self.hasher = hasher
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.__fileobj.write(data)
+        self.hasher.update(data)
+        return len(data)
+
+
+class HashingReader(io.RawIOBase):
+    """Reads from ``fileobj`` updating ``hasher`` with the data read, from its start and in order.
+
+    Data read again after seeking back isn't hashed twice and nothing is
+    hashed after a part is skipped by seeking forward, so the hash covers
+    the first ``hashed`` bytes of ``fileobj``.
+    """
+
+    def __init__(self, fileobj, hasher):
+        self.__fileobj = fileobj
+        self.__position = fileobj.tell() if fileobj.seekable() else 0
+        self.hasher = hasher
+        self.hashed = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self.__fileobj.seekable()
+
+    def tell(self):
+        return self.__position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.__position = self.__fileobj.seek(offset, whence)
+        return self.__position
+
+    def read(self, size=-1):
+        data = self.__fileobj.read(size)
+        end = self.__position + len(data)
+        if self.__position <= self.hashed < end:
+            self.hasher.update(memoryview(data)[self.hashed - self.__position:])
+            self.hashed = end
+        self.__position = end
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def pending_futures(futures):
+    """Returns the futures not done yet, raising the error of any failed one."""
+    pending = []
+    for future in futures:
+        if not future.done():
+            pending.append(future)
+        elif future.exception() is not None:
+            raise future.exception()
+    return pending
@@ -0,0 +1,172 @@
+import contextlib
+import logging
+import re
+import threading
+import time
+
+from datetime import datetime
+
+
+class BandwidthSchedule:
+    """Upload rate limits depending on the time of day.
+
+    Profiles are ``HH:MM-HH:MM=MB`` (MB per second from the first time to
+    the second one, wrapping around midnight if it's earlier) or just
+    ``MB`` for all day. The first profile covering a time applies and the
+    bandwidth is unlimited when none does.
+    """
+
+    PROFILE_RE = re.compile(r'^(?:(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=)?(\d+(?:\.\d+)?)$')
+
+    def __init__(self, profiles):
+        self.__profiles = []
+        for profile in profiles:
+            match = BandwidthSchedule.PROFILE_RE.match(profile.strip())
+            if match is None:
+                raise ValueError('Invalid bandwidth profile "{}"'.format(profile))
+            start_hour, start_minute, end_hour, end_minute, rate = match.groups()
+            start, end = 0, 24 * 60
+            if start_hour is not None:
+                start = BandwidthSchedule._minutes(start_hour, start_minute, profile)
+                end = BandwidthSchedule._minutes(end_hour, end_minute, profile)
+            rate = float(rate) * 1024 * 1024
+            if rate <= 0:
+                raise ValueError('Invalid bandwidth profile "{}": the rate must be positive'.format(
+                    profile))
+            self.__profiles.append((start, end, rate))
+
+    def rate_at(self, moment):
+        """Returns the bytes per second allowed at ``moment``, or ``None`` if unlimited."""
+        minute = moment.hour * 60 + moment.minute
+        for start, end, rate in self.__profiles:
+            if start <= minute < end or (end < start and (minute >= start or minute < end)):
+                return rate
+        return None
+
+    @staticmethod
+    def _minutes(hours, minutes, profile):
+        hours, minutes = int(hours), int(minutes)
+        if hours > 24 or minutes > 59 or (hours == 24 and minutes):
+            raise ValueError('Invalid bandwidth profile "{}": bad time'.format(profile))
+        return hours * 60 + minutes
+
+
+class BandwidthLimiter:
+    """Token bucket keeping the bytes sent under the rate of a ``BandwidthSchedule``.
+
+    Requests are sent whole, so a request may take more tokens than the
+    bucket holds: it's sent as soon as the bucket isn't in debt, and the
+    following ones wait until the debt is paid back. The bucket holds at
+    most ``BURST`` seconds of the rate. It can be shared by several clients,
+    which then share the rate.
+    """
+
+    BURST = 1 # seconds
+    MAX_WAIT = 60 # seconds, so changes of the rate are noticed
+
+    def __init__(self, schedule, clock=datetime.now):
+        self.__schedule = schedule
+        self.__clock = clock
+        self.__lock = threading.Lock()
+        self.__tokens = 0
+        self.__updated_at = time.monotonic()
+
+    def acquire(self, size):
+        """Waits until ``size`` bytes can be sent and returns the seconds waited."""
+        waited = 0
+        while True:
+            with self.__lock:
+                rate = self.__schedule.rate_at(self.__clock())
+                now = time.monotonic()
+                if rate is None:
+                    self.__tokens = 0
+                else:
+                    self.__tokens = min(rate * BandwidthLimiter.BURST,
+                                        self.__tokens + (now - self.__updated_at) * rate)
+                self.__updated_at = now
+                if rate is None or self.__tokens >= 0:
+                    if rate is not None:
+                        self.__tokens -= size
+                    return waited
+                wait = min(-self.__tokens / rate, BandwidthLimiter.MAX_WAIT)
+            time.sleep(wait)
+            waited += wait
+
+    def burst_size(self):
+        """Returns the bytes that can be sent at once at the current rate, ``None`` if unlimited.
+
+        Requests bigger than this are sent faster than the rate, so
+        uploads keep their chunks under it.
+        """
+        rate = self.__schedule.rate_at(self.__clock())
+        return None if rate is None else int(rate * BandwidthLimiter.BURST)
+
+
+class AdaptiveConcurrency:
+    """Limits the requests in flight while Dropbox throttles them.
+
+    There's no limit until a request is throttled. Then the limit is set to
+    half of the requests in flight (only once for all the requests
+    throttled during the same pause) and every new request waits for the
+    time Dropbox asked to retry after. Each run of ``limit`` successful
+    requests raises it by one again, and it's lifted once it's back to the
+    requests that were in flight when it was set.
+    """
+
+    def __init__(self):
+        self.__condition = threading.Condition()
+        self.__active = 0
+        self.__successes = 0
+        self.__resume_at = 0
+        self.__ceiling = None
+        self.limit = None
+
+    @contextlib.contextmanager
+    def request(self):
+        with self.__condition:
+            pause = self.__resume_at - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+        with self.__condition:
+            while self.limit is not None and self.__active >= self.limit:
+                self.__condition.wait()
+            self.__active += 1
+        try:
+            yield
+        finally:
+            with self.__condition:
+                self.__active -= 1
+                self.__condition.notify_all()
+
+    def succeeded(self):
+        with self.__condition:
+            if self.limit is None:
+                return
+            self.__successes += 1
+            if self.__successes >= self.limit:
+                self.limit += 1
+                self.__successes = 0
+                if self.limit >= self.__ceiling:
+                    self.limit = None
+                    logging.debug('Lifted the limit of concurrent requests')
+                else:
+                    logging.debug('Raised the limit of concurrent requests to %d', self.limit)
+                self.__condition.notify_all()
+
+    def throttled(self, retry_after):
+        """Records that a request was throttled and has to be retried in ``retry_after`` seconds."""
+        with self.__condition:
+            now = time.monotonic()
+            if now < self.__resume_at:
+                # Requests sent before the pause are throttled together: back off once.
+                self.__resume_at = max(self.__resume_at, now + retry_after)
+                return
+            if self.limit is None:
+                # The throttled request already left, count it too.
+                self.__ceiling = self.__active + 1
+                self.limit = self.__ceiling
+            self.limit = max(1, self.limit // 2)
+            self.__successes = 0
+            self.__resume_at = now + retry_after
+            logging.warning('Dropbox is throttling requests: pausing them for %.1f seconds and '
+                            'sending at most %d at a time', retry_after, self.limit)
@@ -0,0 +1,347 @@
+import functools
+import logging
+import os
+import os.path
+import re
+import stat
+import tarfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import grp
+    import pwd
+except ImportError:
+    grp = pwd = None
+
+
+class ExcludeMatcher:
+    """Matches paths against glob patterns, indexed by their shape.
+
+    Patterns without a slash match the name of an entry at any depth
+    (``node_modules``, ``*.pyc``) and patterns with a slash match its whole
+    path (``/home/*/.cache``). ``*``, ``?`` and ``[...]`` don't match ``/``
+    while ``**`` does, and a trailing slash makes the pattern only match
+    directories.
+
+    Literal names and paths are looked up in dicts, and so are names
+    starting or ending with a single ``*`` (``*.pyc``, ``core.*``), by
+    their literal part. Other patterns are compiled to regular expressions
+    and, for paths, grouped by the folder they start with, so an entry is
+    only tried against the ones of its parent folders. The cost of a match
+    then stays low with thousands of rules of the common shapes.
+    """
+
+    WILDCARDS = re.compile(r'[*?\[]')
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        # Indexes of literal parts to the first pattern with them: for any
+        # entry and for directories only.
+        self.__names = ({}, {})
+        self.__paths = ({}, {})
+        self.__name_prefixes = ({}, {})
+        self.__name_suffixes = ({}, {})
+        self.__name_regexes = []
+        self.__path_regexes = {}
+        for index, pattern in enumerate(self.patterns):
+            dir_only = len(pattern) > 1 and pattern.endswith('/')
+            glob = pattern.rstrip('/') if dir_only else pattern
+            wildcard = ExcludeMatcher.WILDCARDS.search(glob)
+            if wildcard is None:
+                (self.__paths if '/' in glob else self.__names)[dir_only].setdefault(glob, index)
+                continue
+            if '/' not in glob and len(glob) > 1:
+                if wildcard.start() == 0 and glob[0] == '*' and \
+                        ExcludeMatcher.WILDCARDS.search(glob, 1) is None:
+                    self.__name_suffixes[dir_only].setdefault(glob[1:], index)
+                    continue
+                if wildcard.start() == len(glob) - 1 and glob[-1] == '*':
+                    self.__name_prefixes[dir_only].setdefault(glob[:-1], index)
+                    continue
+            regex = re.compile(ExcludeMatcher._translate(glob) + ('/' if dir_only else '/?'),
+                               re.DOTALL)
+            if '/' in glob:
+                folder = glob[:glob.rfind('/', 0, wildcard.start()) + 1]
+                self.__path_regexes.setdefault(folder, []).append((index, regex))
+            else:
+                self.__name_regexes.append((index, regex))
+        self.__prefix_lengths = ExcludeMatcher._lengths(self.__name_prefixes)
+        self.__suffix_lengths = ExcludeMatcher._lengths(self.__name_suffixes)
+
+    def match(self, path, name, is_dir):
+        """Returns the index of the first pattern matching the entry, or ``None``."""
+        first = None
+        for dir_only in ((False, True) if is_dir else (False,)):
+            first = ExcludeMatcher._first(first, self.__names[dir_only].get(name))
+            first = ExcludeMatcher._first(first, self.__paths[dir_only].get(path))
+            prefixes = self.__name_prefixes[dir_only]
+            suffixes = self.__name_suffixes[dir_only]
+            for length in self.__prefix_lengths:
+                if length > len(name):
+                    break
+                first = ExcludeMatcher._first(first, prefixes.get(name[:length]))
+            for length in self.__suffix_lengths:
+                if length > len(name):
+                    break
+                first = ExcludeMatcher._first(first, suffixes.get(name[-length:]))
+        suffix = '/' if is_dir else ''
+        first = ExcludeMatcher._search(self.__name_regexes, name + suffix, first)
+        if self.__path_regexes:
+            subject = path + suffix
+            first = ExcludeMatcher._search(self.__path_regexes.get('', ()), subject, first)
+            slash = subject.find('/') if len(self.__path_regexes) > ('' in self.__path_regexes) \
+                else -1
+            while slash != -1:
+                regexes = self.__path_regexes.get(subject[:slash + 1])
+                if regexes is not None:
+                    first = ExcludeMatcher._search(regexes, subject, first)
+                slash = subject.find('/', slash + 1)
+        return first
+
+    @staticmethod
+    def _first(first, index):
+        if index is None or (first is not None and first < index):
+            return first
+        return index
+
+    @staticmethod
+    def _search(regexes, subject, first):
+        """Returns the first of ``first`` and the index of the first of ``regexes`` matching."""
+        for index, regex in regexes:
+            if first is not None and index > first:
+                break
+            if regex.fullmatch(subject) is not None:
+                return index
+        return first
+
+    @staticmethod
+    def _lengths(indexes):
+        return sorted({len(key) for index in indexes for key in index})
+
+    @staticmethod
+    def _translate(glob):
+        regex = []
+        index = 0
+        while index < len(glob):
+            char = glob[index]
+            if glob.startswith('**', index):
+                regex.append('.*')
+                index += 2
+                continue
+            if char == '*':
+                regex.append('[^/]*')
+            elif char == '?':
+                regex.append('[^/]')
+            elif char == '[' and glob.find(']', index + 2) != -1:
+                end = glob.find(']', index + 2)
+                content = glob[index + 1:end].replace('\\', '\\\\')
+                if content.startswith('!'):
+                    content = '^' + content[1:]
+                elif content.startswith('^'):
+                    content = '\\' + content
+                regex.append('(?!/)[{}]'.format(content))
+                index = end
+            else:
+                regex.append(re.escape(char))
+            index += 1
+        return ''.join(regex)
+
+
+def read_patterns(path):
+    """Reads exclude patterns from a file: one per line, ignoring blank lines and comments."""
+    with open(path) as patterns_file:
+        lines = (line.rstrip('\n') for line in patterns_file)
+        return [line for line in lines if line.strip() and not line.startswith('#')]
+
+
+class WalkEntry:
+    """Path found by ``FileWalker`` with its ``lstat`` result."""
+
+    __slots__ = ('path', 'stat', 'linkname', 'rule')
+
+    def __init__(self, path, stat_result, linkname=None, rule=None):
+        self.path = path
+        self.stat = stat_result
+        self.linkname = linkname
+        self.rule = rule
+
+    def is_dir(self):
+        return stat.S_ISDIR(self.stat.st_mode)
+
+
+class FileWalker:
+    """Walks paths listing directories and reading their entries' metadata from a thread pool.
+
+    Entries are yielded depth first, sorted by name, so archives are
+    deterministic. While an entry is being archived, the listings of up to
+    ``threads`` of its following sibling directories are fetched ahead,
+    which hides most of the latency of network filesystems. Symbolic links
+    are never followed. Entries matching ``matcher`` are skipped, without
+    descending into excluded directories.
+    """
+
+    DEFAULT_THREADS = 8
+
+    def __init__(self, matcher=None, threads=DEFAULT_THREADS):
+        self.__matcher = matcher
+        self.__threads = max(1, threads)
+        patterns = matcher.patterns if matcher is not None else []
+        self.__excluded = [{'pattern': pattern, 'files': 0, 'directories': 0, 'bytes': 0}
+                           for pattern in patterns]
+
+    def walk(self, paths):
+        with ThreadPoolExecutor(max_workers=self.__threads,
+                                thread_name_prefix='walker') as executor:
+            for path in paths:
+                path = path.rstrip(os.sep) or path
+                try:
+                    entry = self._entry(path, os.path.basename(path))
+                except FileNotFoundError:
+                    logging.warning('Skipping path "%s": it no longer exists', path)
+                    continue
+                yield from self.__visit(executor, entry, None)
+
+    def excluded(self):
+        """Returns, for every pattern, the files, directories and bytes it excluded.
+
+        Entries under an excluded directory are not walked, so they are not
+        counted either.
+        """
+        return [dict(stats) for stats in self.__excluded]
+
+    def __visit(self, executor, entry, listing):
+        """Yields ``entry`` and everything under it.
+
+        ``listing`` is the future of the directory listing if it's already
+        being fetched.
+        """
+        if entry.rule is not None:
+            stats = self.__excluded[entry.rule]
+            if entry.is_dir():
+                stats['directories'] += 1
+            else:
+                stats['files'] += 1
+                stats['bytes'] += entry.stat.st_size
+            return
+        yield entry
+        if not entry.is_dir():
+            return
+        if listing is None:
+            listing = executor.submit(self._list_dir, entry.path)
+        try:
+            children = listing.result()
+        except FileNotFoundError:
+            logging.warning('Skipping directory "%s": it no longer exists', entry.path)
+            return
+        subdirs = iter([child for child in children if child.rule is None and child.is_dir()])
+        listings = {}
+        for child in children:
+            if child.rule is None and child.is_dir():
+                while len(listings) < self.__threads:
+                    subdir = next(subdirs, None)
+                    if subdir is None:
+                        break
+                    listings[subdir.path] = executor.submit(self._list_dir, subdir.path)
+            yield from self.__visit(executor, child, listings.pop(child.path, None))
+
+    def _list_dir(self, dir_path):
+        with os.scandir(dir_path) as dir_entries:
+            dir_entries = sorted(dir_entries, key=lambda dir_entry: dir_entry.name)
+        children = []
+        for dir_entry in dir_entries:
+            try:
+                children.append(self._entry(dir_entry.path,
+                                            dir_entry.name,
+                                            dir_entry.stat(follow_symlinks=False)))
+            except FileNotFoundError:
+                continue
+        return children
+
+    def _entry(self, path, name, stat_result=None):
+        if stat_result is None:
+            stat_result = os.lstat(path)
+        rule = None
+        if self.__matcher is not None:
+            rule = self.__matcher.match(path, name, stat.S_ISDIR(stat_result.st_mode))
+        linkname = None
+        if rule is None and stat.S_ISLNK(stat_result.st_mode):
+            linkname = os.readlink(path)
+        return WalkEntry(path, stat_result, linkname, rule)
+
+
+def make_tarinfo(archive, entry):
+    """Returns the ``TarInfo`` that ``archive.gettarinfo(entry.path)`` would, without a ``lstat``.
+
+    Returns ``None`` for file types tar can't store, such as sockets.
+    """
+    stat_result = entry.stat
+    mode = stat_result.st_mode
+    arcname = os.path.splitdrive(entry.path)[1].replace(os.sep, '/').lstrip('/')
+    linkname = ''
+    if stat.S_ISREG(mode):
+        inode = (stat_result.st_ino, stat_result.st_dev)
+        if stat_result.st_nlink > 1 and inode in archive.inodes and \
+                arcname != archive.inodes[inode]:
+            # Later links to an archived file are stored as hard links to it.
+            file_type = tarfile.LNKTYPE
+            linkname = archive.inodes[inode]
+        else:
+            file_type = tarfile.REGTYPE
+            # Unlike tarfile, only track the inodes which can be linked again.
+            if inode[0] and stat_result.st_nlink > 1:
+                archive.inodes[inode] = arcname
+    elif stat.S_ISDIR(mode):
+        file_type = tarfile.DIRTYPE
+    elif stat.S_ISFIFO(mode):
+        file_type = tarfile.FIFOTYPE
+    elif stat.S_ISLNK(mode):
+        file_type = tarfile.SYMTYPE
+        linkname = entry.linkname
+    elif stat.S_ISCHR(mode):
+        file_type = tarfile.CHRTYPE
+    elif stat.S_ISBLK(mode):
+        file_type = tarfile.BLKTYPE
+    else:
+        return None
+
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.mode = mode
+    tarinfo.uid = stat_result.st_uid
+    tarinfo.gid = stat_result.st_gid
+    tarinfo.size = stat_result.st_size if file_type == tarfile.REGTYPE else 0
+    tarinfo.mtime = stat_result.st_mtime
+    tarinfo.type = file_type
+    tarinfo.linkname = linkname
+    tarinfo.uname = _user_name(stat_result.st_uid)
+    tarinfo.gname = _group_name(stat_result.st_gid)
+    if file_type in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+        tarinfo.devmajor = os.major(stat_result.st_rdev)
+        tarinfo.devminor = os.minor(stat_result.st_rdev)
+    return tarinfo
+
+
+def forget_inode(archive, entry, arcname):
+    """Undoes the tracking of the inode of ``entry`` by ``make_tarinfo``, if it wasn't archived.
+
+    The next link to the inode is then archived with its data.
+    """
+    inode = (entry.stat.st_ino, entry.stat.st_dev)
+    if archive.inodes.get(inode) == arcname:
+        del archive.inodes[inode]
+
+
+@functools.lru_cache(maxsize=None)
+def _user_name(uid):
+    try:
+        return pwd.getpwuid(uid)[0] if pwd is not None else ''
+    except KeyError:
+        return ''
+
+
+@functools.lru_cache(maxsize=None)
+def _group_name(gid):
+    try:
+        return grp.getgrgid(gid)[0] if grp is not None else ''
+    except KeyError:
+        return ''
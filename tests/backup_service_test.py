@@ -1,12 +1,24 @@
 import io
+import json
+import os
 import tarfile
+import tempfile
 import unittest
 
 from datetime import datetime
-from unittest.mock import ANY, MagicMock, Mock, call, patch
+from unittest.mock import ANY, MagicMock, Mock, patch
 
+from backup_to_dropbox.clients import ContentHasher
+from backup_to_dropbox.compression import XzCodec
+from backup_to_dropbox.dedup import Snapshot
+from backup_to_dropbox.manifest import IncrementalBackupState
+from backup_to_dropbox.metrics import RunMetrics
 from backup_to_dropbox.services import BackupService
 
+def archived_names(tar_file_mock):
+    return [args[0].name for args, _ in tar_file_mock.addfile.call_args_list]
+
+
 class BackupServiceTest(unittest.TestCase):
 
     def setUp(self):
@@ -38,98 +50,636 @@ class BackupServiceTest(unittest.TestCase):
         self.backup_service.cleanup_old_backups(2)
 
         self.dropbox_client.list_files.assert_called_once_with('/' + self.backup_name)
-        self.dropbox_client.delete_file.assert_has_calls([
-            call('/{}/2020-04-03-0000.tar.gz'.format(self.backup_name)),
-            call('/{}/2020-05-01-0000.tar.gz'.format(self.backup_name)),
+        self.dropbox_client.delete_files.assert_called_once_with([
+            '/{}/2020-04-03-0000.tar.gz'.format(self.backup_name),
+            '/{}/2020-05-01-0000.tar.gz'.format(self.backup_name),
         ])
 
     @patch.object(BackupService, 'now')
-    @patch.object(BackupService, 'isfile')
-    @patch.object(BackupService, 'isdir')
     @patch('tarfile.open')
-    def test_backup_with_encryption(self, open_tarfile_mock, isdir_mock, isfile_mock, date_now):
-        backup_path = '/var/log/test'
+    def test_backup_with_encryption(self, open_tarfile_mock, date_now):
         date_now.return_value = datetime(2020, 5, 10, 17, 15, 30)
 
         backup_tar_file = MagicMock()
         open_tarfile_mock.return_value.__enter__.return_value = backup_tar_file
-        isfile_mock.return_value = True
 
         encrypted_file = Mock()
-        self.encryption_service.encrypt.return_value = encrypted_file
+        self.encryption_service.encrypt_stream.return_value = encrypted_file
 
-        self.backup_service.backup_paths([backup_path])
+        with tempfile.NamedTemporaryFile() as backup_file:
+            self.backup_service.backup_paths([backup_file.name])
 
         open_tarfile_mock.assert_called_once()
-        isfile_mock.assert_called_once()
-        backup_tar_file.add.assert_called_once_with(backup_path)
+        self.assertEqual([backup_file.name.lstrip('/')], archived_names(backup_tar_file))
 
-        self.encryption_service.encrypt.assert_called_once()
+        self.encryption_service.encrypt_stream.assert_called_once()
 
         expected_filepath = '/{}/2020-05-10-1715.tar.gz.enc'.format(self.backup_name)
         self.dropbox_client.upload_file.assert_called_once_with(encrypted_file, expected_filepath)
 
     @patch.object(BackupService, 'now')
-    @patch.object(BackupService, 'isfile')
-    @patch.object(BackupService, 'isdir')
     @patch('tarfile.open')
-    def test_backup_without_encryption(self, open_tarfile_mock, isdir_mock, isfile_mock, date_now):
+    def test_backup_without_encryption(self, open_tarfile_mock, date_now):
         self.backup_service = BackupService(self.dropbox_client, self.backup_name)
 
-        backup_path = '/var/log/test'
         date_now.return_value = datetime(2020, 5, 10, 17, 15, 30)
 
         backup_tar_file = MagicMock()
         open_tarfile_mock.return_value.__enter__.return_value = backup_tar_file
-        isfile_mock.return_value = True
 
-        self.backup_service.backup_paths([backup_path])
+        with tempfile.NamedTemporaryFile() as backup_file:
+            self.backup_service.backup_paths([backup_file.name])
 
         open_tarfile_mock.assert_called_once()
-        isfile_mock.assert_called_once()
-        backup_tar_file.add.assert_called_once_with(backup_path)
+        self.assertEqual([backup_file.name.lstrip('/')], archived_names(backup_tar_file))
 
         expected_filepath = '/{}/2020-05-10-1715.tar.gz'.format(self.backup_name)
         self.dropbox_client.upload_file.assert_called_once_with(ANY, expected_filepath)
 
     @patch.object(BackupService, 'now')
-    @patch.object(BackupService, 'isfile')
-    @patch.object(BackupService, 'isdir')
     @patch('tarfile.open')
-    def test_backup_add_existing_elems(self, open_tarfile_mock, isdir_mock, isfile_mock, date_now):
-        existing_file = '/var/log/test'
-        existing_dir = '/var/log/test_dir'
-        non_existing_path = '/var/log/missing'
-
-        def isfile(path):
-            if path == existing_file:
-                return True
-            return False
-
-        def isdir(path):
-            if path == existing_dir:
-                return True
-            return False
-
+    def test_backup_add_existing_elems(self, open_tarfile_mock, date_now):
         date_now.return_value = datetime(2020, 5, 10, 17, 15, 30)
 
         backup_tar_file = MagicMock()
         open_tarfile_mock.return_value.__enter__.return_value = backup_tar_file
-        isfile_mock.side_effect = isfile
 
         encrypted_file = Mock()
-        self.encryption_service.encrypt.return_value = encrypted_file
+        self.encryption_service.encrypt_stream.return_value = encrypted_file
+
+        with tempfile.TemporaryDirectory() as backup_dir:
+            existing_file = os.path.join(backup_dir, 'test')
+            existing_dir = os.path.join(backup_dir, 'test_dir')
+            non_existing_path = os.path.join(backup_dir, 'missing')
+            open(existing_file, 'w').close()
+            os.mkdir(existing_dir)
 
-        self.backup_service.backup_paths([existing_file, existing_dir, non_existing_path])
+            self.backup_service.backup_paths([existing_file, existing_dir, non_existing_path])
 
         open_tarfile_mock.assert_called_once()
-        backup_tar_file.add.assert_has_calls([call(existing_file), call(existing_dir)],
-                                             any_order=True)
+        self.assertEqual([existing_file.lstrip('/'), existing_dir.lstrip('/')],
+                         archived_names(backup_tar_file))
 
-        self.encryption_service.encrypt.assert_called_once()
+        self.encryption_service.encrypt_stream.assert_called_once()
 
         expected_filepath = '/{}/2020-05-10-1715.tar.gz.enc'.format(self.backup_name)
         self.dropbox_client.upload_file.assert_called_once_with(encrypted_file, expected_filepath)
 
+    @patch.object(BackupService, 'now')
+    def test_streaming_backup_uploads_archive_while_generating(self, date_now):
+        self.backup_service = BackupService(self.dropbox_client,
+                                            self.backup_name,
+                                            streaming=True,
+                                            stream_buffer_size=1024)
+        date_now.return_value = datetime(2020, 5, 10, 17, 15, 30)
+
+        uploaded = {}
+
+        def upload_file(stream, path):
+            self.assertFalse(stream.seekable())
+            uploaded[path] = stream.read()
+
+        self.dropbox_client.upload_file.side_effect = upload_file
+
+        with tempfile.TemporaryDirectory() as backup_dir:
+            with open(os.path.join(backup_dir, 'data'), 'wb') as data_file:
+                data_file.write(os.urandom(64 * 1024))
+
+            self.backup_service.backup_paths([backup_dir])
+
+        expected_filepath = '/{}/2020-05-10-1715.tar.gz'.format(self.backup_name)
+        with tarfile.open(fileobj=io.BytesIO(uploaded[expected_filepath]), mode='r:gz') as archive:
+            names = archive.getnames()
+        self.assertIn(os.path.join(backup_dir, 'data').lstrip('/'), names)
+
+    @patch.object(BackupService, 'now')
+    def test_backup_records_archive_stages(self, date_now):
+        metrics = RunMetrics()
+        self.backup_service = BackupService(self.dropbox_client,
+                                            self.backup_name,
+                                            streaming=True,
+                                            stream_buffer_size=1024,
+                                            metrics=metrics)
+        date_now.return_value = datetime(2020, 5, 10, 17, 15, 30)
+        uploaded = []
+        self.dropbox_client.upload_file.side_effect = \
+            lambda stream, path: uploaded.append(stream.read())
+
+        with tempfile.TemporaryDirectory() as backup_dir:
+            with open(os.path.join(backup_dir, 'data'), 'wb') as data_file:
+                data_file.write(b'backup data\n' * 100000)
+
+            self.backup_service.backup_paths([backup_dir])
+
+        stages = metrics.report()['stages']
+        self.assertEqual({'archive', 'walk', 'compress', 'archive_output'}, set(stages))
+        self.assertGreater(stages['compress']['bytes_in'], 1200000)
+        self.assertEqual(len(uploaded[0]), stages['compress']['bytes_out'])
+        self.assertLess(stages['compress']['ratio'], 0.1)
+        self.assertAlmostEqual(stages['archive']['wall_time'],
+                               sum(stages[stage]['wall_time']
+                                   for stage in ('walk', 'compress', 'archive_output')))
+
+    @patch.object(BackupService, 'now')
+    def test_backup_holds_disk_slots_while_reading_paths(self, date_now):
+        metrics = RunMetrics()
+        disk_slots = MagicMock()
+        held = []
+        disk_slots.hold.return_value.__enter__.side_effect = lambda: held.append(True)
+        disk_slots.hold.return_value.__exit__.side_effect = \
+            lambda *args: self.dropbox_client.upload_file.assert_not_called()
+        self.backup_service = BackupService(self.dropbox_client,
+                                            self.backup_name,
+                                            metrics=metrics,
+                                            disk_slots=disk_slots)
+        date_now.return_value = datetime(2020, 5, 10, 17, 15, 30)
+
+        with tempfile.TemporaryDirectory() as backup_dir:
+            self.backup_service.backup_paths([backup_dir])
+
+        disk_slots.hold.assert_called_once_with([backup_dir])
+        self.assertEqual([True], held)
+        self.dropbox_client.upload_file.assert_called_once()
+        self.assertEqual(1, metrics.report()['stages']['disk_wait']['calls'])
+
+    @patch.object(BackupService, 'now')
+    @patch.object(BackupService, 'isdir')
+    def test_streaming_backup_failure_propagates_to_upload(self, isdir_mock, date_now):
+        self.backup_service = BackupService(self.dropbox_client,
+                                            self.backup_name,
+                                            streaming=True)
+        date_now.return_value = datetime(2020, 5, 10, 17, 15, 30)
+        isdir_mock.side_effect = OSError('Cannot access path')
+
+        self.dropbox_client.upload_file.side_effect = lambda stream, path: stream.read()
+
+        self.assertRaises(OSError, self.backup_service.backup_paths, ['/var/log/test'])
+
+    @patch.object(BackupService, 'now')
+    def test_backup_with_parallel_compression(self, date_now):
+        self.backup_service = BackupService(self.dropbox_client,
+                                            self.backup_name,
+                                            compress_level=6,
+                                            compress_threads=4)
+        date_now.return_value = datetime(2020, 5, 10, 17, 15, 30)
+
+        uploaded = {}
+
+        def upload_file(backup_file, path):
+            backup_file.seek(0)
+            uploaded[path] = backup_file.read()
+
+        self.dropbox_client.upload_file.side_effect = upload_file
+
+        with tempfile.TemporaryDirectory() as backup_dir:
+            with open(os.path.join(backup_dir, 'data'), 'wb') as data_file:
+                data_file.write(b'backup data\n' * 100000)
+
+            self.backup_service.backup_paths([backup_dir])
+
+        expected_filepath = '/{}/2020-05-10-1715.tar.gz'.format(self.backup_name)
+        with tarfile.open(fileobj=io.BytesIO(uploaded[expected_filepath]), mode='r:gz') as archive:
+            data = archive.extractfile(os.path.join(backup_dir, 'data').lstrip('/')).read()
+        self.assertEqual(b'backup data\n' * 100000, data)
+
+    @patch.object(BackupService, 'now')
+    def test_interrupted_upload_is_resumed_on_next_run(self, date_now):
+        uploaded = []
+
+        def failing_upload(backup_file, path, session_state):
+            session_state.save(path, 'checksum', 'session', 0)
+            raise ConnectionError('network down')
+
+        def upload(backup_file, path, session_state):
+            uploaded.append((path, backup_file.read()))
+
+        with tempfile.TemporaryDirectory() as state_dir, \
+                tempfile.TemporaryDirectory() as backup_dir:
+            self.backup_service = BackupService(self.dropbox_client,
+                                                self.backup_name,
+                                                resume_dir=state_dir)
+            with open(os.path.join(backup_dir, 'data'), 'wb') as data_file:
+                data_file.write(b'backup data')
+            pending_path = os.path.join(state_dir, BackupService.PENDING_UPLOAD_FILE)
+
+            date_now.return_value = datetime(2020, 5, 10, 17, 15, 30)
+            self.dropbox_client.upload_file.side_effect = failing_upload
+            # The archive is written to the pending upload only.
+            with patch('backup_to_dropbox.services.TemporaryFile', side_effect=AssertionError):
+                self.assertRaises(ConnectionError, self.backup_service.backup_paths, [backup_dir])
+            with open(pending_path, 'rb') as pending_file:
+                pending_data = pending_file.read()
+
+            date_now.return_value = datetime(2020, 5, 11, 17, 15, 30)
+            self.dropbox_client.list_content_hashes.return_value = {}
+            self.dropbox_client.upload_file.side_effect = upload
+            self.backup_service.backup_paths([backup_dir])
+
+            self.assertFalse(os.path.exists(pending_path))
+
+        self.assertEqual([('/{}/2020-05-10-1715.tar.gz'.format(self.backup_name), pending_data),
+                          ('/{}/2020-05-11-1715.tar.gz'.format(self.backup_name), ANY)],
+                         uploaded)
+
+    @patch.object(BackupService, 'now')
+    def test_pending_upload_already_committed_is_not_uploaded_again(self, date_now):
+        uploaded = []
+
+        def lost_response_upload(backup_file, path, session_state):
+            session_state.save(path, 'checksum', 'session', 0)
+            raise ConnectionError('response lost')
+
+        def upload(backup_file, path, session_state):
+            uploaded.append(path)
+
+        with tempfile.TemporaryDirectory() as state_dir, \
+                tempfile.TemporaryDirectory() as backup_dir:
+            self.backup_service = BackupService(self.dropbox_client,
+                                                self.backup_name,
+                                                resume_dir=state_dir)
+            with open(os.path.join(backup_dir, 'data'), 'wb') as data_file:
+                data_file.write(b'backup data')
+            pending_path = os.path.join(state_dir, BackupService.PENDING_UPLOAD_FILE)
+
+            date_now.return_value = datetime(2020, 5, 10, 17, 15, 30)
+            self.dropbox_client.upload_file.side_effect = lost_response_upload
+            self.assertRaises(ConnectionError, self.backup_service.backup_paths, [backup_dir])
+            content_hasher = ContentHasher()
+            with open(pending_path, 'rb') as pending_file:
+                content_hasher.update(pending_file.read())
+
+            date_now.return_value = datetime(2020, 5, 11, 17, 15, 30)
+            self.dropbox_client.list_content_hashes.return_value = {
+                '2020-05-10-1715.tar.gz': content_hasher.hexdigest()}
+            self.dropbox_client.upload_file.side_effect = upload
+            self.backup_service.backup_paths([backup_dir])
+
+            self.assertFalse(os.path.exists(pending_path))
+            self.assertEqual([], os.listdir(state_dir))
+
+        self.dropbox_client.list_content_hashes.assert_called_once_with('/' + self.backup_name)
+        self.assertEqual(['/{}/2020-05-11-1715.tar.gz'.format(self.backup_name)], uploaded)
+
+    @patch.object(BackupService, 'now')
+    @patch.object(BackupService, 'isfile')
+    @patch.object(BackupService, 'isdir')
+    @patch('tarfile.open')
+    def test_backup_filename_matches_codec(self, open_tarfile_mock, isdir_mock, isfile_mock,
+                                           date_now):
+        self.backup_service = BackupService(self.dropbox_client,
+                                            self.backup_name,
+                                            self.encryption_service,
+                                            codec=XzCodec())
+        date_now.return_value = datetime(2020, 5, 10, 17, 15, 30)
+        encrypted_file = Mock()
+        self.encryption_service.encrypt_stream.return_value = encrypted_file
+
+        self.backup_service.backup_paths(['/var/log/test'])
+
+        expected_filepath = '/{}/2020-05-10-1715.tar.xz.enc'.format(self.backup_name)
+        self.dropbox_client.upload_file.assert_called_once_with(encrypted_file, expected_filepath)
+
+    def test_cleanup_deletes_all_files_of_a_backup(self):
+        self.dropbox_client.list_files.return_value = [
+            '2020-05-02-0000.tar.gz',
+            '2020-05-01-0000.tar.gz',
+            '2020-05-01-0000.manifest.gz',
+            'unrelated-file',
+        ]
 
+        self.backup_service.cleanup_old_backups(1)
 
+        self.dropbox_client.delete_files.assert_called_once_with([
+            '/{}/2020-05-01-0000.manifest.gz'.format(self.backup_name),
+            '/{}/2020-05-01-0000.tar.gz'.format(self.backup_name),
+        ])
+
+    @patch.object(BackupService, 'now')
+    def test_cleanup_ignores_backups_being_generated(self, date_now):
+        date_now.return_value = datetime(2020, 5, 3, 0, 0, 30)
+        self.dropbox_client.list_files.return_value = [
+            '2020-05-01-0000.tar.gz',
+            '2020-05-02-0000.tar.gz',
+            '2020-05-03-0000.tar.gz',
+        ]
+
+        self.backup_service.cleanup_old_backups(1)
+
+        self.dropbox_client.delete_files.assert_called_once_with([
+            '/{}/2020-05-01-0000.tar.gz'.format(self.backup_name)])
+
+    def test_cleanup_keeps_full_backup_of_kept_incrementals(self):
+        self.dropbox_client.list_files.return_value = [
+            '2020-05-01-0000.tar.gz',
+            '2020-05-02-0000.tar.gz',
+            '2020-05-03-0000.incr.tar.gz',
+            '2020-05-04-0000.incr.tar.gz',
+            '2020-05-05-0000.tar.gz',
+        ]
+
+        self.backup_service.cleanup_old_backups(2)
+
+        self.dropbox_client.delete_files.assert_called_once_with(
+            ['/{}/2020-05-01-0000.tar.gz'.format(self.backup_name)])
+
+    def test_cleanup_keeps_full_backup_the_next_incremental_depends_on(self):
+        incremental_state = Mock()
+        incremental_state.next_is_full.return_value = False
+        self.backup_service = BackupService(self.dropbox_client,
+                                            self.backup_name,
+                                            incremental_state=incremental_state)
+        self.dropbox_client.list_files.return_value = [
+            '2020-05-01-0000.tar.gz',
+            '2020-05-02-0000.tar.gz',
+            '2020-05-03-0000.incr.tar.gz',
+        ]
+
+        self.backup_service.cleanup_old_backups(0)
+
+        self.dropbox_client.delete_files.assert_called_once_with(
+            ['/{}/2020-05-01-0000.tar.gz'.format(self.backup_name)])
+
+    @patch.object(BackupService, 'now')
+    def test_incremental_backup_only_archives_changes(self, date_now):
+        uploaded = {}
+
+        def upload_file(backup_file, path):
+            backup_file.seek(0)
+            uploaded[path] = backup_file.read()
+
+        self.dropbox_client.upload_file.side_effect = upload_file
+
+        with tempfile.TemporaryDirectory() as state_dir, \
+                tempfile.TemporaryDirectory() as backup_dir:
+            self.backup_service = BackupService(self.dropbox_client,
+                                                self.backup_name,
+                                                incremental_state=IncrementalBackupState(state_dir))
+            for name in ('unchanged', 'modified', 'removed'):
+                with open(os.path.join(backup_dir, name), 'w') as data_file:
+                    data_file.write(name)
+            date_now.return_value = datetime(2020, 5, 10, 17, 15, 30)
+            self.backup_service.backup_paths([backup_dir])
+
+            os.remove(os.path.join(backup_dir, 'removed'))
+            with open(os.path.join(backup_dir, 'modified'), 'w') as data_file:
+                data_file.write('modified again')
+            date_now.return_value = datetime(2020, 5, 11, 17, 15, 30)
+            self.backup_service.backup_paths([backup_dir])
+
+        self.assertEqual(['/{}/2020-05-10-1715.manifest.gz'.format(self.backup_name),
+                          '/{}/2020-05-10-1715.tar.gz'.format(self.backup_name),
+                          '/{}/2020-05-11-1715.incr.tar.gz'.format(self.backup_name),
+                          '/{}/2020-05-11-1715.manifest.gz'.format(self.backup_name)],
+                         sorted(uploaded))
+
+        arcname = backup_dir.lstrip('/')
+        full_path = '/{}/2020-05-10-1715.tar.gz'.format(self.backup_name)
+        with tarfile.open(fileobj=io.BytesIO(uploaded[full_path]), mode='r:gz') as archive:
+            self.assertEqual({arcname + '/modified', arcname + '/removed', arcname + '/unchanged'},
+                             {name for name in archive.getnames() if name.startswith(arcname + '/')})
+
+        incremental_path = '/{}/2020-05-11-1715.incr.tar.gz'.format(self.backup_name)
+        with tarfile.open(fileobj=io.BytesIO(uploaded[incremental_path]), mode='r:gz') as archive:
+            self.assertEqual([arcname, arcname + '/modified', BackupService.DELETED_PATHS_MEMBER],
+                             archive.getnames())
+            deleted = archive.extractfile(BackupService.DELETED_PATHS_MEMBER).read()
+        self.assertEqual(os.fsencode(os.path.join(backup_dir, 'removed')) + b'\0', deleted)
+
+    @patch.object(BackupService, 'now')
+    def test_backup_skips_excluded_paths(self, date_now):
+        metrics = RunMetrics()
+        self.backup_service = BackupService(self.dropbox_client,
+                                            self.backup_name,
+                                            exclude_patterns=['.cache/', '*.tmp'],
+                                            metrics=metrics)
+        date_now.return_value = datetime(2020, 5, 10, 17, 15, 30)
+        uploaded = []
+
+        def upload_file(backup_file, path):
+            backup_file.seek(0)
+            uploaded.append(backup_file.read())
+
+        self.dropbox_client.upload_file.side_effect = upload_file
+
+        with tempfile.TemporaryDirectory() as backup_dir:
+            os.makedirs(os.path.join(backup_dir, 'home', '.cache'))
+            for name in ('home/notes.txt', 'home/.cache/data', 'home/download.tmp'):
+                with open(os.path.join(backup_dir, name), 'w') as data_file:
+                    data_file.write(name)
+
+            self.backup_service.backup_paths([backup_dir])
+
+        arcname = backup_dir.lstrip('/')
+        with tarfile.open(fileobj=io.BytesIO(uploaded[0]), mode='r:gz') as archive:
+            self.assertEqual([arcname, arcname + '/home', arcname + '/home/notes.txt'],
+                             archive.getnames())
+        counters = metrics.report()['counters']
+        self.assertEqual(1, counters['excluded_files'])
+        self.assertEqual(len('home/download.tmp'), counters['excluded_bytes'])
+        self.assertEqual(1, counters['excluded_directories'])
+
+    @patch.object(BackupService, 'now')
+    def test_backup_skips_holes_and_data_of_hard_links(self, date_now):
+        metrics = RunMetrics()
+        self.backup_service = BackupService(self.dropbox_client,
+                                            self.backup_name,
+                                            metrics=metrics)
+        date_now.return_value = datetime(2020, 5, 10, 17, 15, 30)
+        uploaded = []
+
+        def upload_file(backup_file, path):
+            backup_file.seek(0)
+            uploaded.append(backup_file.read())
+
+        self.dropbox_client.upload_file.side_effect = upload_file
+
+        with tempfile.TemporaryDirectory() as backup_dir:
+            with open(os.path.join(backup_dir, 'disk.img'), 'wb') as image_file:
+                image_file.write(b'boot' * 1024)
+                image_file.truncate(64 * 1024 * 1024)
+            os.link(os.path.join(backup_dir, 'disk.img'), os.path.join(backup_dir, 'link.img'))
+            if os.stat(os.path.join(backup_dir, 'disk.img')).st_blocks * 512 >= 64 * 1024 * 1024:
+                self.skipTest('The filesystem does not support sparse files')
+
+            self.backup_service.backup_paths([backup_dir])
+
+            with tempfile.TemporaryDirectory() as restore_dir:
+                with tarfile.open(fileobj=io.BytesIO(uploaded[0]), mode='r:gz') as archive:
+                    archive.extractall(restore_dir)
+                restored_path = os.path.join(restore_dir, backup_dir.lstrip('/'), 'link.img')
+                with open(restored_path, 'rb') as restored_file:
+                    self.assertEqual(b'boot' * 1024, restored_file.read(4096))
+                    self.assertEqual(64 * 1024 * 1024, restored_file.seek(0, io.SEEK_END))
+                self.assertLess(os.stat(restored_path).st_blocks * 512, 1024 * 1024)
+
+        self.assertLess(len(uploaded[0]), 1024 * 1024)
+        counters = metrics.report()['counters']
+        self.assertEqual(1, counters['sparse_files'])
+        self.assertGreater(counters['sparse_bytes_skipped'], 63 * 1024 * 1024)
+        self.assertEqual(64 * 1024 * 1024, counters['hardlink_bytes_skipped'])
+
+    @patch.object(BackupService, 'now')
+    def test_volume_backup_splits_paths_in_archives(self, date_now):
+        uploaded = {}
+
+        def upload_file(backup_file, path):
+            uploaded[path] = backup_file.read()
+
+        self.dropbox_client.upload_file.side_effect = upload_file
+        self.encryption_service.encrypt_stream.side_effect = lambda volume_file: volume_file
+        self.encryption_service.encrypt.side_effect = lambda volume_list: volume_list
+
+        with tempfile.TemporaryDirectory() as state_dir, \
+                tempfile.TemporaryDirectory() as backup_dir:
+            self.backup_service = BackupService(self.dropbox_client,
+                                                self.backup_name,
+                                                self.encryption_service,
+                                                incremental_state=IncrementalBackupState(state_dir),
+                                                volume_size=3100,
+                                                volume_workers=2)
+            for name in ('a', 'b', 'c', 'removed'):
+                with open(os.path.join(backup_dir, name), 'wb') as data_file:
+                    data_file.write(os.urandom(1000))
+            date_now.return_value = datetime(2020, 5, 10, 17, 15, 30)
+            self.backup_service.backup_paths([backup_dir])
+            os.remove(os.path.join(backup_dir, 'removed'))
+            uploaded.clear()
+            date_now.return_value = datetime(2020, 5, 11, 17, 15, 30)
+            self.backup_service.backup_paths([backup_dir])
+
+        base_path = '/{}/2020-05-11-1715'.format(self.backup_name)
+        self.assertEqual([base_path + '-part0001.incr.tar.gz.enc',
+                          base_path + '.manifest.gz.enc',
+                          base_path + '.volumes.json.enc'],
+                         sorted(uploaded))
+        volume_list = json.loads(uploaded[base_path + '.volumes.json.enc'].decode('utf-8'))
+        self.assertEqual(['2020-05-11-1715-part0001.incr.tar.gz.enc'],
+                         [volume['name'] for volume in volume_list['volumes']])
+        volume_data = uploaded[base_path + '-part0001.incr.tar.gz.enc']
+        with tarfile.open(fileobj=io.BytesIO(volume_data), mode='r:gz') as archive:
+            self.assertEqual([backup_dir.lstrip('/'), BackupService.DELETED_PATHS_MEMBER],
+                             archive.getnames())
+
+    @patch.object(BackupService, 'now')
+    def test_volume_backup_uploads_volumes_of_bounded_size(self, date_now):
+        uploaded = {}
+
+        def upload_file(backup_file, path):
+            uploaded[path] = backup_file.read()
+
+        self.dropbox_client.upload_file.side_effect = upload_file
+        metrics = RunMetrics()
+        self.backup_service = BackupService(self.dropbox_client,
+                                            self.backup_name,
+                                            metrics=metrics,
+                                            volume_size=3100,
+                                            volume_workers=2)
+        date_now.return_value = datetime(2020, 5, 10, 17, 15, 30)
+
+        with tempfile.TemporaryDirectory() as backup_dir:
+            for name in ('a', 'b', 'c', 'd', 'e'):
+                with open(os.path.join(backup_dir, name), 'wb') as data_file:
+                    data_file.write(os.urandom(1000))
+            self.backup_service.backup_paths([backup_dir])
+
+        base_path = '/{}/2020-05-10-1715'.format(self.backup_name)
+        volume_names = ['2020-05-10-1715-part{:04d}.tar.gz'.format(number)
+                        for number in range(1, 4)]
+        self.assertEqual(['/{}/{}'.format(self.backup_name, name) for name in volume_names] +
+                         [base_path + '.volumes.json'],
+                         sorted(uploaded))
+        volume_list = json.loads(uploaded[base_path + '.volumes.json'].decode('utf-8'))
+        self.assertEqual(volume_names, [volume['name'] for volume in volume_list['volumes']])
+        self.assertEqual([2, 2, 2], [volume['entries'] for volume in volume_list['volumes']])
+
+        arcname = backup_dir.lstrip('/')
+        names = []
+        for name in volume_names:
+            volume_data = uploaded['/{}/{}'.format(self.backup_name, name)]
+            with tarfile.open(fileobj=io.BytesIO(volume_data), mode='r:gz') as archive:
+                names.extend(archive.getnames())
+        self.assertEqual([arcname] + [arcname + '/' + name for name in 'abcde'], names)
+        self.assertEqual(3, metrics.report()['stages']['archive']['calls'])
+
+    @patch.object(BackupService, 'now')
+    def test_failed_volume_backup_deletes_uploaded_volumes(self, date_now):
+        def upload_file(backup_file, path):
+            if path.endswith('-part0002.tar.gz'):
+                raise IOError('upload failed')
+
+        self.dropbox_client.upload_file.side_effect = upload_file
+        self.backup_service = BackupService(self.dropbox_client,
+                                            self.backup_name,
+                                            volume_size=1500,
+                                            volume_workers=1)
+        date_now.return_value = datetime(2020, 5, 10, 17, 15, 30)
+
+        with tempfile.TemporaryDirectory() as backup_dir:
+            for name in ('a', 'b', 'c'):
+                with open(os.path.join(backup_dir, name), 'wb') as data_file:
+                    data_file.write(os.urandom(1000))
+            with self.assertRaises(IOError):
+                self.backup_service.backup_paths([backup_dir])
+
+        deleted = self.dropbox_client.delete_files.call_args[0][0]
+        self.assertIn('/{}/2020-05-10-1715-part0001.tar.gz'.format(self.backup_name), deleted)
+        self.assertNotIn('/{}/2020-05-10-1715-part0002.tar.gz'.format(self.backup_name), deleted)
+
+    def test_cleanup_deletes_all_volumes_of_a_backup(self):
+        self.dropbox_client.list_files.return_value = [
+            '2020-05-01-0000-part0001.tar.gz',
+            '2020-05-01-0000-part0002.tar.gz',
+            '2020-05-01-0000.volumes.json',
+            '2020-05-02-0000-part0001.tar.gz',
+            '2020-05-02-0000.volumes.json',
+        ]
+
+        self.backup_service.cleanup_old_backups(1)
+
+        self.dropbox_client.delete_files.assert_called_once_with([
+            '/{}/2020-05-01-0000-part0001.tar.gz'.format(self.backup_name),
+            '/{}/2020-05-01-0000-part0002.tar.gz'.format(self.backup_name),
+            '/{}/2020-05-01-0000.volumes.json'.format(self.backup_name),
+        ])
+
+    @patch.object(BackupService, 'now')
+    def test_dedup_backup_uploads_snapshot(self, date_now):
+        chunk_store = Mock()
+        chunk_store.store.side_effect = \
+            lambda base_dir, chunks: Snapshot([bytes(32) for _ in chunks], encrypted=False)
+        self.backup_service = BackupService(self.dropbox_client,
+                                            self.backup_name,
+                                            chunk_store=chunk_store)
+        date_now.return_value = datetime(2020, 5, 10, 17, 15, 30)
+
+        with tempfile.TemporaryDirectory() as backup_dir:
+            self.backup_service.backup_paths([backup_dir])
+
+        chunk_store.store.assert_called_once_with('/' + self.backup_name, ANY)
+        self.dropbox_client.upload_file.assert_called_once_with(
+            ANY, '/{}/2020-05-10-1715.snapshot'.format(self.backup_name))
+        snapshot_file = self.dropbox_client.upload_file.call_args[0][0]
+        self.assertEqual(Snapshot.MAGIC, snapshot_file.read(len(Snapshot.MAGIC)))
+
+    def test_cleanup_collects_garbage_of_dedup_backups(self):
+        chunk_store = Mock()
+        self.backup_service = BackupService(self.dropbox_client,
+                                            self.backup_name,
+                                            chunk_store=chunk_store)
+        self.dropbox_client.list_files.return_value = [
+            '2020-05-01-0000.snapshot',
+            '2020-05-02-0000.snapshot',
+            'chunks',
+        ]
+        kept_snapshot = Snapshot([b'a' * 32], encrypted=False)
+        self.dropbox_client.download_file.return_value = kept_snapshot.to_bytes()
+
+        self.backup_service.cleanup_old_backups(1)
+
+        self.dropbox_client.delete_files.assert_called_once_with(
+            ['/{}/2020-05-01-0000.snapshot'.format(self.backup_name)])
+        self.dropbox_client.download_file.assert_called_once_with(
+            '/{}/2020-05-02-0000.snapshot'.format(self.backup_name))
+        chunk_store.collect_garbage.assert_called_once_with('/' + self.backup_name, ANY)
+        kept_snapshots = chunk_store.collect_garbage.call_args[0][1]
+        self.assertEqual([kept_snapshot.digests], [snapshot.digests for snapshot in kept_snapshots])
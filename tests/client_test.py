@@ -1,15 +1,34 @@
+import hashlib
 import io
+import json
+import os
+import tempfile
 import unittest
 
-from unittest.mock import Mock, call
+from unittest.mock import ANY, Mock, PropertyMock, call, patch
 
-from dropbox.exceptions import ApiError
+from dropbox.exceptions import ApiError, InternalServerError, RateLimitError
 from dropbox.file_properties import LookupError
-from dropbox.files import (CommitInfo, UploadSessionCursor, WriteMode)
+from dropbox.files import (CommitInfo, DeleteArg, DeleteBatchJobStatus, DeleteBatchLaunch,
+                           DeleteBatchResult, DeleteBatchResultData, DeleteBatchResultEntry,
+                           DeleteError, FileMetadata, LookupError as FilesLookupError,
+                           UploadSessionAppendError,
+                           UploadSessionCursor, UploadSessionOffsetError, UploadSessionType,
+                           WriteMode)
+from requests.exceptions import ChunkedEncodingError, ConnectionError
 
-from backup_to_dropbox.clients import DropboxClient
+from backup_to_dropbox.clients import (AdaptiveChunkSizer, ContentHasher, DropboxClient,
+                                       UploadSessionState)
+from backup_to_dropbox.metrics import RunMetrics
+from backup_to_dropbox.throttle import BandwidthLimiter, BandwidthSchedule
 
 
+def small_upload_chunks(test):
+    """Makes upload sessions use fixed 4 byte chunks."""
+    for name in ('UPLOAD_ALIGNMENT', 'INITIAL_CHUNK_SIZE', 'MAX_CHUNK_SIZE', 'CONCURRENT_CHUNK_SIZE'):
+        test = patch.object(DropboxClient, name, 4)(test)
+    return test
+
 
 class DropboxClientTest(unittest.TestCase):
     def setUp(self):
@@ -24,7 +43,7 @@ class DropboxClientTest(unittest.TestCase):
     def test_listing_files_on_empty_folder(self):
         folder_path = '/test/'
 
-        api_call_result = Mock(entries=[])
+        api_call_result = Mock(entries=[], has_more=False)
 
         self.api_mock.files_list_folder = Mock(return_value=api_call_result)
         files_found = self.dropbox_client.list_files(folder_path)
@@ -39,7 +58,7 @@ class DropboxClientTest(unittest.TestCase):
         file_2 = Mock()
         file_2.configure_mock(name='2020-02')
 
-        api_call_result = Mock(entries=[file_1, file_2])
+        api_call_result = Mock(entries=[file_1, file_2], has_more=False)
         expected_files_found = ['2020-01', '2020-02']
 
         self.api_mock.files_list_folder = Mock(return_value=api_call_result)
@@ -47,6 +66,56 @@ class DropboxClientTest(unittest.TestCase):
         self.assertEqual(expected_files_found, files_found)
         self.api_mock.files_list_folder.assert_called_once_with(folder_path)
 
+    def test_listing_files_follows_pagination(self):
+        folder_path = '/test/'
+        file_1 = Mock()
+        file_1.configure_mock(name='2020-01')
+        file_2 = Mock()
+        file_2.configure_mock(name='2020-02')
+
+        self.api_mock.files_list_folder.return_value = Mock(entries=[file_1],
+                                                            has_more=True,
+                                                            cursor='cursor-1')
+        self.api_mock.files_list_folder_continue.return_value = Mock(entries=[file_2],
+                                                                     has_more=False)
+
+        self.assertEqual(['2020-01', '2020-02'], self.dropbox_client.list_files(folder_path))
+        self.api_mock.files_list_folder_continue.assert_called_once_with('cursor-1')
+
+    @patch.object(DropboxClient, 'DELETE_BATCH_SIZE', 2)
+    @patch('time.sleep')
+    def test_deleting_files_in_batches(self, sleep_mock):
+        success = DeleteBatchResultEntry.success(DeleteBatchResultData(FileMetadata(name="1", id="id:1")))
+        not_found = DeleteBatchResultEntry.failure(
+            DeleteError.path_lookup(FilesLookupError.not_found))
+        self.api_mock.files_delete_batch.side_effect = [
+            DeleteBatchLaunch.complete(DeleteBatchResult([success, not_found])),
+            DeleteBatchLaunch.async_job_id('job-1'),
+        ]
+        self.api_mock.files_delete_batch_check.side_effect = [
+            DeleteBatchJobStatus('in_progress'),
+            DeleteBatchJobStatus.complete(DeleteBatchResult([success])),
+        ]
+
+        self.dropbox_client.delete_files(['/test/1', '/test/2', '/test/3'])
+
+        self.api_mock.files_delete_batch.assert_has_calls([
+            call([DeleteArg('/test/1'), DeleteArg('/test/2')]),
+            call([DeleteArg('/test/3')]),
+        ])
+        self.assertEqual(2, self.api_mock.files_delete_batch_check.call_count)
+        self.api_mock.files_delete_batch_check.assert_called_with('job-1')
+
+    def test_deleting_files_failure_raises_error(self):
+        failure = DeleteBatchResultEntry.failure(DeleteError.too_many_write_operations)
+        self.api_mock.files_delete_batch.return_value = \
+            DeleteBatchLaunch.complete(DeleteBatchResult([failure]))
+
+        self.assertRaisesRegex(Exception,
+                               '/test/1',
+                               self.dropbox_client.delete_files,
+                               ['/test/1'])
+
     def test_listing_files_on_non_existing_folder(self):
         folder_path = '/test/'
 
@@ -118,3 +187,439 @@ class DropboxClientTest(unittest.TestCase):
         ])
         file_mock.seek.assert_called_with(0)
 
+    def test_upload_small_stream_single_request(self):
+        file_path = '/test/12345'
+        stream = io.BytesIO(b'abcdefg')
+        stream.seekable = Mock(return_value=False)
+
+        self.dropbox_client.upload_file(stream, file_path)
+        self.api_mock.files_upload.assert_called_once_with(b'abcdefg', file_path)
+
+    def test_upload_big_stream_multiple_requests(self):
+        session_id = Mock(session_id='12345')
+        file_path = '/test/12345'
+        file_chunks = [
+            'a' * DropboxClient.SINGLE_REQ_UPLOAD_SIZE_LIMIT,
+            'b' * DropboxClient.SINGLE_REQ_UPLOAD_SIZE_LIMIT,
+            '',
+        ]
+        stream = Mock()
+        stream.seekable = Mock(return_value=False)
+        stream.read = Mock(side_effect=file_chunks)
+
+        self.api_mock.files_upload_session_start.return_value = session_id
+        self.dropbox_client.upload_file(stream, file_path)
+
+        self.api_mock.files_upload.assert_not_called()
+        self.api_mock.files_upload_session_start.assert_called_once_with(file_chunks[0])
+        self.api_mock.files_upload_session_finish.assert_called_once_with(
+            '',
+            UploadSessionCursor('12345', DropboxClient.SINGLE_REQ_UPLOAD_SIZE_LIMIT * 2),
+            CommitInfo(path=file_path,
+                       mode=WriteMode('add'),
+                       autorename=False)
+        )
+        stream.seek.assert_not_called()
+
+    @patch.object(DropboxClient, 'SINGLE_REQ_UPLOAD_SIZE_LIMIT', 10)
+    @small_upload_chunks
+    def test_upload_big_file_concurrent_session(self):
+        self.dropbox_client = DropboxClient(self.api_mock, upload_concurrency=3)
+        file_path = '/test/12345'
+        self.api_mock.files_upload_session_start.return_value = Mock(session_id='12345')
+
+        self.dropbox_client.upload_file(io.BytesIO(b'abcdefghijklmn'), file_path)
+
+        self.api_mock.files_upload_session_start.assert_called_once_with(
+            b'',
+            session_type=UploadSessionType.concurrent
+        )
+        self.api_mock.files_upload_session_append_v2.assert_has_calls([
+            call(b'abcd', UploadSessionCursor('12345', 0), close=False),
+            call(b'efgh', UploadSessionCursor('12345', 4), close=False),
+            call(b'ijkl', UploadSessionCursor('12345', 8), close=False),
+            call(b'mn', UploadSessionCursor('12345', 12), close=True),
+        ], any_order=True)
+        self.assertEqual(4, self.api_mock.files_upload_session_append_v2.call_count)
+        self.api_mock.files_upload_session_finish.assert_called_once_with(
+            b'',
+            UploadSessionCursor('12345', 14),
+            CommitInfo(path=file_path,
+                       mode=WriteMode('add'),
+                       autorename=False)
+        )
+
+    @patch.object(DropboxClient, 'SINGLE_REQ_UPLOAD_SIZE_LIMIT', 10)
+    @small_upload_chunks
+    @patch('time.sleep')
+    def test_concurrent_upload_retries_failed_chunk(self, sleep_mock):
+        self.dropbox_client = DropboxClient(self.api_mock, upload_concurrency=2)
+        self.api_mock.files_upload_session_start.return_value = Mock(session_id='12345')
+        failures = [InternalServerError('1', 503, None)]
+
+        def append(chunk, cursor, close):
+            if cursor.offset == 4 and failures:
+                raise failures.pop()
+
+        self.api_mock.files_upload_session_append_v2.side_effect = append
+
+        self.dropbox_client.upload_file(io.BytesIO(b'abcdefghijk'), '/test/12345')
+
+        self.assertEqual(4, self.api_mock.files_upload_session_append_v2.call_count)
+        self.api_mock.files_upload_session_finish.assert_called_once_with(
+            b'', UploadSessionCursor('12345', 11), ANY)
+
+    @patch.object(DropboxClient, 'SINGLE_REQ_UPLOAD_SIZE_LIMIT', 10)
+    @small_upload_chunks
+    @patch('time.sleep')
+    def test_upload_records_bytes_retries_and_chunk_latencies(self, sleep_mock):
+        metrics = RunMetrics()
+        self.dropbox_client = DropboxClient(self.api_mock, metrics=metrics)
+        self.api_mock.files_upload_session_start.return_value = Mock(session_id='12345')
+        self.api_mock.files_upload_session_append_v2.side_effect = [
+            InternalServerError('1', 503, None), None, None]
+
+        self.dropbox_client.upload_file(io.BytesIO(b'abcdefghijk'), '/test/12345')
+
+        report = metrics.report()
+        self.assertEqual(1, report['stages']['upload']['calls'])
+        self.assertEqual(11, report['stages']['upload']['bytes_out'])
+        self.assertEqual({'upload_retries': 1}, report['counters'])
+        self.assertEqual(2, report['samples']['upload_chunk_seconds']['count'])
+
+    @patch.object(DropboxClient, 'SINGLE_REQ_UPLOAD_SIZE_LIMIT', 10)
+    @small_upload_chunks
+    @patch('time.sleep')
+    def test_concurrent_upload_failure_does_not_commit(self, sleep_mock):
+        self.dropbox_client = DropboxClient(self.api_mock, upload_concurrency=2)
+        self.api_mock.files_upload_session_start.return_value = Mock(session_id='12345')
+        self.api_mock.files_upload_session_append_v2.side_effect = \
+            InternalServerError('1', 503, None)
+
+        self.assertRaises(InternalServerError,
+                          self.dropbox_client.upload_file,
+                          io.BytesIO(b'abcdefghijk'),
+                          '/test/12345')
+        self.api_mock.files_upload_session_finish.assert_not_called()
+
+    def test_upload_overwriting_existing_file(self):
+        file_path = '/test/12345'
+
+        self.dropbox_client.upload_file(io.BytesIO(b'abcdefg'), file_path, overwrite=True)
+
+        self.api_mock.files_upload.assert_called_once_with(b'abcdefg',
+                                                           file_path,
+                                                           mode=WriteMode('overwrite'))
+
+    @patch.object(DropboxClient, 'SINGLE_REQ_UPLOAD_SIZE_LIMIT', 4)
+    @small_upload_chunks
+    def test_upload_realigns_to_offset_reported_by_server(self):
+        self.api_mock.files_upload_session_start.return_value = Mock(session_id='12345')
+        offset_error = UploadSessionAppendError.incorrect_offset(
+            UploadSessionOffsetError(correct_offset=6))
+        self.api_mock.files_upload_session_append_v2.side_effect = [
+            ApiError('1', offset_error, None, None),
+            None,
+        ]
+
+        self.dropbox_client.upload_file(io.BytesIO(b'abcdefghij'), '/test/12345')
+
+        self.api_mock.files_upload_session_append_v2.assert_has_calls([
+            call(b'efgh', UploadSessionCursor('12345', 4)),
+            call(b'gh', UploadSessionCursor('12345', 6)),
+        ])
+        self.api_mock.files_upload_session_finish.assert_called_once_with(
+            b'ij', UploadSessionCursor('12345', 8), ANY)
+
+    @patch.object(DropboxClient, 'SINGLE_REQ_UPLOAD_SIZE_LIMIT', 4)
+    @small_upload_chunks
+    def test_resumable_upload_persists_acknowledged_offset(self):
+        self.api_mock.files_upload_session_start.return_value = Mock(session_id='12345')
+        self.api_mock.files_upload_session_finish.side_effect = OSError('network down')
+        data = b'abcdefghij'
+
+        with tempfile.TemporaryDirectory() as state_dir:
+            state_path = os.path.join(state_dir, 'upload.json')
+            self.assertRaises(OSError,
+                              self.dropbox_client.upload_file,
+                              io.BytesIO(data),
+                              '/test/12345',
+                              session_state=UploadSessionState(state_path))
+
+            with open(state_path) as state_file:
+                state = json.load(state_file)
+
+        self.assertEqual({'path': '/test/12345',
+                          'checksum': DropboxClient._file_checksum(io.BytesIO(data)),
+                          'session_id': '12345',
+                          'offset': 8}, state)
+
+    @patch.object(DropboxClient, 'SINGLE_REQ_UPLOAD_SIZE_LIMIT', 4)
+    @small_upload_chunks
+    def test_resumable_upload_continues_saved_session(self):
+        data = b'abcdefghij'
+
+        with tempfile.TemporaryDirectory() as state_dir:
+            session_state = UploadSessionState(os.path.join(state_dir, 'upload.json'))
+            session_state.save('/test/12345',
+                               DropboxClient._file_checksum(io.BytesIO(data)),
+                               'saved-session',
+                               4)
+
+            self.dropbox_client.upload_file(io.BytesIO(data),
+                                            '/test/12345',
+                                            session_state=session_state)
+
+            self.assertIsNone(session_state.load())
+
+        self.api_mock.files_upload_session_start.assert_not_called()
+        self.api_mock.files_upload_session_append_v2.assert_called_once_with(
+            b'efgh', UploadSessionCursor('saved-session', 4))
+        self.api_mock.files_upload_session_finish.assert_called_once_with(
+            b'ij', UploadSessionCursor('saved-session', 8), ANY)
+
+    @patch.object(DropboxClient, 'SINGLE_REQ_UPLOAD_SIZE_LIMIT', 4)
+    @small_upload_chunks
+    def test_resumable_upload_starts_over_when_source_changed(self):
+        self.api_mock.files_upload_session_start.return_value = Mock(session_id='12345')
+
+        with tempfile.TemporaryDirectory() as state_dir:
+            session_state = UploadSessionState(os.path.join(state_dir, 'upload.json'))
+            session_state.save('/test/12345', 'other checksum', 'saved-session', 4)
+
+            self.dropbox_client.upload_file(io.BytesIO(b'abcdefghij'),
+                                            '/test/12345',
+                                            session_state=session_state)
+
+        self.api_mock.files_upload_session_start.assert_called_once_with(b'abcd')
+        self.api_mock.files_upload_session_finish.assert_called_once_with(
+            b'ij', UploadSessionCursor('12345', 8), ANY)
+
+    @patch.object(DropboxClient, 'SINGLE_REQ_UPLOAD_SIZE_LIMIT', 4)
+    @small_upload_chunks
+    def test_resumable_upload_starts_over_when_session_expired(self):
+        data = b'abcdefghij'
+        self.api_mock.files_upload_session_start.return_value = Mock(session_id='12345')
+
+        def append(chunk, cursor):
+            if cursor.session_id == 'saved-session':
+                raise ApiError('1', UploadSessionAppendError.not_found, None, None)
+
+        self.api_mock.files_upload_session_append_v2.side_effect = append
+
+        with tempfile.TemporaryDirectory() as state_dir:
+            session_state = UploadSessionState(os.path.join(state_dir, 'upload.json'))
+            session_state.save('/test/12345',
+                               DropboxClient._file_checksum(io.BytesIO(data)),
+                               'saved-session',
+                               4)
+
+            self.dropbox_client.upload_file(io.BytesIO(data),
+                                            '/test/12345',
+                                            session_state=session_state)
+
+        self.api_mock.files_upload_session_start.assert_called_once_with(b'abcd')
+        self.api_mock.files_upload_session_finish.assert_called_once_with(
+            b'ij', UploadSessionCursor('12345', 8), ANY)
+
+    @patch.object(DropboxClient, 'UPLOAD_ALIGNMENT', 4)
+    @patch.object(DropboxClient, 'INITIAL_CHUNK_SIZE', 8)
+    def test_upload_memory_limit_bounds_requests(self):
+        self.dropbox_client = DropboxClient(self.api_mock, max_upload_memory=4)
+        self.api_mock.files_upload_session_start.return_value = Mock(session_id='12345')
+
+        self.dropbox_client.upload_file(io.BytesIO(b'abcdefghij'), '/test/12345')
+
+        self.api_mock.files_upload.assert_not_called()
+        self.api_mock.files_upload_session_start.assert_called_once_with(b'abcd')
+        self.api_mock.files_upload_session_append_v2.assert_called_once_with(
+            b'efgh', UploadSessionCursor('12345', 4))
+        self.api_mock.files_upload_session_finish.assert_called_once_with(
+            b'ij', UploadSessionCursor('12345', 8), ANY)
+
+    def test_memory_limit_below_the_min_chunk_size_still_uploads_small_files_at_once(self):
+        self.dropbox_client = DropboxClient(self.api_mock, max_upload_memory=3 * 1024 * 1024)
+        data = b'a' * (3 * 1024 * 1024 + 10)
+
+        self.dropbox_client.upload_file(io.BytesIO(data), '/test/12345')
+
+        self.api_mock.files_upload.assert_called_once_with(data, '/test/12345')
+        self.api_mock.files_upload_session_start.assert_not_called()
+        self.api_mock.files_upload_session_finish.assert_not_called()
+
+    @small_upload_chunks
+    @patch.object(DropboxClient, '_single_request_limit', return_value=0)
+    def test_session_with_a_single_short_chunk_uploads_it_at_once(self, limit_mock):
+        self.dropbox_client.upload_file(io.BytesIO(b'abc'), '/test/12345', overwrite=True)
+
+        self.api_mock.files_upload.assert_called_once_with(b'abc', '/test/12345',
+                                                           mode=WriteMode('overwrite'))
+        self.api_mock.files_upload_session_start.assert_not_called()
+        self.api_mock.files_upload_session_finish.assert_not_called()
+
+    @patch.object(DropboxClient, 'UPLOAD_ALIGNMENT', 4)
+    @patch.object(DropboxClient, 'INITIAL_CHUNK_SIZE', 8)
+    def test_bandwidth_limit_bounds_and_paces_requests(self):
+        metrics = RunMetrics()
+        limiter = Mock()
+        limiter.burst_size.return_value = 4
+        limiter.acquire.return_value = 0.5
+        self.dropbox_client = DropboxClient(self.api_mock, metrics=metrics,
+                                            bandwidth_limiter=limiter)
+        self.api_mock.files_upload_session_start.return_value = Mock(session_id='12345')
+
+        self.dropbox_client.upload_file(io.BytesIO(b'abcdefghij'), '/test/12345')
+
+        self.api_mock.files_upload_session_start.assert_called_once_with(b'abcd')
+        self.api_mock.files_upload_session_append_v2.assert_called_once_with(
+            b'efgh', UploadSessionCursor('12345', 4))
+        self.assertEqual([call(4), call(4), call(2)], limiter.acquire.call_args_list)
+        stage = metrics.report()['stages']['bandwidth_wait']
+        self.assertEqual(3, stage['calls'])
+        self.assertEqual(1.5, stage['wall_time'])
+
+    @patch('time.sleep')
+    def test_bandwidth_limit_below_the_min_chunk_size_still_uploads_small_files_at_once(
+            self, sleep_mock):
+        limiter = BandwidthLimiter(BandwidthSchedule(['2']))
+        self.dropbox_client = DropboxClient(self.api_mock, bandwidth_limiter=limiter)
+        data = b'a' * (3 * 1024 * 1024)
+
+        self.dropbox_client.upload_file(io.BytesIO(data), '/test/12345')
+
+        self.assertLess(limiter.burst_size(), len(data))
+        self.api_mock.files_upload.assert_called_once_with(data, '/test/12345')
+        self.api_mock.files_upload_session_start.assert_not_called()
+        self.api_mock.files_upload_session_finish.assert_not_called()
+
+    @patch('random.random', return_value=0.5)
+    @patch('time.sleep')
+    def test_throttled_request_retries_after_the_time_given(self, sleep_mock, random_mock):
+        metrics = RunMetrics()
+        self.dropbox_client = DropboxClient(self.api_mock, metrics=metrics)
+        self.api_mock.files_upload.side_effect = [RateLimitError('1', backoff=2), None]
+
+        self.dropbox_client.upload_file(io.BytesIO(b'abc'), '/test/a')
+
+        self.assertEqual(call(2.5), sleep_mock.call_args_list[0])
+        self.assertEqual([call(b'abc', '/test/a')] * 2, self.api_mock.files_upload.call_args_list)
+        self.assertEqual({'throttled_requests': 1}, metrics.report()['counters'])
+
+    @patch('time.sleep')
+    def test_throttled_request_gives_up_after_max_retries(self, sleep_mock):
+        self.api_mock.files_delete_v2.side_effect = RateLimitError('1')
+
+        self.assertRaises(RateLimitError, self.dropbox_client.delete_file, '/test/a')
+        self.assertEqual(DropboxClient.MAX_THROTTLED_RETRIES + 1,
+                         self.api_mock.files_delete_v2.call_count)
+
+    def test_verified_upload_of_corrupted_file_is_deleted(self):
+        metrics = RunMetrics()
+        self.dropbox_client = DropboxClient(self.api_mock, metrics=metrics, verify_uploads=True)
+        hasher = ContentHasher()
+        hasher.update(b'abcdefg')
+        self.api_mock.files_upload.return_value = Mock(size=7, content_hash=hasher.hexdigest())
+
+        self.dropbox_client.upload_file(io.BytesIO(b'abcdefg'), '/test/12345')
+        self.api_mock.files_delete_v2.assert_not_called()
+
+        self.api_mock.files_upload.return_value = Mock(size=7, content_hash='0' * 64)
+        self.assertRaisesRegex(Exception, 'corrupted',
+                               self.dropbox_client.upload_file,
+                               io.BytesIO(b'abcdefg'),
+                               '/test/12345')
+        self.api_mock.files_delete_v2.assert_called_once_with('/test/12345')
+        self.assertEqual({'upload_verification_failures': 1}, metrics.report()['counters'])
+
+    def test_copy_file_checks_content_hash(self):
+        self.api_mock.files_copy_v2.return_value = Mock(metadata=Mock(content_hash='abc'))
+
+        self.dropbox_client.copy_file('/test/1', '/test/2', 'abc')
+        self.api_mock.files_copy_v2.assert_called_once_with('/test/1', '/test/2')
+
+        self.assertRaises(Exception, self.dropbox_client.copy_file, '/test/1', '/test/3', 'def')
+        self.api_mock.files_delete_v2.assert_called_once_with('/test/3')
+
+    def test_listing_content_hashes_skips_folders(self):
+        file_1 = FileMetadata(name='2020-01', content_hash='a' * 64)
+        folder = Mock()
+        folder.configure_mock(name='chunks')
+        self.api_mock.files_list_folder.return_value = Mock(entries=[file_1, folder],
+                                                            has_more=False)
+
+        self.assertEqual({'2020-01': 'a' * 64}, self.dropbox_client.list_content_hashes('/test'))
+
+    def test_download_file(self):
+        response = Mock(content=b'file contents')
+        self.api_mock.files_download.return_value = (Mock(), response)
+
+        self.assertEqual(b'file contents', self.dropbox_client.download_file('/test/12345'))
+        self.api_mock.files_download.assert_called_once_with('/test/12345')
+        response.close.assert_called_once()
+
+    @patch('time.sleep')
+    def test_download_file_retries_transient_errors(self, sleep_mock):
+        dropped = Mock()
+        type(dropped).content = PropertyMock(side_effect=ChunkedEncodingError('dropped'))
+        response = Mock(content=b'file contents')
+        self.api_mock.files_download.side_effect = [ConnectionError('reset'),
+                                                    (Mock(), dropped),
+                                                    (Mock(), response)]
+
+        self.assertEqual(b'file contents', self.dropbox_client.download_file('/test/12345'))
+        self.assertEqual(3, self.api_mock.files_download.call_count)
+        dropped.close.assert_called_once()
+
+
+class ContentHasherTest(unittest.TestCase):
+
+    @patch.object(ContentHasher, 'BLOCK_SIZE', 4)
+    def test_hashes_the_hashes_of_every_block(self):
+        hasher = ContentHasher()
+        for piece in (b'ab', b'cdefg', b'', b'hij'):
+            hasher.update(piece)
+
+        block_digests = b''.join(hashlib.sha256(block).digest()
+                                 for block in (b'abcd', b'efgh', b'ij'))
+        self.assertEqual(hashlib.sha256(block_digests).hexdigest(), hasher.hexdigest())
+        self.assertEqual(10, hasher.size)
+        self.assertEqual(hashlib.sha256().hexdigest(), ContentHasher().hexdigest())
+
+
+class AdaptiveChunkSizerTest(unittest.TestCase):
+    def setUp(self):
+        self.chunk_sizer = AdaptiveChunkSizer(4, 64, 8, 4, target_latency=10)
+
+    def test_grows_while_throughput_does_not_drop(self):
+        self.chunk_sizer.record(8, 1)
+        self.assertEqual(16, self.chunk_sizer.chunk_size)
+        self.chunk_sizer.record(16, 1)
+        self.assertEqual(32, self.chunk_sizer.chunk_size)
+
+    def test_shrinks_when_throughput_drops(self):
+        self.chunk_sizer.record(8, 1)
+        self.chunk_sizer.record(16, 4)
+        self.assertEqual(8, self.chunk_sizer.chunk_size)
+
+    def test_shrinks_when_requests_are_too_slow(self):
+        self.chunk_sizer.record(8, 11)
+        self.assertEqual(4, self.chunk_sizer.chunk_size)
+
+    def test_sizes_are_aligned_and_bounded(self):
+        chunk_sizer = AdaptiveChunkSizer(1, 30, 10, 4)
+        self.assertEqual(8, chunk_sizer.chunk_size)
+        for _ in range(5):
+            chunk_sizer.record(chunk_sizer.chunk_size, 1)
+        self.assertEqual(28, chunk_sizer.chunk_size)
+        for _ in range(5):
+            chunk_sizer.record(chunk_sizer.chunk_size, 100)
+        self.assertEqual(4, chunk_sizer.chunk_size)
+
+    def test_size_limit_bounds_sizes_while_set(self):
+        limit = [12]
+        chunk_sizer = AdaptiveChunkSizer(4, 64, 32, 4, size_limit=lambda: limit[0])
+        self.assertEqual(12, chunk_sizer.chunk_size)
+        limit[0] = 2
+        self.assertEqual(4, chunk_sizer.chunk_size)
+        limit[0] = None
+        self.assertEqual(32, chunk_sizer.chunk_size)
@@ -0,0 +1,142 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import tempfile
+import unittest
+import zlib
+
+from backup_to_dropbox.compression import (CODECS, CompressionBenchmark, ParallelGzipWriter,
+                                           SeekableGzipWriter, get_codec)
+
+class ParallelGzipWriterTest(unittest.TestCase):
+
+    def _compress(self, data, write_size=1000, **kwargs):
+        output = io.BytesIO()
+        with ParallelGzipWriter(output, **kwargs) as writer:
+            for i in range(0, len(data), write_size):
+                writer.write(data[i:i + write_size])
+        return output.getvalue()
+
+    def test_output_is_a_single_gzip_member(self):
+        data = b''.join(b'line %d of a repetitive text\n' % i for i in range(20000))
+
+        compressed = self._compress(data, threads=4, block_size=16 * 1024)
+
+        self.assertEqual(data, gzip.decompress(compressed))
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(data, decompressor.decompress(compressed))
+        self.assertTrue(decompressor.eof)
+        self.assertEqual(b'', decompressor.unused_data)
+
+    def test_incompressible_data(self):
+        data = os.urandom(200 * 1024)
+
+        compressed = self._compress(data, level=1, threads=3, block_size=32 * 1024)
+
+        self.assertEqual(data, gzip.decompress(compressed))
+
+    def test_empty_input(self):
+        self.assertEqual(b'', gzip.decompress(self._compress(b'', threads=2)))
+
+    def test_block_dictionary_improves_ratio(self):
+        data = os.urandom(8 * 1024) * 64
+
+        compressed = self._compress(data, threads=2, block_size=8 * 1024)
+
+        self.assertLess(len(compressed), 16 * 1024)
+
+    def test_tell_returns_uncompressed_size(self):
+        with ParallelGzipWriter(io.BytesIO(), threads=2) as writer:
+            writer.write(b'abc')
+            writer.write(b'defg')
+            self.assertEqual(7, writer.tell())
+
+
+class SeekableGzipWriterTest(unittest.TestCase):
+
+    def _compress(self, data, write_size=1000, **kwargs):
+        output = io.BytesIO()
+        with SeekableGzipWriter(output, **kwargs) as writer:
+            for i in range(0, len(data), write_size):
+                writer.write(data[i:i + write_size])
+            self.assertEqual(len(data), writer.tell())
+        return output.getvalue(), writer.blocks
+
+    def test_blocks_are_decompressed_on_their_own(self):
+        data = b''.join(b'line %d of a repetitive text\n' % i for i in range(20000))
+
+        compressed, blocks = self._compress(data, threads=3, block_size=64 * 1024)
+
+        self.assertEqual(data, gzip.decompress(compressed))
+        self.assertEqual([(offset, blocks[i][1]) for i, offset in
+                          enumerate(range(0, len(data), 64 * 1024))], blocks)
+        for input_offset, output_offset in blocks:
+            with gzip.GzipFile(fileobj=io.BytesIO(compressed[output_offset:])) as block_file:
+                self.assertEqual(data[input_offset:input_offset + 100], block_file.read(100))
+
+    def test_empty_input(self):
+        compressed, blocks = self._compress(b'')
+
+        self.assertEqual(b'', gzip.decompress(compressed))
+        self.assertEqual([(0, 0)], blocks)
+
+
+class CodecTest(unittest.TestCase):
+
+    def _compress(self, codec_name, data, level=None, threads=1):
+        output = io.BytesIO()
+        with get_codec(codec_name).open_writer(output, level, threads) as writer:
+            writer.write(data)
+            self.assertEqual(len(data), writer.tell())
+        self.assertFalse(output.closed)
+        return output.getvalue()
+
+    def test_no_compression(self):
+        self.assertEqual(b'content', self._compress('none', b'content'))
+
+    def test_gzip(self):
+        self.assertEqual(b'content', gzip.decompress(self._compress('gz', b'content', 1)))
+
+    def test_gzip_multiple_threads_uses_parallel_writer(self):
+        with get_codec('gz').open_writer(io.BytesIO(), 6, threads=2) as writer:
+            self.assertIsInstance(writer, ParallelGzipWriter)
+
+    def test_bzip2(self):
+        self.assertEqual(b'content', bz2.decompress(self._compress('bz2', b'content')))
+
+    def test_xz(self):
+        self.assertEqual(b'content', lzma.decompress(self._compress('xz', b'content', 0)))
+
+    def test_extensions(self):
+        self.assertEqual({'none': '.tar', 'gz': '.tar.gz', 'bz2': '.tar.bz2', 'xz': '.tar.xz'},
+                         {name: codec.extension for name, codec in CODECS.items()})
+
+
+class CompressionBenchmarkTest(unittest.TestCase):
+
+    def test_sample_is_bounded(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            for i in range(4):
+                with open(os.path.join(data_dir, str(i)), 'wb') as data_file:
+                    data_file.write(bytes([i]) * 1000)
+
+            sample = CompressionBenchmark(sample_size=2500).sample([data_dir])
+
+        self.assertEqual(b'\x00' * 1000 + b'\x01' * 1000 + b'\x02' * 500, sample)
+
+    def test_reports_every_codec(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            with open(os.path.join(data_dir, 'data'), 'wb') as data_file:
+                data_file.write(b'compressible ' * 10000)
+
+            results = CompressionBenchmark().run([data_dir])
+
+        self.assertEqual(set(CODECS), {codec for codec, _, _, _ in results})
+        for codec, level, throughput, ratio in results:
+            self.assertGreater(throughput, 0)
+            if codec == 'none':
+                self.assertEqual(1.0, ratio)
+            else:
+                self.assertLess(ratio, 0.1)
@@ -0,0 +1,101 @@
+import io
+import os
+import tempfile
+import unittest
+import zlib
+
+from unittest.mock import Mock
+
+from backup_to_dropbox.dedup import ChunkIndex, ChunkStore, ContentDefinedChunker, Snapshot
+
+class ContentDefinedChunkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chunker = ContentDefinedChunker(min_size=1024, avg_size=4096, max_size=16384)
+
+    def test_chunks_reassemble_the_stream(self):
+        data = os.urandom(200 * 1024)
+
+        chunks = list(self.chunker.split(io.BytesIO(data)))
+
+        self.assertEqual(data, b''.join(chunks))
+        self.assertTrue(all(1024 <= len(chunk) <= 16384 for chunk in chunks[:-1]))
+
+    def test_insertion_only_changes_nearby_chunks(self):
+        data = os.urandom(200 * 1024)
+        modified = data[:100000] + b'inserted' + data[100000:]
+
+        chunks = list(self.chunker.split(io.BytesIO(data)))
+        modified_chunks = list(self.chunker.split(io.BytesIO(modified)))
+
+        self.assertGreaterEqual(len(set(chunks) & set(modified_chunks)), len(chunks) - 3)
+
+    def test_data_without_anchors_is_cut_at_max_size(self):
+        chunks = list(self.chunker.split(io.BytesIO(b'\0' * 40000)))
+
+        self.assertEqual([16384, 16384, 7232], [len(chunk) for chunk in chunks])
+
+    def test_empty_stream(self):
+        self.assertEqual([], list(self.chunker.split(io.BytesIO(b''))))
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def test_serialization(self):
+        snapshot = Snapshot([b'a' * 32, b'b' * 32], encrypted=True)
+
+        parsed = Snapshot.from_bytes(snapshot.to_bytes())
+
+        self.assertEqual(snapshot.digests, parsed.digests)
+        self.assertTrue(parsed.encrypted)
+        self.assertEqual(['61' * 32 + '.enc', '62' * 32 + '.enc'], parsed.chunk_names)
+
+    def test_invalid_data(self):
+        self.assertRaises(ValueError, Snapshot.from_bytes, b'not a snapshot')
+
+
+class ChunkStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.state_dir.cleanup)
+        self.dropbox_client = Mock()
+        self.dropbox_client.list_files.return_value = []
+        self.index = ChunkIndex(os.path.join(self.state_dir.name, 'chunks.sqlite'))
+        self.chunk_store = ChunkStore(self.dropbox_client, self.index, upload_workers=2)
+
+    def test_store_uploads_each_chunk_once(self):
+        uploaded = {}
+
+        def upload_file(chunk_file, path, overwrite):
+            uploaded[path] = zlib.decompress(chunk_file.read())
+
+        self.dropbox_client.upload_file.side_effect = upload_file
+
+        snapshot = self.chunk_store.store('/backup', [b'first', b'second', b'first'])
+        self.chunk_store.store('/backup', [b'second', b'third'])
+
+        self.dropbox_client.list_files.assert_called_once_with('/backup/chunks')
+        self.assertEqual(3, len(snapshot.digests))
+        self.assertEqual(snapshot.digests[0], snapshot.digests[2])
+        self.assertEqual({b'first', b'second', b'third'}, set(uploaded.values()))
+        self.assertIn('/backup/chunks/' + snapshot.chunk_names[0], uploaded)
+
+    def test_failed_upload_is_not_remembered(self):
+        self.dropbox_client.upload_file.side_effect = OSError('Network down')
+
+        self.assertRaises(OSError, self.chunk_store.store, '/backup', [b'first'])
+        self.dropbox_client.upload_file.side_effect = None
+        self.chunk_store.store('/backup', [b'first'])
+
+        self.assertEqual(2, self.dropbox_client.upload_file.call_count)
+
+    def test_collect_garbage_deletes_unreferenced_chunks(self):
+        kept = Snapshot([b'a' * 32], encrypted=False)
+        self.dropbox_client.list_files.return_value = ['61' * 32, '62' * 32]
+
+        self.chunk_store.collect_garbage('/backup', [kept])
+
+        self.dropbox_client.list_files.assert_called_once_with('/backup/chunks')
+        deleted_paths = self.dropbox_client.delete_files.call_args[0][0]
+        self.assertEqual(['/backup/chunks/' + '62' * 32], list(deleted_paths))
@@ -1,16 +1,33 @@
 
+import gzip
+import io
+import subprocess
 import unittest
 
-from unittest.mock import Mock, call, ANY
+from unittest.mock import Mock, call, ANY, patch
 
+from backup_to_dropbox.metrics import RunMetrics
 from backup_to_dropbox.services import GpgEncryptionService
 
 class GpgEncryptionServiceTest(unittest.TestCase):
     def setUp(self):
         self.destination = 'TARGET_DESTINATION'
-        self.gnupg_mock = Mock()
+        self.gnupg_mock = Mock(binary='/usr/bin/gpg',
+                               homedir='/gpg-home',
+                               keyring='/gpg-home/pubring.gpg',
+                               secring='/gpg-home/secring.gpg')
         self.encryption_service = GpgEncryptionService(self.destination, self.gnupg_mock)
 
+    def fake_gpg(self, command):
+        """Makes ``command`` run instead of gpg and returns the mock of ``Popen`` starting it."""
+        process = subprocess.Popen(command,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        patcher = patch('subprocess.Popen', return_value=process)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
     def test_successful_encryption(self):
         file_to_encrypt = Mock()
         encrypted_file_contents = b'encrypted value'
@@ -45,3 +62,67 @@ class GpgEncryptionServiceTest(unittest.TestCase):
                                                         output=ANY,
                                                         armor=False)
 
+
+    def test_successful_stream_encryption(self):
+        popen_mock = self.fake_gpg(['cat'])
+        data = b'backup archive' * 100000
+
+        with self.encryption_service.encrypt_stream(io.BytesIO(data)) as encrypted_stream:
+            self.assertEqual(data, encrypted_stream.read())
+
+        popen_mock.assert_called_once_with(
+            ['/usr/bin/gpg', '--no-options', '--no-emit-version', '--no-tty', '--status-fd', '2',
+             '--homedir', '/gpg-home',
+             '--no-default-keyring', '--keyring', '/gpg-home/pubring.gpg',
+             '--secret-keyring', '/gpg-home/secring.gpg',
+             '--always-trust', '--encrypt', '--recipient', self.destination],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+
+    def test_stream_encryption_records_metrics(self):
+        metrics = RunMetrics()
+        self.encryption_service = GpgEncryptionService(self.destination,
+                                                       self.gnupg_mock,
+                                                       metrics=metrics)
+        self.fake_gpg(['gzip', '-c'])
+        data = b'backup archive' * 100000
+
+        with self.encryption_service.encrypt_stream(io.BytesIO(data)) as encrypted_stream:
+            encrypted = encrypted_stream.read()
+
+        stats = metrics.report()['stages']['encrypt']
+        self.assertEqual(1, stats['calls'])
+        self.assertEqual(len(data), stats['bytes_in'])
+        self.assertEqual(len(encrypted), stats['bytes_out'])
+
+    def test_stream_decryption_records_metrics(self):
+        metrics = RunMetrics()
+        self.encryption_service = GpgEncryptionService(None, self.gnupg_mock, metrics=metrics)
+        popen_mock = self.fake_gpg(['gzip', '-dc'])
+        data = b'backup archive' * 100000
+        compressed = gzip.compress(data)
+
+        with self.encryption_service.decrypt_stream(io.BytesIO(compressed)) as decrypted_stream:
+            self.assertEqual(data, decrypted_stream.read())
+
+        self.assertEqual(['--decrypt'], popen_mock.call_args[0][0][-1:])
+        stats = metrics.report()['stages']['decrypt']
+        self.assertEqual(len(compressed), stats['bytes_in'])
+        self.assertEqual(len(data), stats['bytes_out'])
+
+    def test_fail_to_encrypt_stream_raises_error_at_the_end(self):
+        self.fake_gpg(['sh', '-c', 'cat >/dev/null; echo "no public key" >&2; exit 2'])
+
+        with self.encryption_service.encrypt_stream(io.BytesIO(b'data')) as encrypted_stream:
+            with self.assertRaisesRegex(Exception, 'no public key'):
+                encrypted_stream.read()
+
+    def test_input_error_is_raised_by_stream(self):
+        self.fake_gpg(['cat'])
+        file_to_encrypt = Mock()
+        file_to_encrypt.read.side_effect = OSError('disk error')
+
+        with self.encryption_service.encrypt_stream(file_to_encrypt) as encrypted_stream:
+            with self.assertRaisesRegex(OSError, 'disk error'):
+                encrypted_stream.read()
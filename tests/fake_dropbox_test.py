@@ -0,0 +1,96 @@
+import io
+import os
+import tempfile
+import unittest
+
+from unittest.mock import patch
+
+from benchmarks.fake_dropbox import FakeDropbox
+from backup_to_dropbox.clients import ContentHasher, DropboxClient
+from backup_to_dropbox.metrics import RunMetrics
+from backup_to_dropbox.services import BackupService
+
+
+class FakeDropboxTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeDropbox(error_rate=0.2, lost_response_rate=0.2, seed=3)
+
+    @patch.object(DropboxClient, 'MAX_CHUNK_RETRIES', 10)
+    @patch.object(DropboxClient, 'UPLOAD_ALIGNMENT', 1024)
+    @patch.object(DropboxClient, 'INITIAL_CHUNK_SIZE', 1024)
+    @patch.object(DropboxClient, 'MAX_CHUNK_SIZE', 4096)
+    @patch.object(DropboxClient, 'CONCURRENT_CHUNK_SIZE', 2048)
+    @patch('time.sleep')
+    def test_sessions_survive_injected_errors(self, sleep_mock):
+        data = os.urandom(64 * 1024)
+        for concurrency in (1, 3):
+            client = DropboxClient(self.fake,
+                                   upload_concurrency=concurrency,
+                                   max_upload_memory=16 * 1024,
+                                   verify_uploads=True)
+            path = '/test/{}'.format(concurrency)
+
+            client.upload_file(io.BytesIO(data), path)
+
+            self.assertEqual(len(data), self.fake.files[path].size)
+        content_hasher = ContentHasher()
+        content_hasher.update(data)
+        self.assertEqual(content_hasher.hexdigest(), self.fake.files['/test/1'].content_hash)
+        self.assertEqual(content_hasher.hexdigest(), self.fake.files['/test/3'].content_hash)
+        self.assertGreater(self.fake.stats['errors'], 0)
+
+    @patch.object(DropboxClient, 'SINGLE_REQ_UPLOAD_SIZE_LIMIT', 1024)
+    @patch.object(DropboxClient, 'UPLOAD_ALIGNMENT', 1024)
+    @patch.object(DropboxClient, 'INITIAL_CHUNK_SIZE', 1024)
+    @patch.object(DropboxClient, 'CONCURRENT_CHUNK_SIZE', 1024)
+    def test_throttled_uploads_back_off_and_complete(self):
+        fake = FakeDropbox(latency=0.02, max_concurrent_uploads=2, retry_after=0.01)
+        metrics = RunMetrics()
+        client = DropboxClient(fake, upload_concurrency=6, metrics=metrics, verify_uploads=True)
+        data = os.urandom(32 * 1024)
+
+        client.upload_file(io.BytesIO(data), '/test/file')
+
+        self.assertEqual(len(data), fake.files['/test/file'].size)
+        self.assertGreater(fake.stats['throttled'], 0)
+        self.assertEqual(fake.stats['throttled'], metrics.report()['counters']['throttled_requests'])
+
+    def test_volumes_are_uploaded_concurrently(self):
+        fake = FakeDropbox(latency=0.3)
+        backup_service = BackupService(DropboxClient(fake), 'test', volume_size=3100,
+                                       volume_workers=4)
+        with tempfile.TemporaryDirectory() as backup_dir:
+            for number in range(16):
+                with open(os.path.join(backup_dir, str(number)), 'wb') as data_file:
+                    data_file.write(os.urandom(1000))
+
+            backup_service.backup_paths([backup_dir])
+
+        self.assertGreater(len(fake.files), 4)
+        self.assertGreater(fake.stats['max_concurrent_uploads'], 1)
+
+    def test_listing_and_deleting_many_files(self):
+        client = DropboxClient(self.fake)
+        paths = ['/test/file-{:04d}'.format(index) for index in range(250)]
+        for path in paths:
+            client.upload_file(io.BytesIO(b'data'), path)
+
+        self.assertEqual([os.path.basename(path) for path in paths], client.list_files('/test'))
+
+        with patch('time.sleep'):
+            client.delete_files(paths[:200])
+        self.assertEqual([os.path.basename(path) for path in paths[200:]],
+                         client.list_files('/test'))
+
+    @patch.object(DropboxClient, 'DOWNLOAD_CHUNK_SIZE', 1000)
+    @patch('time.sleep')
+    def test_ranged_downloads_survive_injected_errors(self, sleep_mock):
+        client = DropboxClient(self.fake)
+        data = os.urandom(64 * 1024)
+        client.upload_file(io.BytesIO(data), '/test/file')
+
+        with client.open_download('/test/file') as download:
+            self.assertEqual(data, download.read())
+        with client.open_download('/test/file', workers=4) as download:
+            self.assertEqual(data[:10000], download.read(10000))
+        self.assertGreater(self.fake.stats['errors'], 0)
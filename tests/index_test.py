@@ -0,0 +1,95 @@
+import unittest
+
+from backup_to_dropbox.index import ArchiveIndex, ArchiveIndexBuilder
+
+
+class ArchiveIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.members = [('home/user/{}/file-{:04d}.txt'.format(folder, number),
+                         (folder_number * 1000 + number) * 512)
+                        for folder_number, folder in enumerate(('docs', 'docs-old', 'music'))
+                        for number in range(200)]
+        self.members.append(('home/user', 10))
+        self.index = ArchiveIndex.build(reversed(self.members),
+                                        [(0, 0), (300000, 1000), (1200000, 5000)])
+
+    def test_lookup(self):
+        for name, offset in self.members:
+            self.assertEqual(offset, self.index.lookup(name))
+        self.assertIsNone(self.index.lookup('home/user/docs'))
+        self.assertIsNone(self.index.lookup('home/user/docs/file-0000'))
+        self.assertIsNone(self.index.lookup('zzz'))
+        self.assertIsNone(self.index.lookup(''))
+
+    def test_members_under_a_path(self):
+        docs = list(self.index.members('home/user/docs'))
+
+        self.assertEqual(sorted(self.members[:200]), docs)
+        self.assertEqual([('home/user/music/file-0007.txt', 2007 * 512)],
+                         list(self.index.members('home/user/music/file-0007.txt')))
+        self.assertEqual(len(self.members), len(list(self.index.members('home'))))
+        self.assertEqual(len(self.members), len(list(self.index.members())))
+        self.assertEqual([], list(self.index.members('home/user/doc')))
+
+    def test_block_of_an_offset(self):
+        self.assertEqual((0, 0), self.index.block(0))
+        self.assertEqual((0, 0), self.index.block(299999))
+        self.assertEqual((300000, 1000), self.index.block(300000))
+        self.assertEqual((1200000, 5000), self.index.block(2000000))
+
+    def test_end_of_a_member_and_of_its_blocks(self):
+        self.assertEqual(512, self.index.member_end(10))
+        self.assertEqual(1001 * 512, self.index.member_end(1000 * 512))
+        self.assertIsNone(self.index.member_end(2199 * 512))
+        self.assertEqual(1000, self.index.block_end(300000))
+        self.assertEqual(5000, self.index.block_end(300001))
+        self.assertEqual(5000, self.index.block_end(1200000))
+        self.assertIsNone(self.index.block_end(1200001))
+        self.assertIsNone(self.index.block_end(None))
+
+    def test_uncompressed_archive_blocks(self):
+        index = ArchiveIndex.build(self.members)
+
+        self.assertFalse(index.compressed)
+        self.assertEqual((12345, 12345), index.block(12345))
+        self.assertEqual(512, index.member_end(10))
+        self.assertEqual(12345, index.block_end(12345))
+
+    def test_serialization(self):
+        data = self.index.to_bytes()
+        index = ArchiveIndex.from_bytes(data)
+
+        self.assertTrue(index.compressed)
+        self.assertEqual(self.index.blocks, index.blocks)
+        self.assertEqual(sorted(self.members), list(index.members()))
+        # Shared prefixes are stored once.
+        self.assertLess(len(data), sum(len(name) for name, _ in self.members) / 4)
+        self.assertRaises(ValueError, ArchiveIndex.from_bytes, b'not an index')
+
+    def test_non_utf8_names(self):
+        name = b'caf\xe9'.decode('utf-8', 'surrogateescape')
+        index = ArchiveIndex.from_bytes(ArchiveIndex.build([(name, 1024)]).to_bytes())
+
+        self.assertEqual(1024, index.lookup(name))
+        self.assertEqual([(name, 1024)], list(index.members()))
+
+    def test_empty_index(self):
+        index = ArchiveIndex.from_bytes(ArchiveIndexBuilder().build().to_bytes())
+
+        self.assertIsNone(index.lookup('file'))
+        self.assertEqual([], list(index.members()))
+
+
+class ArchiveIndexBuilderTest(unittest.TestCase):
+
+    def test_builds_index_of_added_members(self):
+        builder = ArchiveIndexBuilder()
+        builder.add('b', 512)
+        builder.add('a', 0)
+        builder.blocks = [(0, 0)]
+
+        index = builder.build()
+
+        self.assertTrue(index.compressed)
+        self.assertEqual([('a', 0), ('b', 512)], list(index.members()))
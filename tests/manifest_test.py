@@ -0,0 +1,98 @@
+import os
+import tempfile
+import unittest
+
+from backup_to_dropbox.manifest import FileManifest, FileState, IncrementalBackupState
+
+class IncrementalBackupStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.state_dir.cleanup)
+        self.addCleanup(self.data_dir.cleanup)
+
+    def _write(self, name, content):
+        path = os.path.join(self.data_dir.name, name)
+        with open(path, 'wb') as data_file:
+            data_file.write(content)
+        return path
+
+    def _run(self, state, paths):
+        tracker = state.start()
+        changed = [path for path in paths if tracker.has_changed(path, os.lstat(path))]
+        deleted = list(tracker.deleted_paths())
+        tracker.commit()
+        return tracker, changed, deleted
+
+    def test_first_backup_is_full(self):
+        state = IncrementalBackupState(self.state_dir.name)
+        self.assertTrue(state.next_is_full())
+
+        tracker, changed, deleted = self._run(state, [self._write('a', b'a')])
+
+        self.assertTrue(tracker.is_full)
+        self.assertEqual(1, len(changed))
+        self.assertEqual([], deleted)
+        self.assertFalse(state.next_is_full())
+
+    def test_incremental_backup_detects_changes_and_deletions(self):
+        state = IncrementalBackupState(self.state_dir.name)
+        unchanged = self._write('unchanged', b'1')
+        modified = self._write('modified', b'1')
+        removed = self._write('removed', b'1')
+        self._run(state, [unchanged, modified, removed])
+
+        os.remove(removed)
+        self._write('modified', b'22')
+        added = self._write('added', b'1')
+        tracker, changed, deleted = self._run(state, [unchanged, modified, added])
+
+        self.assertFalse(tracker.is_full)
+        self.assertEqual([modified, added], changed)
+        self.assertEqual([removed], deleted)
+
+    def test_hash_skips_files_with_same_content(self):
+        state = IncrementalBackupState(self.state_dir.name, hash_files=True)
+        path = self._write('touched', b'content')
+        self._run(state, [path])
+
+        os.utime(path, ns=(0, 0))
+        tracker, changed, deleted = self._run(state, [path])
+
+        self.assertEqual([], changed)
+
+    def test_full_every(self):
+        state = IncrementalBackupState(self.state_dir.name, full_every=2)
+        path = self._write('a', b'a')
+
+        kinds = [self._run(state, [path])[0].is_full for _ in range(5)]
+
+        self.assertEqual([True, False, False, True, False], kinds)
+
+    def test_discarded_run_keeps_previous_manifest(self):
+        state = IncrementalBackupState(self.state_dir.name)
+        path = self._write('a', b'a')
+        self._run(state, [path])
+
+        self._write('a', b'bb')
+        tracker = state.start()
+        self.assertTrue(tracker.has_changed(path, os.lstat(path)))
+        tracker.discard()
+
+        tracker = state.start()
+        self.assertTrue(tracker.has_changed(path, os.lstat(path)))
+        tracker.discard()
+
+
+class FileManifestTest(unittest.TestCase):
+
+    def test_non_utf8_paths(self):
+        with tempfile.TemporaryDirectory() as state_dir:
+            manifest = FileManifest(os.path.join(state_dir, 'manifest.sqlite'))
+            path = os.fsdecode(b'/data/\xff\xfe')
+            manifest.add(path, FileState(1, 2, 3, None))
+
+            self.assertEqual(FileState(1, 2, 3, None), manifest.lookup(path))
+            self.assertIsNone(manifest.lookup('/data/other'))
+            manifest.close()
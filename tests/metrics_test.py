@@ -0,0 +1,123 @@
+import io
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from backup_to_dropbox.metrics import (MeteredWriter, RunMetrics, save_prometheus_textfile,
+                                       save_report)
+
+
+class RunMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = RunMetrics()
+
+    def test_stages_accumulate_every_run(self):
+        for _ in range(3):
+            with self.metrics.stage('upload'):
+                self.metrics.add_bytes('upload', bytes_out=10)
+        self.metrics.add_bytes('compress', bytes_in=100, bytes_out=25)
+
+        stages = self.metrics.report()['stages']
+        self.assertEqual(3, stages['upload']['calls'])
+        self.assertEqual(30, stages['upload']['bytes_out'])
+        self.assertGreater(stages['upload']['wall_time'], 0)
+        self.assertNotIn('ratio', stages['upload'])
+        self.assertEqual(0.25, stages['compress']['ratio'])
+
+    def test_add_stages_of_another_report(self):
+        worker_metrics = RunMetrics()
+        worker_metrics.add_time('archive', 2.0, 1.5, calls=1)
+        worker_metrics.add_bytes('archive', bytes_in=100, bytes_out=40)
+        self.metrics.add_time('archive', 1.0, 0.5, calls=1)
+
+        self.metrics.add_stages(worker_metrics.report()['stages'])
+
+        archive = self.metrics.report()['stages']['archive']
+        self.assertEqual(2, archive['calls'])
+        self.assertEqual(3.0, archive['wall_time'])
+        self.assertEqual(2.0, archive['cpu_time'])
+        self.assertEqual(40, archive['bytes_out'])
+
+    def test_stage_is_recorded_when_it_fails(self):
+        with self.assertRaises(ValueError):
+            with self.metrics.stage('upload'):
+                raise ValueError()
+
+        self.assertEqual(1, self.metrics.report()['stages']['upload']['calls'])
+
+    def test_counters_and_samples_from_several_threads(self):
+        def work():
+            for value in range(100):
+                self.metrics.increment('upload_retries')
+                self.metrics.observe('upload_chunk_seconds', value)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        report = self.metrics.report(backup_name='test')
+        self.assertEqual('test', report['backup_name'])
+        self.assertEqual({'upload_retries': 400}, report['counters'])
+        samples = report['samples']['upload_chunk_seconds']
+        self.assertEqual(400, samples['count'])
+        self.assertEqual(0, samples['min'])
+        self.assertEqual(99, samples['max'])
+        self.assertEqual(50, samples['quantiles']['0.5'])
+        self.assertEqual(99, samples['quantiles']['0.99'])
+        self.assertGreater(report['peak_rss_bytes'], 1024 * 1024)
+
+    def test_metered_writer_counts_bytes_written(self):
+        output = io.BytesIO()
+        writer = MeteredWriter(output)
+
+        writer.write(b'abc')
+        writer.write(b'defg')
+
+        self.assertEqual(b'abcdefg', output.getvalue())
+        self.assertEqual(7, writer.bytes_written)
+        self.assertGreater(writer.wall_time, 0)
+
+
+class SaveMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics = RunMetrics()
+        with metrics.stage('upload'):
+            metrics.add_bytes('upload', bytes_out=1024)
+        metrics.increment('upload_retries', 2)
+        metrics.observe('upload_chunk_seconds', 1.5)
+        self.report = metrics.report(backup_name='my "server"', succeeded=True)
+
+    def test_save_report(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            report_path = os.path.join(output_dir, 'report.json')
+
+            save_report(self.report, report_path)
+
+            with open(report_path) as report_file:
+                self.assertEqual(self.report, json.load(report_file))
+            self.assertEqual(['report.json'], os.listdir(output_dir))
+
+    def test_save_prometheus_textfile(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            textfile_path = os.path.join(output_dir, 'backup.prom')
+
+            save_prometheus_textfile(self.report, textfile_path)
+
+            with open(textfile_path) as textfile:
+                lines = textfile.read().splitlines()
+        self.assertIn('# TYPE backup_to_dropbox_stage_wall_seconds gauge', lines)
+        self.assertIn('backup_to_dropbox_last_run_success{backup="my \\"server\\""} 1.0', lines)
+        self.assertIn('backup_to_dropbox_stage_bytes_out{backup="my \\"server\\"",stage="upload"} '
+                      '1024.0', lines)
+        self.assertIn('backup_to_dropbox_upload_retries{backup="my \\"server\\""} 2.0', lines)
+        self.assertIn('# TYPE backup_to_dropbox_upload_chunk_seconds summary', lines)
+        self.assertIn('backup_to_dropbox_upload_chunk_seconds{backup="my \\"server\\"",'
+                      'quantile="0.5"} 1.5', lines)
+        self.assertIn('backup_to_dropbox_upload_chunk_seconds_count{backup="my \\"server\\""} 1.0',
+                      lines)
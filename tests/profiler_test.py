@@ -0,0 +1,40 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from backup_to_dropbox.profiler import SamplingProfiler
+
+
+def busy_function(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class SamplingProfilerTest(unittest.TestCase):
+
+    def test_samples_stacks_of_other_threads(self):
+        stop = threading.Event()
+        worker = threading.Thread(target=busy_function, args=(stop,), name='busy-worker')
+        profiler = SamplingProfiler(interval=0.001)
+
+        worker.start()
+        profiler.start()
+        try:
+            threading.Event().wait(0.2)
+        finally:
+            profiler.stop()
+            stop.set()
+            worker.join()
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            profile_path = os.path.join(output_dir, 'profile.txt')
+            profiler.save(profile_path)
+            with open(profile_path) as profile_file:
+                lines = profile_file.read().splitlines()
+
+        worker_stacks = [line for line in lines if line.startswith('busy-worker;')]
+        self.assertTrue(worker_stacks)
+        stack, count = worker_stacks[0].rsplit(' ', 1)
+        self.assertIn('busy_function (profiler_test.py:', stack)
+        self.assertGreater(int(count), 0)
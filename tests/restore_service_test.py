@@ -0,0 +1,241 @@
+import os
+import stat
+import tempfile
+import unittest
+
+from datetime import datetime
+from unittest.mock import Mock, patch
+
+from benchmarks.fake_dropbox import FakeDropbox
+from backup_to_dropbox.clients import DropboxClient
+from backup_to_dropbox.compression import NoCompressionCodec, SeekableGzipWriter
+from backup_to_dropbox.dedup import ChunkIndex, ChunkStore
+from backup_to_dropbox.index import ArchiveIndex
+from backup_to_dropbox.manifest import IncrementalBackupState
+from backup_to_dropbox.metrics import RunMetrics
+from backup_to_dropbox.services import BackupService, RestoreService
+
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as data_file:
+        data_file.write(content)
+
+
+def read_tree(root):
+    """Returns the relative paths under ``root`` mapped to their content (``None`` for folders)."""
+    tree = {}
+    for dir_path, dir_names, file_names in os.walk(root):
+        for dir_name in dir_names:
+            tree[os.path.relpath(os.path.join(dir_path, dir_name), root)] = None
+        for file_name in file_names:
+            with open(os.path.join(dir_path, file_name), 'rb') as data_file:
+                tree[os.path.relpath(os.path.join(dir_path, file_name), root)] = data_file.read()
+    return tree
+
+
+@patch.object(DropboxClient, 'DOWNLOAD_CHUNK_SIZE', 1000)
+@patch('time.sleep')
+class RestoreServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeDropbox(error_rate=0.1, seed=5)
+        self.dropbox_client = DropboxClient(self.fake)
+        self.backup_name = 'TestBackupName'
+        self.encryption_service = None
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.temp_dir.name, 'source')
+        write_file(os.path.join(self.source, 'notes.txt'), b'notes')
+        write_file(os.path.join(self.source, 'docs', 'report.bin'), os.urandom(5000))
+        write_file(os.path.join(self.source, 'docs', 'old.txt'), b'old')
+        os.chmod(os.path.join(self.source, 'notes.txt'), 0o600)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def backup(self, minute, **kwargs):
+        backup_service = BackupService(self.dropbox_client,
+                                       self.backup_name,
+                                       self.encryption_service,
+                                       **kwargs)
+        with patch.object(BackupService, 'now', return_value=datetime(2020, 5, 10, 17, minute)):
+            backup_service.backup_paths([self.source])
+
+    def restore(self, backup, paths=(), fetch=False):
+        destination = tempfile.mkdtemp(dir=self.temp_dir.name)
+        restore_service = RestoreService(self.dropbox_client,
+                                         self.backup_name,
+                                         self.encryption_service,
+                                         download_workers=3)
+        if fetch:
+            restore_service.fetch(backup, destination, paths)
+        else:
+            restore_service.restore(backup, destination, paths)
+        return os.path.join(destination, self.source.lstrip('/'))
+
+    def test_restores_latest_backup(self, sleep_mock):
+        self.backup(0)
+        write_file(os.path.join(self.source, 'new.txt'), b'new')
+        self.backup(1)
+
+        restored = self.restore('latest')
+
+        self.assertEqual(read_tree(self.source), read_tree(restored))
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(os.path.join(restored, 'notes.txt')).st_mode))
+        self.assertEqual(int(os.stat(os.path.join(self.source, 'docs')).st_mtime),
+                         int(os.stat(os.path.join(restored, 'docs')).st_mtime))
+
+    def test_restores_incremental_backups_on_top_of_the_full_one(self, sleep_mock):
+        with tempfile.TemporaryDirectory() as state_dir:
+            incremental_state = IncrementalBackupState(state_dir)
+            self.backup(0, incremental_state=incremental_state)
+            original_tree = read_tree(self.source)
+            os.remove(os.path.join(self.source, 'docs', 'old.txt'))
+            write_file(os.path.join(self.source, 'new.txt'), b'new')
+            self.backup(1, incremental_state=incremental_state)
+
+        self.assertEqual(read_tree(self.source), read_tree(self.restore('2020-05-10-1701')))
+        self.assertEqual(original_tree, read_tree(self.restore('2020-05-10-1700.tar.gz')))
+
+    def test_restores_only_selected_paths(self, sleep_mock):
+        self.backup(0)
+
+        restored = self.restore('latest', [os.path.join(self.source, 'docs') + '/'])
+
+        self.assertEqual(['docs', 'docs/old.txt', 'docs/report.bin'],
+                         sorted(read_tree(restored)))
+
+    def test_restores_every_volume(self, sleep_mock):
+        self.backup(0, volume_size=2000, volume_workers=2)
+        self.assertGreater(len(self.dropbox_client.list_files('/' + self.backup_name)), 2)
+
+        self.assertEqual(read_tree(self.source), read_tree(self.restore('latest')))
+
+    def test_restores_deduplicated_backup(self, sleep_mock):
+        chunk_index = ChunkIndex(os.path.join(self.temp_dir.name, 'chunks.sqlite'))
+        self.backup(0, chunk_store=ChunkStore(self.dropbox_client, chunk_index))
+
+        self.assertEqual(read_tree(self.source), read_tree(self.restore('latest')))
+
+    def test_decrypts_encrypted_archives(self, sleep_mock):
+        self.encryption_service = Mock()
+        self.encryption_service.encrypt_stream.side_effect = lambda archive: archive
+        self.encryption_service.decrypt_stream.side_effect = lambda archive: archive
+        self.backup(0)
+
+        self.assertEqual(read_tree(self.source), read_tree(self.restore('latest')))
+        self.encryption_service.decrypt_stream.assert_called_once()
+
+        self.encryption_service = None
+        self.assertRaises(Exception, self.restore, 'latest')
+
+    def test_unchanged_backup_is_copied_instead_of_uploaded(self, sleep_mock):
+        metrics = RunMetrics()
+        self.dropbox_client = DropboxClient(self.fake, metrics=metrics, verify_uploads=True)
+        self.backup(0, skip_unchanged=True)
+        bytes_received = self.fake.stats['bytes_received']
+
+        self.backup(1, skip_unchanged=True, metrics=metrics)
+
+        self.assertEqual(bytes_received, self.fake.stats['bytes_received'])
+        archives = ['/{}/2020-05-10-17{:02d}.tar.gz'.format(self.backup_name, minute)
+                    for minute in (0, 1)]
+        self.assertEqual(self.fake.files[archives[0]].content_hash,
+                         self.fake.files[archives[1]].content_hash)
+        self.assertEqual(self.fake.files[archives[1]].size,
+                         metrics.report()['counters']['unchanged_bytes_not_uploaded'])
+        self.assertEqual(read_tree(self.source), read_tree(self.restore('2020-05-10-1701')))
+
+        write_file(os.path.join(self.source, 'new.txt'), b'new')
+        self.backup(2, skip_unchanged=True)
+
+        self.assertGreater(self.fake.stats['bytes_received'], bytes_received)
+        self.assertEqual(read_tree(self.source), read_tree(self.restore('latest')))
+
+    def test_unknown_backup_is_reported(self, sleep_mock):
+        self.backup(0)
+
+        self.assertRaisesRegex(Exception, 'not found', self.restore, '2020-05-11-0000')
+
+    @patch.object(SeekableGzipWriter, 'BLOCK_SIZE', 4096)
+    def test_fetches_paths_of_seekable_backup(self, sleep_mock):
+        for number in range(20):
+            write_file(os.path.join(self.source, 'bulk', 'file-{:02d}'.format(number)),
+                       os.urandom(3000))
+        self.backup(0, seekable=True)
+        metrics = RunMetrics()
+        self.dropbox_client = DropboxClient(self.fake, metrics=metrics)
+
+        restored = self.restore('latest',
+                                [os.path.join(self.source, 'docs'),
+                                 os.path.join(self.source, 'notes.txt')],
+                                fetch=True)
+
+        source_tree = read_tree(self.source)
+        self.assertEqual({path: content for path, content in source_tree.items()
+                          if not path.startswith('bulk')},
+                         read_tree(restored))
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(os.path.join(restored, 'notes.txt')).st_mode))
+        archive_size = sum(file.size for path, file in self.fake.files.items()
+                           if path.endswith('.tar.gz'))
+        self.assertLess(metrics.report()['stages']['download']['bytes_in'], archive_size / 2)
+
+    @patch.object(SeekableGzipWriter, 'BLOCK_SIZE', 4096)
+    def test_fetch_downloads_only_the_blocks_of_the_members(self, sleep_mock):
+        for number in range(20):
+            write_file(os.path.join(self.source, 'bulk', 'file-{:02d}'.format(number)),
+                       os.urandom(3000))
+        self.backup(0, seekable=True)
+        archive = '/{}/2020-05-10-1700.tar.gz'.format(self.backup_name)
+        index = ArchiveIndex.from_bytes(
+            bytes(self.fake.files[archive + BackupService.INDEX_SUFFIX].content))
+        offset = index.lookup(os.path.join(self.source, 'bulk', 'file-03').lstrip('/'))
+        start = index.block(offset)[1]
+        end = index.block_end(index.member_end(offset))
+        self.assertLess(end - start, self.fake.files[archive].size / 4)
+
+        with patch.object(self.fake, 'files_download', wraps=self.fake.files_download) as download:
+            self.restore('latest', [os.path.join(self.source, 'bulk', 'file-03')], fetch=True)
+
+        # Failed requests are retried with the same range.
+        ranges = {args[1] for args, _ in download.call_args_list if args[0] == archive}
+        self.assertEqual(start, min(first for first, _ in ranges))
+        self.assertEqual(end - 1, max(last for _, last in ranges))
+        self.assertEqual(end - start, sum(last - first + 1 for first, last in ranges))
+
+    @patch.object(SeekableGzipWriter, 'BLOCK_SIZE', 4096)
+    def test_restores_seekable_backup(self, sleep_mock):
+        for number in range(5):
+            write_file(os.path.join(self.source, 'bulk', 'file-{:02d}'.format(number)),
+                       os.urandom(3000))
+        self.backup(0, seekable=True)
+
+        restored = self.restore('latest')
+
+        self.assertEqual(read_tree(self.source), read_tree(restored))
+
+    def test_fetches_from_incremental_seekable_backups(self, sleep_mock):
+        os.link(os.path.join(self.source, 'notes.txt'), os.path.join(self.source, 'z-link'))
+        with tempfile.TemporaryDirectory() as state_dir:
+            incremental_state = IncrementalBackupState(state_dir)
+            self.backup(0, incremental_state=incremental_state, seekable=True,
+                        codec=NoCompressionCodec())
+            os.remove(os.path.join(self.source, 'docs', 'old.txt'))
+            write_file(os.path.join(self.source, 'docs', 'new.txt'), b'new')
+            self.backup(1, incremental_state=incremental_state, seekable=True,
+                        codec=NoCompressionCodec())
+
+        restored = self.restore('latest',
+                                [os.path.join(self.source, 'docs'),
+                                 os.path.join(self.source, 'z-link')],
+                                fetch=True)
+
+        self.assertEqual({path: content for path, content in read_tree(self.source).items()
+                          if path.startswith('docs') or path == 'z-link'},
+                         read_tree(restored))
+
+    def test_fetching_needs_seekable_archives(self, sleep_mock):
+        self.backup(0)
+
+        self.assertRaisesRegex(Exception, 'no index', self.restore, 'latest',
+                               [os.path.join(self.source, 'docs')], True)
@@ -0,0 +1,154 @@
+import functools
+import itertools
+import tempfile
+import threading
+import time
+import unittest
+
+from datetime import datetime
+
+from backup_to_dropbox.scheduler import CronSchedule, DiskSlots, Job, Scheduler
+
+
+class CronScheduleTest(unittest.TestCase):
+
+    def test_next_time_of_fields(self):
+        moment = datetime(2020, 5, 10, 17, 14, 30) # A Sunday
+
+        self.assertEqual(datetime(2020, 5, 10, 17, 15),
+                         CronSchedule('* * * * *').next_after(moment))
+        self.assertEqual(datetime(2020, 5, 10, 17, 20),
+                         CronSchedule('*/20 * * * *').next_after(moment))
+        self.assertEqual(datetime(2020, 5, 11, 2, 0),
+                         CronSchedule('0,30 2 * * *').next_after(moment))
+        self.assertEqual(datetime(2020, 5, 11, 0, 0),
+                         CronSchedule('@daily').next_after(moment))
+        self.assertEqual(datetime(2020, 5, 15, 3, 0),
+                         CronSchedule('0 3 * * 5').next_after(moment))
+        self.assertEqual(datetime(2020, 5, 17, 3, 0),
+                         CronSchedule('0 3 * * 7').next_after(moment))
+        self.assertEqual(datetime(2021, 2, 1, 0, 5),
+                         CronSchedule('5 0 1 2 *').next_after(moment))
+
+    def test_restricted_days_of_month_and_week_match_either(self):
+        schedule = CronSchedule('0 0 20 * 1-5')
+
+        self.assertEqual(datetime(2020, 5, 11), schedule.next_after(datetime(2020, 5, 10)))
+        self.assertEqual(datetime(2020, 6, 20), schedule.next_after(datetime(2020, 6, 19, 1)))
+
+    def test_invalid_expressions(self):
+        for expression in ('* * * *', '60 * * * *', '* * 0 * *', 'a * * * *', '*/0 * * * *'):
+            self.assertRaisesRegex(ValueError, 'Invalid schedule', CronSchedule, expression)
+        self.assertRaisesRegex(ValueError, 'never matches',
+                               CronSchedule('0 0 30 2 *').next_after, datetime(2020, 5, 10))
+
+
+class SchedulerTest(unittest.TestCase):
+
+    @staticmethod
+    def clock(*times):
+        """Returns a clock giving ``times`` and then the last of them forever."""
+        times = itertools.chain(times, itertools.repeat(times[-1]))
+        return lambda: next(times)
+
+    def test_due_jobs_start_by_priority(self):
+        started = []
+
+        def run(name):
+            started.append(name)
+            if len(started) == 3:
+                scheduler.stop()
+            if name == 'high':
+                raise Exception('Failed')
+
+        jobs = [Job(name, CronSchedule('* * * * *'), functools.partial(run, name), priority)
+                for name, priority in (('low', -1), ('high', 5), ('normal', 0))]
+        scheduler = Scheduler(jobs,
+                              clock=SchedulerTest.clock(datetime(2020, 5, 10, 17, 0, 30),
+                                                        datetime(2020, 5, 10, 17, 1)))
+
+        scheduler.run()
+
+        self.assertEqual(['high', 'normal', 'low'], started)
+        self.assertEqual([datetime(2020, 5, 10, 17, 2)] * 3, [job.next_run for job in jobs])
+
+    def test_at_most_max_concurrent_jobs_run(self):
+        lock = threading.Lock()
+        running = []
+        peak = []
+        finished = []
+
+        def run():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+                finished.append(1)
+                if len(finished) == 4:
+                    scheduler.stop()
+
+        jobs = [Job(str(number), CronSchedule('@hourly'), run) for number in range(4)]
+        scheduler = Scheduler(jobs,
+                              max_concurrent_jobs=2,
+                              clock=SchedulerTest.clock(datetime(2020, 5, 10, 16, 59),
+                                                        datetime(2020, 5, 10, 17, 0)))
+
+        scheduler.run()
+
+        self.assertEqual(2, max(peak))
+        self.assertEqual(4, len(finished))
+
+    def test_job_due_while_running_runs_again_once(self):
+        started = []
+        now = [datetime(2020, 5, 10, 17, 0)]
+
+        def run():
+            started.append(now[0])
+            if len(started) == 1:
+                # Two more runs are missed while the first one runs.
+                now[0] = datetime(2020, 5, 10, 17, 2, 30)
+            else:
+                scheduler.stop()
+
+        start_time = iter([datetime(2020, 5, 10, 16, 59, 30)])
+        scheduler = Scheduler([Job('job', CronSchedule('* * * * *'), run)],
+                              clock=lambda: next(start_time, now[0]))
+
+        scheduler.run()
+
+        self.assertEqual([datetime(2020, 5, 10, 17, 0), datetime(2020, 5, 10, 17, 2, 30)],
+                         started)
+
+
+class DiskSlotsTest(unittest.TestCase):
+
+    def test_jobs_reading_the_same_disk_wait_for_each_other(self):
+        disk_slots = DiskSlots()
+        held = threading.Event()
+        release = threading.Event()
+        events = []
+
+        def first():
+            with disk_slots.hold([temp_dir, '/missing/path']):
+                held.set()
+                release.wait()
+                events.append('first released')
+
+        def second():
+            held.wait()
+            with disk_slots.hold([temp_dir]):
+                events.append('second held')
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            threads = [threading.Thread(target=first), threading.Thread(target=second)]
+            for thread in threads:
+                thread.start()
+            held.wait()
+            time.sleep(0.05)
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(['first released', 'second held'], events)
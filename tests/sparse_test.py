@@ -0,0 +1,68 @@
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+
+from backup_to_dropbox.sparse import add_sparse_file, data_extents
+
+MB = 1024 * 1024
+
+
+class SparseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, 'disk.img')
+        with open(self.path, 'wb') as image_file:
+            image_file.write(b'head' * 1024)
+            image_file.seek(8 * MB)
+            image_file.write(b'middle')
+            image_file.truncate(16 * MB)
+        if os.stat(self.path).st_blocks * 512 >= 16 * MB:
+            self.skipTest('The filesystem does not support sparse files')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_data_extents_skip_holes(self):
+        with open(self.path, 'rb') as image_file:
+            extents = data_extents(image_file, 16 * MB)
+            self.assertEqual(0, image_file.tell())
+
+        self.assertEqual(3, len(extents))
+        self.assertEqual(0, extents[0][0])
+        self.assertLessEqual(8 * MB, sum(extents[1]))
+        self.assertEqual((16 * MB, 0), extents[2])
+        self.assertLess(sum(size for _, size in extents), MB)
+
+    def test_files_without_holes_are_not_sparse(self):
+        dense_path = os.path.join(self.temp_dir.name, 'dense')
+        with open(dense_path, 'wb') as dense_file:
+            dense_file.write(os.urandom(100000))
+
+        with open(dense_path, 'rb') as dense_file:
+            self.assertIsNone(data_extents(dense_file, 100000))
+
+    def test_sparse_member_is_extracted_with_holes(self):
+        archive_file = io.BytesIO()
+        with tarfile.open(fileobj=archive_file, mode='w|') as archive, \
+                open(self.path, 'rb') as image_file:
+            tarinfo = archive.gettarinfo(self.path, 'images/disk.img')
+            add_sparse_file(archive, tarinfo, image_file, data_extents(image_file, tarinfo.size))
+            after = tarfile.TarInfo('after')
+            after.size = 5
+            archive.addfile(after, io.BytesIO(b'after'))
+        self.assertLess(len(archive_file.getvalue()), MB)
+
+        archive_file.seek(0)
+        output_dir = os.path.join(self.temp_dir.name, 'output')
+        with tarfile.open(fileobj=archive_file, mode='r|') as archive:
+            archive.extractall(output_dir)
+
+        restored_path = os.path.join(output_dir, 'images', 'disk.img')
+        with open(self.path, 'rb') as original, open(restored_path, 'rb') as restored:
+            self.assertEqual(original.read(), restored.read())
+        self.assertLess(os.stat(restored_path).st_blocks * 512, MB)
+        with open(os.path.join(output_dir, 'after'), 'rb') as after_file:
+            self.assertEqual(b'after', after_file.read())
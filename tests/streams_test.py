@@ -0,0 +1,190 @@
+import functools
+import hashlib
+import io
+import tarfile
+import threading
+import time
+import unittest
+
+from concurrent.futures import Future
+
+from backup_to_dropbox.streams import (ChunkPipe, ForwardSeekReader, HashingReader, HashingWriter,
+                                       PrefetchReader, pending_futures)
+
+class ChunkPipeTest(unittest.TestCase):
+
+    def test_data_written_is_read_in_order(self):
+        pipe = ChunkPipe(max_buffer_size=16, chunk_size=4)
+
+        def produce():
+            for i in range(10):
+                pipe.writer.write(bytes([i]) * 3)
+            pipe.writer.close()
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        content = pipe.reader.read(7) + pipe.reader.read()
+        producer.join()
+
+        self.assertEqual(b''.join(bytes([i]) * 3 for i in range(10)), content)
+
+    def test_read_returns_full_chunks_until_eof(self):
+        pipe = ChunkPipe(max_buffer_size=16, chunk_size=4)
+        pipe.writer.write(b'abcdef')
+        pipe.writer.close()
+
+        self.assertEqual(b'abcde', pipe.reader.read(5))
+        self.assertEqual(b'f', pipe.reader.read(5))
+        self.assertEqual(b'', pipe.reader.read(5))
+
+    def test_writer_abort_is_raised_by_reader(self):
+        pipe = ChunkPipe(max_buffer_size=16, chunk_size=4)
+        pipe.writer.write(b'abcd')
+        pipe.writer.abort(ValueError('archive failed'))
+
+        self.assertEqual(b'abcd', pipe.reader.read(4))
+        self.assertRaises(ValueError, pipe.reader.read, 4)
+        self.assertRaises(ValueError, pipe.reader.read, 4)
+
+    def test_closing_reader_unblocks_writer(self):
+        pipe = ChunkPipe(max_buffer_size=4, chunk_size=4)
+        errors = []
+
+        def produce():
+            try:
+                while True:
+                    pipe.writer.write(b'abcd')
+            except BrokenPipeError as e:
+                errors.append(e)
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        pipe.reader.read(4)
+        pipe.reader.close()
+        producer.join(timeout=5)
+
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(1, len(errors))
+
+    def test_closing_reader_unblocks_pending_read(self):
+        pipe = ChunkPipe(max_buffer_size=4, chunk_size=4)
+        errors = []
+
+        def consume():
+            try:
+                pipe.reader.read(4)
+            except ValueError as e:
+                errors.append(e)
+
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        pipe.reader.close()
+        consumer.join(timeout=5)
+
+        self.assertFalse(consumer.is_alive())
+        self.assertEqual(1, len(errors))
+
+
+class PrefetchReaderTest(unittest.TestCase):
+
+    def test_results_are_read_in_order(self):
+        def fetch(index):
+            # Later fetches finish first.
+            time.sleep(0.01 * (5 - index))
+            return bytes([index]) * 3
+
+        reader = PrefetchReader((functools.partial(fetch, index) for index in range(5)),
+                                workers=3)
+
+        with reader:
+            self.assertEqual(b''.join(bytes([index]) * 3 for index in range(5)), reader.read())
+
+    def test_at_most_workers_fetches_run_ahead(self):
+        started = []
+
+        def fetch(index):
+            started.append(index)
+            return b'x'
+
+        with PrefetchReader((functools.partial(fetch, index) for index in range(10)),
+                            workers=2) as reader:
+            self.assertEqual(b'x', reader.read(1))
+            self.assertLessEqual(len(started), 3)
+
+    def test_fetch_error_is_raised_by_reader(self):
+        def fail():
+            raise IOError('download failed')
+
+        with PrefetchReader([lambda: b'abc', fail]) as reader:
+            self.assertEqual(b'abc', reader.read(3))
+            self.assertRaises(IOError, reader.read, 3)
+
+
+class ForwardSeekReaderTest(unittest.TestCase):
+
+    def test_positions_start_at_offset(self):
+        reader = ForwardSeekReader(io.BytesIO(b'0123456789'), offset=100)
+
+        self.assertEqual(100, reader.tell())
+        self.assertEqual(b'01', reader.read(2))
+        self.assertEqual(105, reader.seek(3, io.SEEK_CUR))
+        self.assertEqual(b'56789', reader.read())
+        self.assertEqual(110, reader.tell())
+        self.assertRaises(io.UnsupportedOperation, reader.seek, 105)
+        self.assertRaises(io.UnsupportedOperation, reader.seek, 0, io.SEEK_END)
+
+    def test_reads_members_from_the_middle_of_an_archive(self):
+        archive_file = io.BytesIO()
+        offsets = {}
+        with tarfile.open(fileobj=archive_file, mode='w') as archive:
+            for index in range(5):
+                offsets[index] = archive.offset
+                tarinfo = tarfile.TarInfo('file-{}'.format(index))
+                tarinfo.size = 1000
+                archive.addfile(tarinfo, io.BytesIO(bytes([index]) * 1000))
+        data = archive_file.getvalue()
+
+        reader = ForwardSeekReader(io.BytesIO(data[offsets[1]:]), offsets[1])
+        for index in (2, 4):
+            reader.seek(offsets[index])
+            archive = tarfile.TarFile(fileobj=reader, mode='r')
+            self.assertEqual('file-{}'.format(index), archive.firstmember.name)
+            self.assertEqual(bytes([index]) * 1000,
+                             archive.extractfile(archive.firstmember).read())
+
+
+class HashingStreamsTest(unittest.TestCase):
+
+    def test_writer_hashes_data_written(self):
+        output = io.BytesIO()
+        writer = HashingWriter(output, hashlib.sha256())
+
+        writer.write(b'abc')
+        writer.write(b'defg')
+
+        self.assertEqual(b'abcdefg', output.getvalue())
+        self.assertEqual(hashlib.sha256(b'abcdefg').hexdigest(), writer.hasher.hexdigest())
+
+    def test_reader_hashes_data_once_from_the_start(self):
+        reader = HashingReader(io.BytesIO(b'abcdefghij'), hashlib.sha256())
+
+        self.assertEqual(b'abcd', reader.read(4))
+        reader.seek(2)
+        self.assertEqual(b'cdef', reader.read(4))
+        reader.seek(8)
+        self.assertEqual(b'ij', reader.read())
+
+        self.assertEqual(6, reader.hashed)
+        self.assertEqual(hashlib.sha256(b'abcdef').hexdigest(), reader.hasher.hexdigest())
+
+
+class PendingFuturesTest(unittest.TestCase):
+
+    def test_keeps_the_futures_not_done_and_raises_errors(self):
+        running, done, failed = Future(), Future(), Future()
+        done.set_result(1)
+
+        self.assertEqual([running], pending_futures([running, done]))
+
+        failed.set_exception(ValueError('failed'))
+        self.assertRaisesRegex(ValueError, 'failed', pending_futures, [running, done, failed])
@@ -0,0 +1,141 @@
+import contextlib
+import threading
+import time
+import unittest
+
+from datetime import datetime
+from unittest.mock import patch
+
+from backup_to_dropbox.throttle import AdaptiveConcurrency, BandwidthLimiter, BandwidthSchedule
+
+MB = 1024 * 1024
+
+
+class FakeTime:
+    """Replaces ``time.monotonic`` and ``time.sleep`` with a clock moved forward by sleeping."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class BandwidthScheduleTest(unittest.TestCase):
+
+    def test_first_profile_covering_the_time_applies(self):
+        schedule = BandwidthSchedule(['08:00-20:00=20', '22:00-06:00=50', '5'])
+
+        self.assertEqual(20 * MB, schedule.rate_at(datetime(2020, 5, 10, 8, 0)))
+        self.assertEqual(20 * MB, schedule.rate_at(datetime(2020, 5, 10, 19, 59)))
+        self.assertEqual(5 * MB, schedule.rate_at(datetime(2020, 5, 10, 20, 0)))
+        self.assertEqual(50 * MB, schedule.rate_at(datetime(2020, 5, 10, 23, 0)))
+        self.assertEqual(50 * MB, schedule.rate_at(datetime(2020, 5, 10, 5, 59)))
+
+    def test_unlimited_outside_of_the_profiles(self):
+        schedule = BandwidthSchedule(['08:00-20:00=0.5'])
+
+        self.assertEqual(MB / 2, schedule.rate_at(datetime(2020, 5, 10, 12, 0)))
+        self.assertIsNone(schedule.rate_at(datetime(2020, 5, 10, 21, 0)))
+        self.assertIsNone(BandwidthSchedule([]).rate_at(datetime(2020, 5, 10, 12, 0)))
+
+    def test_invalid_profiles(self):
+        for profile in ('fast', '08:00=20', '08:00-25:00=20', '08:61-20:00=20', '0'):
+            self.assertRaisesRegex(ValueError, 'Invalid bandwidth profile',
+                                   BandwidthSchedule, [profile])
+
+
+class BandwidthLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.time = FakeTime()
+        self.moment = datetime(2020, 5, 10, 12, 0)
+        for name in ('monotonic', 'sleep'):
+            patcher = patch('time.' + name, getattr(self.time, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_requests_wait_for_the_debt_of_the_previous_ones(self):
+        limiter = BandwidthLimiter(BandwidthSchedule(['10']), clock=lambda: self.moment)
+
+        self.assertEqual(0, limiter.acquire(5 * MB))
+        self.assertEqual(0.5, limiter.acquire(20 * MB))
+        self.assertEqual(2, limiter.acquire(MB))
+        # Idle time only builds up a burst of one second.
+        self.time.now += 60
+        self.assertEqual(0, limiter.acquire(15 * MB))
+        self.assertEqual(0.5, limiter.acquire(MB))
+        self.assertEqual(10 * MB, limiter.burst_size())
+
+    def test_unlimited_times_do_not_wait(self):
+        limiter = BandwidthLimiter(BandwidthSchedule(['08:00-20:00=1']),
+                                   clock=lambda: self.moment)
+        limiter.acquire(10 * MB)
+
+        self.moment = datetime(2020, 5, 10, 21, 0)
+
+        self.assertEqual(0, limiter.acquire(10 * MB))
+        self.assertEqual(0, limiter.acquire(10 * MB))
+        self.assertIsNone(limiter.burst_size())
+        self.assertEqual([], self.time.sleeps)
+
+
+class AdaptiveConcurrencyTest(unittest.TestCase):
+
+    def test_throttling_halves_the_requests_in_flight_and_successes_lift_the_limit(self):
+        concurrency = AdaptiveConcurrency()
+
+        with patch('time.monotonic', return_value=1000):
+            with contextlib.ExitStack() as stack:
+                for _ in range(7):
+                    stack.enter_context(concurrency.request())
+                self.assertIsNone(concurrency.limit)
+                # The throttled request is the eighth one.
+                concurrency.throttled(1)
+            self.assertEqual(4, concurrency.limit)
+            # Requests sent before the pause started back off with it.
+            concurrency.throttled(1)
+            self.assertEqual(4, concurrency.limit)
+        with patch('time.monotonic', return_value=1002):
+            concurrency.throttled(1)
+        self.assertEqual(2, concurrency.limit)
+
+        for _ in range(2 + 3 + 4 + 5 + 6):
+            concurrency.succeeded()
+        self.assertEqual(7, concurrency.limit)
+        for _ in range(7):
+            concurrency.succeeded()
+        self.assertIsNone(concurrency.limit)
+
+    @patch('time.sleep')
+    def test_requests_wait_for_the_pause_and_a_free_slot(self, sleep_mock):
+        concurrency = AdaptiveConcurrency()
+        with patch('time.monotonic', return_value=1000), concurrency.request():
+            concurrency.throttled(3)
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def request():
+            with concurrency.request():
+                with lock:
+                    running.append(1)
+                    peak.append(len(running))
+                time.sleep(0)
+                with lock:
+                    running.pop()
+
+        with patch('time.monotonic', return_value=1001):
+            threads = [threading.Thread(target=request) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(1, max(peak))
+        self.assertIn(2, [call[0][0] for call in sleep_mock.call_args_list])
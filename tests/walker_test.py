@@ -0,0 +1,165 @@
+import io
+import os
+import tarfile
+import tempfile
+import time
+import unittest
+
+from backup_to_dropbox.walker import (ExcludeMatcher, FileWalker, WalkEntry, forget_inode,
+                                      make_tarinfo, read_patterns)
+
+
+class ExcludeMatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.matcher = ExcludeMatcher(['node_modules',
+                                       '*.pyc',
+                                       'build/',
+                                       '/home/*/.cache',
+                                       '**/tmp/*.log',
+                                       'data-[0-9]'])
+
+    def test_names_match_at_any_depth(self):
+        self.assertEqual(0, self.matcher.match('/src/app/node_modules', 'node_modules', True))
+        self.assertEqual(1, self.matcher.match('/src/app/main.pyc', 'main.pyc', False))
+        self.assertEqual(5, self.matcher.match('/srv/data-1', 'data-1', False))
+        self.assertIsNone(self.matcher.match('/srv/data-a', 'data-a', False))
+        self.assertIsNone(self.matcher.match('/src/app/main.py', 'main.py', False))
+
+    def test_trailing_slash_only_matches_directories(self):
+        self.assertEqual(2, self.matcher.match('/src/build', 'build', True))
+        self.assertIsNone(self.matcher.match('/src/build', 'build', False))
+
+    def test_paths_match_whole_path(self):
+        self.assertEqual(3, self.matcher.match('/home/user/.cache', '.cache', True))
+        self.assertIsNone(self.matcher.match('/home/user/app/.cache', '.cache', True))
+        self.assertEqual(4, self.matcher.match('/var/app/tmp/out.log', 'out.log', False))
+        self.assertIsNone(self.matcher.match('/var/app/tmp/old/out.log', 'out.log', False))
+
+    def test_many_patterns(self):
+        matcher = ExcludeMatcher(['name-{}'.format(index) for index in range(5000)] +
+                                 ['*.tmp-{}'.format(index) for index in range(5000)])
+
+        self.assertEqual(4321, matcher.match('/a/name-4321', 'name-4321', False))
+        self.assertEqual(9321, matcher.match('/a/b.tmp-4321', 'b.tmp-4321', False))
+        self.assertIsNone(matcher.match('/a/name', 'name', False))
+
+    def test_shapes_of_patterns_keep_their_order(self):
+        matcher = ExcludeMatcher(['/srv/app/*.log', 'core.*', '*.log', 'app*', '/srv/**', 'tmp/'])
+
+        self.assertEqual(0, matcher.match('/srv/app/out.log', 'out.log', False))
+        self.assertEqual(1, matcher.match('/srv/core.log', 'core.log', False))
+        self.assertEqual(2, matcher.match('/var/app.log', 'app.log', False))
+        self.assertEqual(3, matcher.match('/var/app', 'app', True))
+        self.assertEqual(4, matcher.match('/srv/data', 'data', True))
+        self.assertEqual(4, matcher.match('/srv/tmp', 'tmp', True))
+        self.assertEqual(5, matcher.match('/var/tmp', 'tmp', True))
+        self.assertIsNone(matcher.match('/var/tmp', 'tmp', False))
+
+    def test_cost_does_not_grow_with_the_number_of_patterns(self):
+        entries = [('/home/user/src/file-{}.py'.format(index), 'file-{}.py'.format(index), False)
+                   for index in range(2000)]
+
+        def cost(count):
+            matcher = ExcludeMatcher(['*.ext{}'.format(index) for index in range(count)] +
+                                     ['tmp-{}*'.format(index) for index in range(count)] +
+                                     ['/srv/app-{}/*.log'.format(index) for index in range(count)])
+            timings = []
+            for _ in range(3):
+                start = time.perf_counter()
+                for path, name, is_dir in entries:
+                    matcher.match(path, name, is_dir)
+                timings.append(time.perf_counter() - start)
+            return min(timings)
+
+        self.assertLess(cost(3000), 5 * cost(10))
+
+    def test_read_patterns_skips_comments_and_blank_lines(self):
+        with tempfile.NamedTemporaryFile('w') as patterns_file:
+            patterns_file.write('# caches\n.cache/\n\n*.pyc\n')
+            patterns_file.flush()
+
+            self.assertEqual(['.cache/', '*.pyc'], read_patterns(patterns_file.name))
+
+
+class FileWalkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.temp_dir.name, 'root')
+        for folder in ('b', 'a/node_modules/pkg', 'a/src', 'c/d/e'):
+            os.makedirs(os.path.join(self.root, folder))
+        for path, content in (('z.txt', b'z'),
+                              ('a/src/main.py', b'main'),
+                              ('a/src/main.pyc', b'compiled'),
+                              ('a/node_modules/pkg/index.js', b'index'),
+                              ('c/d/e/deep.txt', b'deep')):
+            with open(os.path.join(self.root, path), 'wb') as data_file:
+                data_file.write(content)
+        os.symlink('a', os.path.join(self.root, 'link'))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_walks_in_the_same_order_as_tarfile(self):
+        expected = []
+        with tarfile.open(fileobj=io.BytesIO(), mode='w') as archive:
+            archive.add(self.root,
+                        filter=lambda tarinfo: expected.append(tarinfo.name) or tarinfo)
+
+        for threads in (1, 4):
+            walker = FileWalker(threads=threads)
+            names = [entry.path.lstrip('/') for entry in walker.walk([self.root])]
+            self.assertEqual(expected, names)
+
+    def test_skips_excluded_entries(self):
+        walker = FileWalker(ExcludeMatcher(['node_modules', '*.pyc', 'unused']))
+
+        paths = [os.path.relpath(entry.path, self.root) for entry in walker.walk([self.root])]
+
+        self.assertNotIn('a/node_modules', paths)
+        self.assertNotIn('a/node_modules/pkg', paths)
+        self.assertNotIn('a/src/main.pyc', paths)
+        self.assertIn('a/src/main.py', paths)
+        self.assertEqual([{'pattern': 'node_modules', 'files': 0, 'directories': 1, 'bytes': 0},
+                          {'pattern': '*.pyc', 'files': 1, 'directories': 0, 'bytes': 8},
+                          {'pattern': 'unused', 'files': 0, 'directories': 0, 'bytes': 0}],
+                         walker.excluded())
+
+    def test_skips_missing_paths(self):
+        walker = FileWalker()
+
+        entries = list(walker.walk([os.path.join(self.root, 'missing'),
+                                    os.path.join(self.root, 'z.txt')]))
+
+        self.assertEqual([os.path.join(self.root, 'z.txt')], [entry.path for entry in entries])
+
+    def test_tarinfo_matches_tarfile(self):
+        os.link(os.path.join(self.root, 'z.txt'), os.path.join(self.root, 'hardlink'))
+        linked = []
+        with tarfile.open(fileobj=io.BytesIO(), mode='w') as expected_archive, \
+                tarfile.open(fileobj=io.BytesIO(), mode='w') as archive:
+            for entry in FileWalker().walk([self.root]):
+                expected = expected_archive.gettarinfo(entry.path)
+                tarinfo = make_tarinfo(archive, entry)
+                self.assertEqual(expected.get_info(), tarinfo.get_info())
+                if tarinfo.islnk():
+                    linked.append(tarinfo.name)
+        self.assertEqual([os.path.join(self.root, 'z.txt').lstrip('/')], linked)
+
+    def test_only_inodes_with_several_links_are_tracked(self):
+        os.link(os.path.join(self.root, 'z.txt'), os.path.join(self.root, 'hardlink'))
+        with tarfile.open(fileobj=io.BytesIO(), mode='w') as archive:
+            entries = {os.path.basename(entry.path): entry
+                       for entry in FileWalker().walk([self.root])}
+            first = make_tarinfo(archive, entries['hardlink'])
+            self.assertEqual([first.name], list(archive.inodes.values()))
+
+            # The first link couldn't be archived, so the next one stores the data.
+            forget_inode(archive, entries['hardlink'], first.name)
+            self.assertTrue(make_tarinfo(archive, entries['z.txt']).isreg())
+
+    def test_unsupported_types_have_no_tarinfo(self):
+        stat_result = os.stat_result((0o140755, 1, 1, 1, 0, 0, 0, 0, 0, 0))
+        with tarfile.open(fileobj=io.BytesIO(), mode='w') as archive:
+            self.assertIsNone(make_tarinfo(archive, WalkEntry('/run/socket', stat_result)))